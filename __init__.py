@@ -21,12 +21,11 @@ if "bpy" in locals():
 else:
     from .vi_node import vinode_categories, envinode_categories
     from .envi_mat import envi_materials, envi_constructions
-    from .vi_func import iprop, bprop, eprop, fprop, sprop, fvprop, sunpath1, radmat
+    from .vi_func import iprop, bprop, eprop, fprop, sprop, fvprop, sunpath1, radmat, resvals, resbins, setresmatis
     from .vi_operators import *
     from .vi_ui import *
 
 import sys, os, inspect, bpy, nodeitems_utils, bmesh, shutil
-from numpy import array, digitize
 
 epversion = "8-2-0"
 addonpath = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -102,20 +101,7 @@ def legupdate(self, context):
     scene = context.scene
     for frame in range(scene.fs, scene.fe + 1):
         for o in [o for o in scene.objects if o.get('lires')]:
-            bm = bmesh.new()
-            bm.from_mesh(o.data)
-            livires = bm.faces.layers.float['res{}'.format(frame)] if bm.faces.layers.float.get('res{}'.format(frame)) else bm.verts.layers.float['res{}'.format(frame)]
-            try:
-                vals = array([(f[livires] - scene.vi_leg_min)/(scene.vi_leg_max - scene.vi_leg_min) for f in bm.faces]) if scene['liparams']['cp'] == '0' else \
-            ([(sum([vert[livires] for vert in f.verts])/len(f.verts) - scene.vi_leg_min)/(scene.vi_leg_max - scene.vi_leg_min) for f in bm.faces])
-            except:
-                vals = array([0 for f in bm.faces])
-            bm.free()
-            bins = array([0.05*i for i in range(1, 20)])
-            nmatis = digitize(vals, bins)
-            for fi, f in enumerate(o.data.polygons):
-                f.material_index = nmatis[fi]
-                f.keyframe_insert('material_index', frame=frame)
+            setresmatis(o, frame, resbins(resvals(o, 'res{}'.format(frame))[0], scene.vi_leg_min, scene.vi_leg_max))
     scene.frame_set(scene.frame_current)
             
 def register():
@@ -361,6 +347,8 @@ def register():
     Scene.vi_display_rp_fc = fvprop(4, "", "Font colour", [0.0, 0.0, 0.0, 1.0], 'COLOR', 0, 1)
     Scene.vi_display_rp_fsh = fvprop(4, "", "Font shadow", [0.0, 0.0, 0.0, 1.0], 'COLOR', 0, 1)
     Scene.vi_display_rp_off = fprop("", "Surface offset for number display", 0, 1, 0.001)
+    Scene.vi_display_rp_bin = eprop([("0", "Off", "Draw every label"), ("1", "Max", "Draw the largest value in each screen cell"), ("2", "Min", "Draw the smallest value in each screen cell"), ("3", "Centre", "Draw the label nearest the centre of each screen cell")], "", "Screen space label binning", "0")
+    Scene.vi_display_rp_cell = iprop("", "Label binning cell size (pixels)", 8, 400, 40)
     Scene.vi_disp_trans = bpy.props.FloatProperty(name = "", description = "Sensing material transparency", min = 0, max = 1, default = 1, update = tupdate)
     Scene.vi_disp_wire = bpy.props.BoolProperty(name = "", description = "Draw wire frame", default = 0, update=wupdate)
     Scene.vi_disp_sk = bprop("", "Boolean for skyview display",  False)
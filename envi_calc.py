@@ -1,7 +1,8 @@
-import os, bpy, subprocess
+import os, bpy, subprocess, shutil, numpy, datetime, re, hashlib
 from subprocess import PIPE, Popen
 from os import rename
-from .vi_func import processf
+from .vi_func import processf, esoread, retenres
+from .envi_export import runperiod
 
 def envi_sim(calc_op, node, connode):
     scene, err = bpy.context.scene, 0
@@ -31,5 +32,150 @@ def envi_sim(calc_op, node, connode):
     if node.resname+".err" not in [im.name for im in bpy.data.texts]:
         bpy.data.texts.load(os.path.join(scene['viparams']['newdir'], node.resname+".err"))
     calc_op.report({'INFO'}, "Calculation is finished.")  
-            
-   
\ No newline at end of file
+
+def batchvariants(batchdir):
+    # Each *.idf file in the batch directory is a variant, run against a same named *.epw file if there is one
+    return sorted([os.path.splitext(f)[0] for f in os.listdir(batchdir) if f.endswith('.idf')])
+
+def batchstart(scene, node, variant):
+    rundir = os.path.join(scene['viparams']['newdir'], node.resname+'-batch', variant)
+    if os.path.isdir(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+    vepw = os.path.join(bpy.path.abspath(node.batchdir), variant+'.epw')
+    shutil.copyfile(os.path.join(bpy.path.abspath(node.batchdir), variant+'.idf'), os.path.join(rundir, 'in.idf'))
+    shutil.copyfile((os.path.join(scene['viparams']['newdir'], 'in.epw'), vepw)[os.path.isfile(vepw)], os.path.join(rundir, 'in.epw'))
+    shutil.copyfile(os.path.join(scene['viparams']['newdir'], 'Energy+.idd'), os.path.join(rundir, 'Energy+.idd'))
+    return eplusrun(rundir), rundir
+
+def eplusrun(rundir):
+    # EnergyPlus writes its own eplusout.err, so its console output is discarded rather than piped to a buffer that could
+    # fill and stall the run before anything reads it. Old outputs are removed so the error file checked is this run's
+    for fname in [fname for fname in os.listdir(rundir) if fname.split(".")[0] == "eplusout"]:
+        os.remove(os.path.join(rundir, fname))
+    return Popen('EnergyPlus', shell = True, cwd = rundir, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+def eplusfailed(rundir):
+    if not all([os.path.isfile(os.path.join(rundir, fname)) for fname in ('eplusout.err', 'eplusout.eso')]):
+        return 1
+    with open(os.path.join(rundir, 'eplusout.err'), 'r') as errfile:
+        return 'EnergyPlus Completed Successfully' not in errfile.read()
+
+def batchcollect(variant, rundir):
+    # Summary row of a finished variant: name, status and the annual ideal loads heating and cooling in kWh
+    esofile = os.path.join(rundir, 'eplusout.eso')
+    if eplusfailed(rundir):
+        return [variant, 'Error', '', '']
+    allresdict, resdict = esoread(esofile, 'batch@'+variant, runid = variant)[:2]
+    heat, cool = [sum([numpy.sum(allresdict[rid]) for rid in resdict if resdict[rid][1] == rtype])/1000 for rtype in ('Zone air heating (W)', 'Zone air cooling (W)')]
+    return [variant, 'OK', '{:.1f}'.format(heat), '{:.1f}'.format(cool)]
+
+def batchsummary(scene, node, rows):
+    sumlines = ['Variant,Status,Heating (kWh),Cooling (kWh)'] + [','.join(row) for row in rows]
+    with open(os.path.join(scene['viparams']['newdir'], node.resname+'-batch', 'summary.csv'), 'w') as sumfile:
+        sumfile.write('\n'.join(sumlines))
+    sumtext = bpy.data.texts.get(node.resname+'-batch') or bpy.data.texts.new(node.resname+'-batch')
+    sumtext.from_string('\n'.join(sumlines))
+    node['batchsummary'] = rows
+
+def shardperiods(simnode, connode):
+    # Contiguous day slices of the exported run period, one per shard
+    sdate, edate = datetime.date(2015, connode.startmonth, 1), datetime.date(2015 + (0, 1)[connode.endmonth == 12], connode.endmonth + (1, -11)[connode.endmonth == 12], 1) - datetime.timedelta(days = 1)
+    days = (edate - sdate).days + 1
+    snum = min(simnode.shards, days)
+    bounds = [sdate + datetime.timedelta(days = days * s // snum) for s in range(snum + 1)]
+    return [(bounds[s], bounds[s + 1] - datetime.timedelta(days = 1)) for s in range(snum)]
+
+def shardstart(scene, simnode, connode, calc_op):
+    # Each shard reruns the exported IDF over its own slice of the run period. Shards after the first start shardlead days
+    # early, on top of EnergyPlus' own warm-up, so the building has settled to real weather when its kept results begin
+    newdir, rpre = scene['viparams']['newdir'], re.compile(r'RunPeriod,\n.*?! - Number of Times Runperiod to be Repeated\n\n', flags = re.S)
+    with open(os.path.join(newdir, 'in.idf'), 'r') as idffile:
+        idftext = idffile.read()
+    shards, refrun = [], None
+    for si, (sdate, edate) in enumerate(shardperiods(simnode, connode)):
+        ldate = (max(sdate - datetime.timedelta(days = simnode.shardlead), datetime.date(2015, 1, 1)), sdate)[si == 0]
+        rundir = os.path.join(newdir, simnode.resname+'-shards', str(si))
+        if not os.path.isdir(rundir):
+            os.makedirs(rundir)
+        shardtext, rpnum = rpre.subn(lambda m: runperiod(connode, ldate.month, ldate.day, edate.month, edate.day), idftext, count = 1)
+        if not rpnum:
+            calc_op.report({'ERROR'}, "No exported RunPeriod was found in in.idf to shard. Re-export the EnVi context")
+            return
+        with open(os.path.join(rundir, 'in.idf'), 'w') as idffile:
+            idffile.write(shardtext)
+        for fname in ('in.epw', 'Energy+.idd'):
+            shutil.copyfile(os.path.join(newdir, fname), os.path.join(rundir, fname))
+        shards.append((eplusrun(rundir), rundir, sdate, edate))
+    if simnode.shardcheck:
+        rundir = os.path.join(newdir, simnode.resname+'-shards', 'ref')
+        if not os.path.isdir(rundir):
+            os.makedirs(rundir)
+        for fname in ('in.idf', 'in.epw', 'Energy+.idd'):
+            shutil.copyfile(os.path.join(newdir, fname), os.path.join(rundir, fname))
+        refrun = (eplusrun(rundir), rundir)
+    return shards, refrun
+
+def shardstitch(scene, simnode, shards):
+    # Joins the shard ESO files into <resname>.eso: the data dictionary and environment line of the first shard, then the
+    # hourly records of each shard's own slice, lead-in days dropped, with the day of simulation renumbered to run on.
+    # Returns the stitched day of simulation at which each later shard begins
+    newdir, offset, seams = scene['viparams']['newdir'], 0, []
+    with open(os.path.join(newdir, simnode.resname+'.eso'), 'w') as stitchfile, open(os.path.join(newdir, simnode.resname+'.err'), 'w') as errfile:
+        for si, (esimrun, rundir, sdate, edate) in enumerate(shards):
+            with open(os.path.join(rundir, 'eplusout.err'), 'r') as shardfile:
+                errfile.write('Shard {} ({} to {})\n{}\n'.format(si, sdate.strftime('%d/%m'), edate.strftime('%d/%m'), shardfile.read()))
+            with open(os.path.join(rundir, 'eplusout.eso'), 'r') as shardfile:
+                for line in shardfile:
+                    if si == 0:
+                        stitchfile.write(line)
+                    if line.startswith('End of Data Dictionary'):
+                        break
+                keep, first, lastdos = 0, 0, offset
+                for line in shardfile:
+                    linesplit = line.split(',')
+                    if line.startswith('End of Data'):
+                        break
+                    elif linesplit[0] == '2':
+                        keep = (sdate.month, sdate.day) <= (int(linesplit[2]), int(linesplit[3])) <= (edate.month, edate.day)
+                        if keep:
+                            first = first or int(linesplit[1])
+                            lastdos = int(linesplit[1]) - first + offset + 1
+                            line = ','.join([linesplit[0], ' {}'.format(lastdos)] + linesplit[2:])
+                    elif linesplit[0] in ('1', '3', '4', '5'):
+                        if linesplit[0] == '1' and si == 0:
+                            stitchfile.write(line)
+                        keep = 0
+                        continue
+                    if keep:
+                        stitchfile.write(line)
+            if si:
+                seams.append(offset + 1)
+            offset = lastdos
+        stitchfile.write('End of Data\n')
+    if os.path.isfile(os.path.join(newdir, simnode.resname+'.sql')):
+        os.remove(os.path.join(newdir, simnode.resname+'.sql'))
+    return seams
+
+def seamerror(simnode, seams, refrundir):
+    # Largest absolute difference, per result type, between the stitched results and a single full run over the day after each seam
+    allresdict, (refdict, resdict) = retenres(simnode), esoread(os.path.join(refrundir, 'eplusout.eso'), 'shardref@'+simnode['nodeid'])[:2]
+    if len(refdict['Hour']) != len(allresdict['Hour']) or not seams:
+        return {}
+    seamrows, errs = numpy.in1d(allresdict['dos'], seams), {}
+    for rid in [rid for rid in resdict if rid in allresdict and rid != simnode['dos']]:
+        errs[resdict[rid][1]] = max(errs.get(resdict[rid][1], 0), float(numpy.max(numpy.abs(allresdict[rid][seamrows] - refdict[rid][seamrows]))))
+    return errs
+
+def simhash(scene, simnode):
+    # Hash of what a simulation depends on: the IDF without its comment lines, the weather file and the sharding settings
+    if not all([os.path.isfile(os.path.join(scene['viparams']['newdir'], f)) for f in ('in.idf', 'in.epw')]):
+        return ''
+    md5 = hashlib.md5(repr((simnode.shards, simnode.shardlead)).encode())
+    with open(os.path.join(scene['viparams']['newdir'], 'in.idf'), 'r') as idffile:
+        for line in idffile:
+            if not line.lstrip().startswith('!'):
+                md5.update(line.encode())
+    with open(os.path.join(scene['viparams']['newdir'], 'in.epw'), 'rb') as epwfile:
+        md5.update(epwfile.read())
+    return md5.hexdigest()
@@ -1,16 +1,84 @@
-import bpy, os, itertools, subprocess, datetime, sys, mathutils, bmesh
-from .vi_func import epentry, objvol, ceilheight, selobj, facearea, boundpoly, rettimes, epschedwrite, selmesh
+import bpy, os, itertools, subprocess, datetime, sys, bmesh, re, hashlib, json, numpy
+from .vi_func import epentry, objvol, ceilheight, boundpoly, rettimes, epschedwrite
 dtdf = datetime.date.fromordinal
 
+def runperiod(node, sm, sd, em, ed):
+    params = ('Name', 'Begin Month', 'Begin Day', 'End Month', 'End Day', 'Day of Week for Start Day', 'Use Weather File Holidays and Special Days', 'Use Weather File Daylight Saving Period',\
+    'Apply Weekend Holiday Rule', 'Use Weather File Rain Indicators', 'Use Weather File Snow Indicators', 'Number of Times Runperiod to be Repeated')
+    paramvs = (node.loc, sm, sd, em, ed, "UseWeatherFile", "Yes", "Yes", "No", "Yes", "Yes", "1")
+    return epentry('RunPeriod', params, paramvs)
+
 def enpolymatexport(exp_op, node, locnode, em, ec):
     scene = bpy.context.scene
     for scene in bpy.data.scenes:
         scene.update()
-    en_epw = open(locnode.weather, "r")
-    en_idf = open(scene['viparams']['idf_file'], 'w')
+    en_idf = idfmodel(scene['viparams']['idf_file'])
     enng = [ng for ng in bpy.data.node_groups if ng.bl_label == 'EnVi Network'][0]
     en_idf.write("!- Blender -> EnergyPlus\n!- Using the EnVi export scripts\n!- Author: Ryan Southall\n!- Date: {}\n\nVERSION,{};\n\n".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M"), scene.epversion))
 
+    # Each IDF section is only regenerated if the hash of its inputs has changed since the last export, otherwise the
+    # fragment cached in the in-sections folder is reused. Fragments are cached before deduplication, which is done on the whole file
+    enobjs = [obj for obj in bpy.data.objects if obj.layers[1] and obj.type == 'MESH' and obj.envi_type != '0']
+    zoneobjs = [obj for obj in bpy.context.scene.objects if obj.layers[1] == True and obj.envi_type == '1']
+    envimats = [idvals(mat) for mat in bpy.data.materials if mat.envi_export == True and mat.envi_con_type != "None"]
+    geo, ngvals = geohash(enobjs), [[idvals(enode) for enode in enng.nodes], [(l.from_node.name, l.from_socket.name, l.to_node.name, l.to_socket.name) for l in enng.links], enng['enviparams'].to_dict()]
+    sections = (('header', enidfheader, (node, locnode), (node.loc, node.terrain, node.timesteps, node.startmonth, node.endmonth, locnode.weather, os.path.getmtime(locnode.weather), os.path.getsize(locnode.weather))),
+                ('materials', enidfmats, (exp_op, em, ec), (envimats, [mat.envi_con_type for mat in bpy.data.materials])),
+                ('zones', enidfzones, (), geo),
+                ('surfaces', enidfsurfs, (enng,), (geo, envimats, ngvals)),
+                ('schedules', enidfscheds, (enng,), ([idvals(obj) for obj in zoneobjs], ngvals)),
+                ('hvac', enidfhvac, (), (geo, [idvals(obj) for obj in zoneobjs])),
+                ('afn', enidfafn, (exp_op, enng), (geo, envimats, ngvals)),
+                ('outputs', enidfoutputs, (node, enng), (geo, idvals(node), ngvals)))
+
+    secdir = os.path.splitext(scene['viparams']['idf_file'])[0] + '-sections'
+    if not os.path.isdir(secdir):
+        os.makedirs(secdir)
+    try:
+        with open(os.path.join(secdir, 'index.json'), 'r') as indexfile:
+            secindex = json.load(indexfile)
+    except:
+        secindex = {'hashes': {}, 'hvactemplate': 0}
+
+    regen = []
+    for sname, sfunc, sargs, sinputs in sections:
+        shash, secfile = hashlib.md5(repr((sinputs, os.path.getmtime(__file__))).encode()).hexdigest(), os.path.join(secdir, sname+'.idf')
+        if secindex['hashes'].get(sname) != shash or not os.path.isfile(secfile):
+            secidf = idfmodel(secfile)
+            if sfunc(secidf, *sargs):
+                return
+            with open(secfile, 'w') as sf:
+                sf.write(''.join(secidf.text))
+            secindex['hashes'][sname] = shash
+            regen.append(sname)
+            if sname == 'hvac':
+                secindex['hvactemplate'] = scene['viparams'].get('hvactemplate', 0)
+        elif sname == 'hvac':
+            scene['viparams']['hvactemplate'] = secindex['hvactemplate']
+        with open(secfile, 'r') as sf:
+            en_idf.write(sf.read())
+
+    with open(os.path.join(secdir, 'index.json'), 'w') as indexfile:
+        json.dump(secindex, indexfile)
+
+    for obj in enobjs:
+        mi, areas = enmesharrays(obj)[4::2]
+        obj["floorarea"] = float(sum([areas[mi == m].sum() for m, mat in enumerate(obj.data.materials) if mat.envi_con_type == "Floor" and mat.envi_con_makeup != "2"]))
+
+    en_idf.close()
+    exp_op.report({'INFO'}, 'IDF sections regenerated: {}. {} duplicate materials, constructions and schedules merged'.format(', '.join(regen) or 'none', en_idf.dropped))
+    
+    if scene['viparams'].get('hvactemplate'):
+        os.chdir(scene['viparams']['newdir'])
+        ehtempcmd = "ExpandObjects {}".format(os.path.join(scene['viparams']['newdir'], 'in.idf'))
+        subprocess.call(ehtempcmd.split())
+        subprocess.call('{} {} {}'.format(scene['viparams']['cp'], os.path.join(scene['viparams']['newdir'], 'expanded.idf'), os.path.join(scene['viparams']['newdir'], 'in.idf')), shell = True)
+
+    if 'in.idf' not in [im.name for im in bpy.data.texts]:
+        bpy.data.texts.load(scene['viparams']['idf_file'])
+
+def enidfheader(en_idf, node, locnode):
+    en_epw = open(locnode.weather, "r")
     params = ('Name', 'North Axis (deg)', 'Terrain', 'Loads Convergence Tolerance Value', 'Temperature Convergence Tolerance Value (deltaC)',
               'Solar Distribution', 'Maximum Number of Warmup Days(from MLC TCM)')
     paramvs = (node.loc, '0.00', ("City", "Urban", "Suburbs", "Country", "Ocean,")[int(node.terrain)], '0.004', '0.4', 'FullExteriorWithReflections', '15')
@@ -22,10 +90,7 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
     for ppair in zip(params, paramvs):
         en_idf.write(epentry('', [ppair[0]], [ppair[1]]) + ('', '\n\n')[ppair[0] == params[-1]])
 
-    params = ('Name', 'Begin Month', 'Begin Day', 'End Month', 'End Day', 'Day of Week for Start Day', 'Use Weather File Holidays and Special Days', 'Use Weather File Daylight Saving Period',\
-    'Apply Weekend Holiday Rule', 'Use Weather File Rain Indicators', 'Use Weather File Snow Indicators', 'Number of Times Runperiod to be Repeated')
-    paramvs = (node.loc, node.startmonth, '1', node.endmonth, ((datetime.date(datetime.datetime.now().year, node.endmonth + (1, -11)[node.endmonth == 12], 1) - datetime.timedelta(days = 1)).day), "UseWeatherFile", "Yes", "Yes", "No", "Yes", "Yes", "1")
-    en_idf.write(epentry('RunPeriod', params, paramvs))
+    en_idf.write(runperiod(node, node.startmonth, 1, node.endmonth, ((datetime.date(datetime.datetime.now().year, node.endmonth + (1, -11)[node.endmonth == 12], 1) - datetime.timedelta(days = 1)).day)))
 
     for line in en_epw.readlines():
         if line.split(",")[0].upper() == "GROUND TEMPERATURES":
@@ -42,8 +107,9 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
             break
     en_epw.close()
 
+def enidfmats(en_idf, exp_op, em, ec):
     en_idf.write("!-   ===========  ALL OBJECTS IN CLASS: MATERIAL & CONSTRUCTIONS ===========\n\n")
-    matcount, matname, namelist = [], [], []
+    matcount, matname, namecount = {}, [], {}
     if 'Window' in [mat.envi_con_type for mat in bpy.data.materials] or 'Door' in [mat.envi_con_type for mat in bpy.data.materials]:
         params = ('Name', 'Roughness', 'Thickness (m)', 'Conductivity (W/m-K)', 'Density (kg/m3)', 'Specific Heat (J/kg-K)', 'Thermal Absorptance', 'Solar Absorptance', 'Visible Absorptance', 'Name', 'Outside Layer')
         paramvs = ('Wood frame', 'Rough', '0.12', '0.1', '1400.00', '1000', '0.9', '0.6', '0.6', 'Frame', 'Wood frame')
@@ -57,8 +123,8 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
             conname = (mat.envi_export_wallconlist, mat.envi_export_roofconlist, mat.envi_export_floorconlist, mat.envi_export_doorconlist, mat.envi_export_glazeconlist)[("Wall", "Roof", "Floor", "Door", "Window").index(mat.envi_con_type)]
             mats = (ec.wall_con, ec.roof_con, ec.floor_con, ec.door_con, ec.glaze_con)[("Wall", "Roof", "Floor", "Door", "Window").index(mat.envi_con_type)][conname]
             for pm, presetmat in enumerate(mats):
-                matname.append('{}-{}'.format(presetmat, matcount.count(presetmat.upper())))
-                matcount.append(presetmat.upper())
+                matname.append('{}-{}'.format(presetmat, matcount.get(presetmat.upper(), 0)))
+                matcount[presetmat.upper()] = matcount.get(presetmat.upper(), 0) + 1
                 
                 if em.namedict.get(presetmat) == None:
                     em.namedict[presetmat] = 0
@@ -75,8 +141,8 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
                 elif mat.envi_con_type =='Window' and em.matdat[presetmat][0] == 'Gas':
                     em.gmat_write(en_idf, matname[-1], list(em.matdat[presetmat]), str(thicklist[pm]/1000))
 
-            namelist.append(conname)
-            ec.con_write(en_idf, mat.envi_con_type, conname, str(namelist.count(conname)-1), mat.name)
+            namecount[conname] = namecount.get(conname, 0) + 1
+            ec.con_write(en_idf, mat.envi_con_type, conname, str(namecount[conname]-1), mat.name)
 
         elif mat.envi_con_makeup == '1' and mat.envi_con_type not in ('None', 'Shading', 'Aperture'):
             thicklist = (mat.envi_export_lo_thi, mat.envi_export_l1_thi, mat.envi_export_l2_thi, mat.envi_export_l3_thi, mat.envi_export_l4_thi)
@@ -84,7 +150,7 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
             layers = [i for i in itertools.takewhile(lambda x: x != "0", (mat.envi_layero, mat.envi_layer1, mat.envi_layer2, mat.envi_layer3, mat.envi_layer4))]
             if len(layers) in (2, 4) and mat.envi_con_type == 'Window':
                 exp_op.report({'ERROR'}, 'Wrong number of layers specified for the {} window construction'.format(mat.name))
-                return
+                return 1
             for l, layer in enumerate(layers):
                 if layer == "1" and mat.envi_con_type in ("Wall", "Floor", "Roof"):
                     mats = ((mat.envi_export_bricklist_lo, mat.envi_export_claddinglist_lo, mat.envi_export_concretelist_lo, mat.envi_export_metallist_lo, mat.envi_export_stonelist_lo, mat.envi_export_woodlist_lo, mat.envi_export_gaslist_lo, mat.envi_export_insulationlist_lo), \
@@ -94,16 +160,16 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
                     (mat.envi_export_bricklist_l4, mat.envi_export_claddinglist_l4, mat.envi_export_concretelist_l4, mat.envi_export_metallist_l4, mat.envi_export_stonelist_l4, mat.envi_export_woodlist_l4, mat.envi_export_gaslist_l4, mat.envi_export_insulationlist_l4))\
                     [l][int((mat.envi_layeroto, mat.envi_layer1to, mat.envi_layer2to, mat.envi_layer3to, mat.envi_layer4to)[l])]
                     if mats not in em.gas_dat:
-                        em.omat_write(en_idf, '{}-{}'.format(mats, matcount.count(mats.upper())), list(em.matdat[mats]), str(thicklist[l]/1000))
+                        em.omat_write(en_idf, '{}-{}'.format(mats, matcount.get(mats.upper(), 0)), list(em.matdat[mats]), str(thicklist[l]/1000))
                     else:
-                        em.amat_write(en_idf, '{}-{}'.format(mats, matcount.count(mats.upper())), [em.matdat[mats][2]])
+                        em.amat_write(en_idf, '{}-{}'.format(mats, matcount.get(mats.upper(), 0)), [em.matdat[mats][2]])
 
                 elif layer == "1" and mat.envi_con_type == "Window":
                     mats = ((mat.envi_export_glasslist_lo, mat.envi_export_wgaslist_l1, mat.envi_export_glasslist_l2, mat.envi_export_wgaslist_l3, mat.envi_export_glasslist_l4)[l])
                     if l in (0, 2, 4):
-                        em.tmat_write(en_idf, '{}-{}'.format(mats, matcount.count(mats.upper())), list(em.matdat[mats]) + [(0, mat.envi_export_lo_sdiff)[len(layers) == l + 1]], list(em.matdat[mats])[3])
+                        em.tmat_write(en_idf, '{}-{}'.format(mats, matcount.get(mats.upper(), 0)), list(em.matdat[mats]) + [(0, mat.envi_export_lo_sdiff)[len(layers) == l + 1]], list(em.matdat[mats])[3])
                     else:
-                        em.gmat_write(en_idf, '{}-{}'.format(mats, matcount.count(mats.upper())), list(em.matdat[mats]), str(thicklist[l]/1000))
+                        em.gmat_write(en_idf, '{}-{}'.format(mats, matcount.get(mats.upper(), 0)), list(em.matdat[mats]), str(thicklist[l]/1000))
 
                 elif layer == "2" and mat.envi_con_type in ("Wall", "Floor", "Roof"):
                     mats = (mat.envi_export_lo_name, mat.envi_export_l1_name, mat.envi_export_l2_name, mat.envi_export_l3_name, mat.envi_export_l4_name)[l]
@@ -112,7 +178,7 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
                     [mat.envi_export_l2_rough, mat.envi_export_l2_tc, mat.envi_export_l2_rho, mat.envi_export_l2_shc, mat.envi_export_l2_tab, mat.envi_export_l2_sab, mat.envi_export_l2_vab],\
                     [mat.envi_export_l3_rough, mat.envi_export_l3_tc, mat.envi_export_l3_rho, mat.envi_export_l3_shc, mat.envi_export_l3_tab, mat.envi_export_l3_sab, mat.envi_export_l3_vab],\
                     [mat.envi_export_l4_rough, mat.envi_export_l4_tc, mat.envi_export_l4_rho, mat.envi_export_l4_shc, mat.envi_export_l4_tab, mat.envi_export_l4_sab, mat.envi_export_l4_vab])[l]
-                    em.omat_write(en_idf, mats+"-"+str(matcount.count(mats.upper())), params, str(thicklist[l]/1000))
+                    em.omat_write(en_idf, mats+"-"+str(matcount.get(mats.upper(), 0)), params, str(thicklist[l]/1000))
 
                 elif layer == "2" and mat.envi_con_type == "Window":
                     mats = (mat.envi_export_lo_name, mat.envi_export_l1_name, mat.envi_export_l2_name, mat.envi_export_l3_name, mat.envi_export_l4_name)[l]
@@ -120,14 +186,14 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
                         params = (["Glazing", mat.envi_export_lo_odt, mat.envi_export_lo_sds, mat.envi_export_lo_thi, mat.envi_export_lo_stn, mat.envi_export_lo_fsn, mat.envi_export_lo_bsn, mat.envi_export_lo_vtn, mat.envi_export_lo_fvrn, mat.envi_export_lo_bvrn, mat.envi_export_lo_itn, mat.envi_export_lo_fie, mat.envi_export_lo_bie, mat.envi_export_lo_tc, (0, mat.envi_export_lo_sdiff)[len(layers) == l + 1]],"",\
                     ["Glazing",  mat.envi_export_l2_odt, mat.envi_export_l2_sds, mat.envi_export_l2_thi, mat.envi_export_l2_stn, mat.envi_export_l2_fsn, mat.envi_export_l2_bsn, mat.envi_export_l2_vtn, mat.envi_export_l2_fvrn, mat.envi_export_l2_bvrn, mat.envi_export_l2_itn, mat.envi_export_l2_fie, mat.envi_export_l2_bie, mat.envi_export_l2_tc, (0, mat.envi_export_l2_sdiff)[len(layers) == l + 1]], "",\
                     ["Glazing",  mat.envi_export_l4_odt, mat.envi_export_l4_sds, mat.envi_export_l4_thi, mat.envi_export_l4_stn, mat.envi_export_l4_fsn, mat.envi_export_l4_bsn, mat.envi_export_l4_vtn, mat.envi_export_l4_fvrn, mat.envi_export_l4_bvrn, mat.envi_export_l4_itn, mat.envi_export_l4_fie, mat.envi_export_l4_bie, mat.envi_export_l4_tc, (0, mat.envi_export_l4_sdiff)[len(layers) == l + 1]])[l]
-                        em.tmat_write(en_idf, '{}-{}'.format(mats, matcount.count(mats.upper())), params, str(thicklist[l]/1000))
+                        em.tmat_write(en_idf, '{}-{}'.format(mats, matcount.get(mats.upper(), 0)), params, str(thicklist[l]/1000))
                     else:
                         params = ("", ("Gas", mat.envi_export_wgaslist_l1), "", ("Gas", mat.envi_export_wgaslist_l3))[l]
-                        em.gmat_write(en_idf, mats+"-"+str(matcount.count(mats.upper())), params, str(thicklist[l]/1000))
+                        em.gmat_write(en_idf, mats+"-"+str(matcount.get(mats.upper(), 0)), params, str(thicklist[l]/1000))
                 
-                conlist.append('{}-{}'.format(mats, matcount.count(mats.upper())))
-                matname.append('{}-{}'.format(mats, matcount.count(mats.upper())))
-                matcount.append(mats.upper())
+                conlist.append('{}-{}'.format(mats, matcount.get(mats.upper(), 0)))
+                matname.append('{}-{}'.format(mats, matcount.get(mats.upper(), 0)))
+                matcount[mats.upper()] = matcount.get(mats.upper(), 0) + 1
 
             params, paramvs = ['Name'],  [mat.name]
             for i, mn in enumerate(conlist):
@@ -138,6 +204,7 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
     em.namedict = {}
     em.thickdict = {}
 
+def enidfzones(en_idf):
     en_idf.write("!-   ===========  ALL OBJECTS IN CLASS: ZONES ===========\n\n")
     for obj in [obj for obj in bpy.context.scene.objects if obj.layers[1] == True and obj.envi_type == '1']:
         if obj.type == 'MESH':
@@ -150,42 +217,46 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
     paramvs = ('UpperRightCorner', 'Counterclockwise', 'World')
     en_idf.write(epentry('GlobalGeometryRules', params, paramvs))
 
+def enidfsurfs(en_idf, enng):
     en_idf.write("!-   ===========  ALL OBJECTS IN CLASS: SURFACE DEFINITIONS ===========\n\n")
 
     wfrparams = ['Name', 'Surface Type', 'Construction Name', 'Zone Name', 'Outside Boundary Condition', 'Outside Boundary Condition Object', 'Sun Exposure', 'Wind Exposure', 'View Factor to Ground', 'Number of Vertices']
+    fparams = ['Name', 'Surface Type', 'Construction Name', 'Building Surface Name', 'Outside Boundary Condition Object', 'View Factor to Ground', 'Shading Control Name', 'Frame and Divider Name', 'Multiplier', 'Number of Vertices']
+    sparams = ['Name', 'Transmittance Schedule Name', 'Number of Vertices']
+    vparams = {}
 
     for obj in [obj for obj in bpy.data.objects if obj.layers[1] and obj.type == 'MESH' and obj.envi_type != '0']:
-        obm, odv = obj.matrix_world, obj.data.vertices
-        obj["floorarea"] = sum([facearea(obj, face) for face in obj.data.polygons if obj.data.materials[face.material_index].envi_con_type =='floor'])
-        for poly in obj.data.polygons:
-            mat = obj.data.materials[poly.material_index]
-            (obc, obco, se, we) = boundpoly(obj, mat, poly, enng)
+        # Vertex strings for every polygon loop, and for the 95% window/door insets about the polygon centres, are formatted in one pass
+        wco, ls, lt, lv, mi, centres, areas = enmesharrays(obj)
+        lco = wco[lv]
+        inset = centres[numpy.repeat(numpy.arange(len(lt)), lt)] + (lco - centres[numpy.repeat(numpy.arange(len(lt)), lt)]) * 0.95
+        vstrs = ["  {:.3f}, {:.3f}, {:.3f}".format(*co) for co in lco.tolist()]
+        istrs = ["  {:.3f}, {:.3f}, {:.3f}".format(*co) for co in inset.tolist()] if any([mat.envi_con_type in ('Door', 'Window') for mat in obj.data.materials]) else []
+        mats = obj.data.materials
+        bounds = [None if mat.envi_boundary else boundpoly(obj, mat, None, enng) for mat in mats]
+        surfs = []
+
+        for pi, (pstart, ptotal, pmi) in enumerate(zip(ls.tolist(), lt.tolist(), mi.tolist())):
+            mat, pname = mats[pmi], '{}_{}'.format(obj.name, pi)
+            if mat.envi_con_type not in ('Wall', 'Floor', 'Roof', 'Door', 'Window', 'Shading'):
+                continue
+            (obc, obco, se, we) = bounds[pmi] or boundpoly(obj, mat, obj.data.polygons[pi], enng)
+            if ptotal not in vparams:
+                vparams[ptotal] = ["X,Y,Z ==> Vertex {} (m)".format(v) for v in range(ptotal)]
 
             if mat.envi_con_type in ('Wall', "Floor", "Roof") and mat.envi_con_makeup != "2":
-                params = list(wfrparams) + ["X,Y,Z ==> Vertex {} (m)".format(v) for v in poly.vertices]
-                paramvs = ['{}_{}'.format(obj.name, poly.index), mat.envi_con_type, mat.name, obj.name, obc, obco, se, we, 'autocalculate', len(poly.vertices)]+ ["  {0[0]:.3f}, {0[1]:.3f}, {0[2]:.3f}".format(obm * odv[v].co) for v in poly.vertices]
-                en_idf.write(epentry('BuildingSurface:Detailed', params, paramvs))
-                if mat.envi_con_type == "Floor":
-                    obj["floorarea"] = obj["floorarea"] + poly.area
-
-            elif  mat.envi_con_type in ('Door', 'Window'):
-                xav, yav, zav = obm*mathutils.Vector(poly.center)
-                params = list(wfrparams) + ["X,Y,Z ==> Vertex {} (m)".format(v) for v in poly.vertices]
-                paramvs = ['{}_{}'.format(obj.name, poly.index), 'Wall', 'Frame', obj.name, obc, obco, se, we, 'autocalculate', len(poly.vertices)] + ["  {0[0]:.3f}, {0[1]:.3f}, {0[2]:.3f}".format(obm * odv[v].co) for v in poly.vertices]
-                en_idf.write(epentry('BuildingSurface:Detailed', params, paramvs))
+                surfs.append(epentry('BuildingSurface:Detailed', wfrparams + vparams[ptotal], [pname, mat.envi_con_type, mat.name, obj.name, obc, obco, se, we, 'autocalculate', ptotal] + vstrs[pstart:pstart + ptotal]))
 
+            elif mat.envi_con_type in ('Door', 'Window'):
+                surfs.append(epentry('BuildingSurface:Detailed', wfrparams + vparams[ptotal], [pname, 'Wall', 'Frame', obj.name, obc, obco, se, we, 'autocalculate', ptotal] + vstrs[pstart:pstart + ptotal]))
                 obound = ('win-', 'door-')[mat.envi_con_type == 'Door']+obco if obco else obco
-                params = ['Name', 'Surface Type', 'Construction Name', 'Building Surface Name', 'Outside Boundary Condition Object', 'View Factor to Ground', 'Shading Control Name', 'Frame and Divider Name', 'Multiplier', 'Number of Vertices'] + \
-                ["X,Y,Z ==> Vertex {} (m)".format(v) for v in poly.vertices]
-                paramvs = [('win-', 'door-')[mat.envi_con_type == 'Door']+'{}_{}'.format(obj.name, poly.index), mat.envi_con_type, mat.name, '{}_{}'.format(obj.name, poly.index), obound, 'autocalculate', '', '', '1', len(poly.vertices)] + \
-                ["  {0[0]:.3f}, {0[1]:.3f}, {0[2]:.3f}".format((xav+((obm * odv[v].co)[0]-xav)*0.95, yav+((obm * odv[v].co)[1]-yav)*0.95, zav+((obm * odv[v].co)[2]-zav)*0.95)) for v in poly.vertices]
-                en_idf.write(epentry('FenestrationSurface:Detailed', params, paramvs))
+                surfs.append(epentry('FenestrationSurface:Detailed', fparams + vparams[ptotal], [('win-', 'door-')[mat.envi_con_type == 'Door']+pname, mat.envi_con_type, mat.name, pname, obound, 'autocalculate', '', '', '1', ptotal] + istrs[pstart:pstart + ptotal]))
 
             elif mat.envi_con_type == 'Shading':
-                params = ['Name', 'Transmittance Schedule Name', 'Number of Vertices'] + ['X,Y,Z ==> Vertex {} (m)'.format(v) for v in range(len(poly.vertices))]
-                paramvs = ['{}_{}'.format(obj.name, poly.index), '', len(poly.vertices)] + ['{0[0]:.3f}, {0[1]:.3f}, {0[2]:.3f}'.format(obm * odv[poly.vertices[v]].co) for v in range(len(poly.vertices))]
-                en_idf.write(epentry('Shading:Building:Detailed', params, paramvs))
+                surfs.append(epentry('Shading:Building:Detailed', sparams + vparams[ptotal], [pname, '', ptotal] + [vstr[2:] for vstr in vstrs[pstart:pstart + ptotal]]))
+        en_idf.write(''.join(surfs))
 
+def enidfscheds(en_idf, enng):
     co2 = 0
     en_idf.write("\n!-   ===========  ALL OBJECTS IN CLASS: SCHEDULES ===========\n\n")
     params = ('Name', 'Lower Limit Value', 'Upper Limit Value', 'Numeric Type', 'Unit Type')
@@ -202,7 +273,6 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
     en_idf.write(epentry('ScheduleTypeLimits', params, paramvs))
 
     hcoiobjs = [hcoiwrite(obj) for obj in bpy.context.scene.objects if obj.layers[1] == True and obj.envi_type == '1']
-    bpy.context.scene['viparams']['hvactemplate'] = 0
     for hcoiobj in hcoiobjs:
         en_idf.write(hcoiobj.hvacschedwrite())
         if hcoiobj.h:
@@ -231,6 +301,9 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
     for snode in [snode for snode in enng.nodes if snode.bl_idname == 'EnViSched' and snode.outputs['Schedule'].is_linked]:
         en_idf.write(snode.epwrite())
 
+def enidfhvac(en_idf):
+    hcoiobjs = [hcoiwrite(obj) for obj in bpy.context.scene.objects if obj.layers[1] == True and obj.envi_type == '1']
+    bpy.context.scene['viparams']['hvactemplate'] = 0
     en_idf.write("\n!-   ===========  ALL OBJECTS IN CLASS: THERMOSTSTATS ===========\n\n")
     for hcoiobj in [hcoiobj for hcoiobj in hcoiobjs if hcoiobj.hc]:
         en_idf.write(hcoiobj.thermowrite())
@@ -266,11 +339,13 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
         if (hcoiobj.obj.envi_occtype == "1" and hcoiobj.obj.envi_occinftype != '0') or (hcoiobj.obj.envi_occtype != "1" and hcoiobj.obj.envi_inftype != '0'):
             en_idf.write(hcoiobj.zi())
 
+def enidfafn(en_idf, exp_op, enng):
     en_idf.write("\n!-   ===========  ALL OBJECTS IN CLASS: AIRFLOW NETWORK ===========\n\n")
     
     if enng['enviparams']['afn']:
         writeafn(exp_op, en_idf, enng)
 
+def enidfoutputs(en_idf, node, enng):
     en_idf.write("!-   ===========  ALL OBJECTS IN CLASS: REPORT VARIABLE ===========\n\n")
     epentrydict = {"Output:Variable,*,Site Outdoor Air Drybulb Temperature,Hourly;\n": node.resat, "Output:Variable,*,Site Wind Speed,Hourly;\n": node.resaws,
                    "Output:Variable,*,Site Wind Direction,Hourly;\n": node.resawd, "Output:Variable,*,Site Outdoor Air Relative Humidity,hourly;\n": node.resah,
@@ -300,35 +375,80 @@ def enpolymatexport(exp_op, node, locnode, em, ec):
                 for sno in snode['sname']:
                     en_idf.write("Output:Variable,{},AFN Surface Venting Window or Door Opening Factor,hourly;\n".format(sno))
 
+    if node.sqlite:
+        en_idf.write(epentry('Output:SQLite', ['Option Type'], ['SimpleAndTabular']))
+
     en_idf.write("Output:Table:SummaryReports,\
     AllSummary;              !- Report 1 Name")
-    en_idf.close()
-    
-    if scene['viparams'].get('hvactemplate'):
-        os.chdir(scene['viparams']['newdir'])
-        ehtempcmd = "ExpandObjects {}".format(os.path.join(scene['viparams']['newdir'], 'in.idf'))
-        subprocess.call(ehtempcmd.split())
-        subprocess.call('{} {} {}'.format(scene['viparams']['cp'], os.path.join(scene['viparams']['newdir'], 'expanded.idf'), os.path.join(scene['viparams']['newdir'], 'in.idf')), shell = True)
 
-    if 'in.idf' not in [im.name for im in bpy.data.texts]:
-        bpy.data.texts.load(scene['viparams']['idf_file'])
+# Object schedule properties read by the zone exports, besides the envi_ ones
+schedprops = re.compile(r'((a|w|av|c)?occ|htsp|ctsp|equip|hvac|inf)[ftu]\d$')
+
+def idvals(ids):
+    # Name and the add-on's own property values of a material, object or node, for hashing. Built in node properties
+    # (selection, location, size) and object display state are not read by the export, and ID properties only hold
+    # values derived while exporting, such as floorarea and volume, so neither is hashed
+    if isinstance(ids, bpy.types.Node):
+        base = [prop.identifier for prop in bpy.types.Node.bl_rna.properties]
+        props = [prop for prop in ids.bl_rna.properties if prop.identifier not in base]
+    else:
+        props = [prop for prop in ids.bl_rna.properties if prop.identifier.startswith('envi_') or schedprops.match(prop.identifier)]
+    vals = [('name', ids.name)]
+    for prop in [prop for prop in props if prop.type in ('BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM')]:
+        val = getattr(ids, prop.identifier)
+        vals.append((prop.identifier, tuple(sorted(val)) if isinstance(val, set) else tuple(val) if hasattr(val, '__len__') and not isinstance(val, str) else val))
+    return vals
+
+def enmesharrays(obj):
+    # World space vertex coordinates, polygon loop starts, loop totals, loop vertex indices, material indices, centres and areas
+    me = obj.data
+    co, lv = numpy.zeros(len(me.vertices) * 3), numpy.zeros(len(me.loops), dtype = numpy.int32)
+    ls, lt, mi = [numpy.zeros(len(me.polygons), dtype = numpy.int32) for i in range(3)]
+    me.vertices.foreach_get('co', co)
+    me.polygons.foreach_get('loop_start', ls)
+    me.polygons.foreach_get('loop_total', lt)
+    me.loops.foreach_get('vertex_index', lv)
+    me.polygons.foreach_get('material_index', mi)
+    omw = numpy.array(obj.matrix_world)
+    wco = co.reshape(-1, 3).dot(omw[:3, :3].T) + omw[:3, 3]
+    if not len(lt):
+        return wco, ls, lt, lv, mi, numpy.zeros((0, 3)), numpy.zeros(0)
+    lco = wco[lv]
+    nxt = numpy.arange(1, len(lv) + 1)
+    nxt[ls + lt - 1] = ls
+    centres = numpy.add.reduceat(lco, ls)/lt[:, None]
+    areas = 0.5 * numpy.linalg.norm(numpy.add.reduceat(numpy.cross(lco, lco[nxt]), ls), axis = 1)
+    return wco, ls, lt, lv, mi, centres, areas
+
+def geohash(objs):
+    md5 = hashlib.md5()
+    for obj in objs:
+        me = obj.data
+        co, vi, lt, mi = numpy.zeros(len(me.vertices) * 3), numpy.zeros(len(me.loops), dtype = numpy.int32), numpy.zeros(len(me.polygons), dtype = numpy.int32), numpy.zeros(len(me.polygons), dtype = numpy.int32)
+        me.vertices.foreach_get('co', co)
+        me.loops.foreach_get('vertex_index', vi)
+        me.polygons.foreach_get('loop_total', lt)
+        me.polygons.foreach_get('material_index', mi)
+        md5.update(repr((obj.name, [tuple(row) for row in obj.matrix_world], [mat.name for mat in me.materials])).encode())
+        for arr in (co, vi, lt, mi):
+            md5.update(arr.tobytes())
+    return md5.hexdigest()
 
 def pregeo(op):
+    # The en_ copies of the EnVi objects are built with the data API, without operators, edit mode or scans of all of bpy.data
     scene = bpy.context.scene
     bpy.data.scenes[0].layers[0:2] = True, False
-    for obj in [obj for obj in scene.objects if obj.layers[1] == True]:
+    oldobjs = [obj for obj in scene.objects if obj.layers[1] == True]
+    oldmeshes, oldmats = [obj.data for obj in oldobjs if obj.type == 'MESH'], set([mat for obj in oldobjs if obj.type == 'MESH' for mat in obj.data.materials if mat])
+    for obj in oldobjs:
         scene.objects.unlink(obj)
         bpy.data.objects.remove(obj)
-    for mesh in bpy.data.meshes:
-        if mesh.users == 0:
-            bpy.data.meshes.remove(mesh)
-    for materials in bpy.data.materials:
-        if materials.users == 0:
-            bpy.data.materials.remove(materials)
+    for mesh in [mesh for mesh in oldmeshes if mesh.users == 0]:
+        bpy.data.meshes.remove(mesh)
+    for mat in [mat for mat in oldmats if mat.users == 0]:
+        bpy.data.materials.remove(mat)
     
     enviobjs = [obj for obj in scene.objects if obj.envi_type in ('1', '2') and obj.layers[0] == True and obj.hide == False]
-#    envings = [ng for ng in bpy.data.node_groups if ng.bl_label == 'EnVi Network']
-#    enng = envings[0] if envings else 0
     if not [ng for ng in bpy.data.node_groups if ng.bl_label == 'EnVi Network']:
         bpy.ops.node.new_node_tree(type='EnViN', name ="EnVi Network") 
         for screen in bpy.data.screens:
@@ -336,37 +456,45 @@ def pregeo(op):
                 area.spaces[0].node_tree = bpy.data.node_groups[op.nodeid.split('@')[1]]
     enng = [ng for ng in bpy.data.node_groups if ng.bl_label == 'EnVi Network'][0]
     enng['enviparams'] = {'wpca': 0, 'wpcn': 0, 'crref': 0, 'afn': 0}
+    dcdict = {'Wall':(1,1,1), 'Partition':(0.5,0.5,0.5), 'Window':(0,1,1), 'Roof':(0,1,0), 'Ceiling':(0, 0.5, 0), 'Floor':(0.44,0.185,0.07), 'Ground':(0.22, 0.09, 0.04), 'Shading':(1, 0, 0), 'Aperture':(0, 0, 1)}
+    en_objs = []
           
     for obj in enviobjs:
         for mats in obj.data.materials:
-            if 'en_'+mats.name not in [mat.name for mat in bpy.data.materials]:
+            if not bpy.data.materials.get('en_'+mats.name):
                 mats.copy().name = 'en_'+mats.name
 
-        selobj(scene, obj)
-        selmesh('desel')
-        bpy.ops.object.duplicate()
+        en_mesh = obj.data.copy()
+        en_mesh.name = 'en_'+obj.data.name
+        bm = bmesh.new()
+        bm.from_mesh(en_mesh)
+        nonefaces = [f for f in bm.faces if obj.data.materials[f.material_index].envi_con_type == 'None']
+        if nonefaces:
+            bmesh.ops.delete(bm, geom = nonefaces, context = 5)
+        bmesh.ops.remove_doubles(bm, verts = bm.verts, dist = 0.0001)
+        bm.to_mesh(en_mesh)
+        bm.free()
 
-        en_obj = scene.objects.active
-        obj.select, en_obj.select, en_obj.name, en_obj.data.name, en_obj.layers[1], en_obj.layers[0], bpy.data.scenes[0].layers[0:2] = False, True, 'en_'+obj.name, en_obj.data.name, True, False, (False, True)
+        en_obj = obj.copy()
+        en_obj.data, en_obj.name = en_mesh, 'en_'+obj.name
+        en_obj.layers[1], en_obj.layers[0] = True, False
         for s, slots in enumerate(en_obj.material_slots):
             slots.material = bpy.data.materials['en_'+obj.data.materials[s].name]
             slots.material.envi_export = True
-            dcdict = {'Wall':(1,1,1), 'Partition':(0.5,0.5,0.5), 'Window':(0,1,1), 'Roof':(0,1,0), 'Ceiling':(0, 0.5, 0), 'Floor':(0.44,0.185,0.07), 'Ground':(0.22, 0.09, 0.04), 'Shading':(1, 0, 0), 'Aperture':(0, 0, 1)}
             if slots.material.envi_con_type in dcdict:
                 slots.material.diffuse_color = dcdict[slots.material.envi_con_type]
 
-        for poly in en_obj.data.polygons:
-            if en_obj.data.materials[poly.material_index].envi_con_type == 'None':
-                poly.select = True
+        # Volume from the signed volumes of the world space polygon fans
+        wco, ls, lt, lv = enmesharrays(en_obj)[:4]
+        lco, li, first = wco[lv], numpy.arange(len(lv)), numpy.repeat(ls, lt)
+        fan = (li > first) & (li < numpy.repeat(ls + lt - 1, lt))
+        en_obj["volume"] = float(abs(numpy.einsum('ij,ij->i', lco[first[fan]], numpy.cross(lco[li[fan]], lco[li[fan] + 1])).sum())/6)
+        en_objs.append(en_obj)
 
-        selmesh('delf')
-        en_obj.select = False
-        bm = bmesh.new()
-        bm.from_mesh(en_obj.data)
-        bm.transform(en_obj.matrix_world)
-        en_obj["volume"] = bm.calc_volume()
-        bm.free()
+    for en_obj in en_objs:
+        scene.objects.link(en_obj)
 
+    for en_obj in en_objs:
         if any([(mat.envi_afsurface or mat.envi_boundary) for mat in en_obj.data.materials]):
             enng['enviparams']['afn'] = 1
             if 'Control' not in [node.bl_label for node in enng.nodes]:
@@ -382,10 +510,7 @@ def pregeo(op):
             for node in enng.nodes:
                 if hasattr(node, 'zone') and node.zone == en_obj.name:
                     enng.nodes.remove(node)            
-            
-        bpy.data.scenes[0].layers[0:2] = True, False
-        obj.select = True
-        scene.objects.active = obj
+    bpy.data.scenes[0].layers[0:2] = True, False
 
 class hcoiwrite(object):
     def __init__(self, obj):
@@ -641,3 +766,87 @@ def writeafn(exp_op, en_idf, enng):
     for enode in ssafnodes + safnodes:
         en_idf.write(enode.epwrite(exp_op, enng))
 
+
+class idfmodel(object):
+    # In-memory IDF. Text written to it is parsed into objects on close, materials, constructions and compact schedules that
+    # only differ from an earlier object of the same class by name are dropped, references to them are renamed to the
+    # earlier object, and the file is written in one go
+    matclasses = ('MATERIAL', 'MATERIAL:AIRGAP', 'MATERIAL:NOMASS', 'WINDOWMATERIAL:GLAZING', 'WINDOWMATERIAL:GAS')
+    dedup = matclasses + ('CONSTRUCTION', 'SCHEDULE:COMPACT')
+    # Fields that can name an object of a deduplicated class, as class: (target classes, field indices), with the class
+    # name as field 0. Only these are renamed, so a zone or node that happens to share a dropped object's name is left alone
+    scheds = ('SCHEDULE:COMPACT',)
+    refs = {'CONSTRUCTION': (matclasses, range(2, 12)), 'BUILDINGSURFACE:DETAILED': (('CONSTRUCTION',), (3,)), 'FENESTRATIONSURFACE:DETAILED': (('CONSTRUCTION',), (3,)),
+            'SHADING:BUILDING:DETAILED': (scheds, (2,)), 'THERMOSTATSETPOINT:SINGLEHEATING': (scheds, (2,)), 'THERMOSTATSETPOINT:SINGLECOOLING': (scheds, (2,)),
+            'THERMOSTATSETPOINT:SINGLEHEATINGORCOOLING': (scheds, (2,)), 'THERMOSTATSETPOINT:DUALSETPOINT': (scheds, (2, 3)), 'ZONECONTROL:THERMOSTAT': (scheds, (3,)),
+            'ZONEHVAC:IDEALLOADSAIRSYSTEM': (scheds, (2, 15, 16)), 'HVACTEMPLATE:ZONE:IDEALLOADSAIRSYSTEM': (scheds, (3, 14, 15)), 'PEOPLE': (scheds, (3, 10, 15, 17, 18, 19)),
+            'ZONEAIRCONTAMINANTBALANCE': (scheds, (2, 4)), 'ZONEINFILTRATION:DESIGNFLOWRATE': (scheds, (3,)), 'OTHEREQUIPMENT': (scheds, (3,)),
+            'AIRFLOWNETWORK:MULTIZONE:ZONE': (scheds, (3, 9)), 'AIRFLOWNETWORK:MULTIZONE:SURFACE': (scheds, (6, 12)), 'FAN:ZONEEXHAUST': (scheds, (2,))}
+
+    def __init__(self, idffile):
+        self.idffile, self.text, self.dropped = idffile, [], 0
+
+    def write(self, text):
+        self.text.append(text)
+
+    def parse(self):
+        # Entries are lines outside any object (comments and blank lines) or [fields, comments, raw text] objects.
+        # Raw text is None for objects that share a line with another and so have to be rendered
+        entries, fields, comments, raw, cur, shared = [], [], [], [], '', 0
+        for line in ''.join(self.text).split('\n'):
+            code, comment = line.split('!', 1) if '!' in line else (line, '')
+            if not fields and not cur.strip() and not code.strip():
+                entries.append(line)
+                continue
+            raw.append(line)
+            pos, nfields = 0, len(fields)
+            for delim in re.finditer('[,;]', code):
+                fields.append((cur + code[pos:delim.start()]).strip())
+                comments.append('')
+                cur, pos = '', delim.end()
+                if delim.group() == ';':
+                    if comment and not code[pos:].strip():
+                        comments[-1] = comment
+                    entries.append([fields, comments, (None, '\n'.join(raw))[not shared and not code[pos:].strip()]])
+                    fields, comments, raw, nfields, shared = [], [], [], 0, code[pos:].strip() != ''
+            cur += code[pos:]
+            if comment and len(fields) > nfields:
+                comments[-1] = comment
+            elif not fields and not cur.strip():
+                shared = 0
+        return entries
+
+    def rename(self, fields, names):
+        # names maps (class, upper case name) of a dropped object to the name of the object kept in its place
+        targets, findices = self.refs.get(fields[0].upper(), ((), ()))
+        return [([names[(tc, f.upper())] for tc in targets if (tc, f.upper()) in names] + [f])[0] if fi in findices else f for fi, f in enumerate(fields)]
+
+    def close(self):
+        entries, names, keys = self.parse(), {}, {}
+        for entry in [entry for entry in entries if isinstance(entry, list) and entry[0][0].upper() in self.dedup and len(entry[0]) > 2]:
+            fields = self.rename(entry[0], names)
+            key = (fields[0].upper(), tuple(fields[2:]))
+            if key in keys:
+                names[(fields[0].upper(), fields[1].upper())], entry[2] = keys[key], 'drop'
+            else:
+                keys[key] = fields[1]
+
+        idftext, dropped = [], 0
+        for entry in entries:
+            if not isinstance(entry, list):
+                if not (dropped and not entry.strip()):
+                    idftext.append(entry + '\n')
+                    dropped = 0
+            elif entry[2] != 'drop':
+                dropped = 0
+                fields = entry[0]
+                rfields = self.rename(fields, names)
+                if rfields != fields or entry[2] is None:
+                    idftext.append('{},\n'.format(rfields[0]) + '\n'.join(['    {:{width}}!{}'.format(f + (',', ';')[fi == len(rfields) - 2], entry[1][fi + 1], width = 80) if entry[1][fi + 1] else '    {}'.format(f + (',', ';')[fi == len(rfields) - 2]) for fi, f in enumerate(rfields[1:])]) + '\n')
+                else:
+                    idftext.append(entry[2] + '\n')
+            else:
+                self.dropped, dropped = self.dropped + 1, 1
+
+        with open(self.idffile, 'w') as idffile:
+            idffile.write(''.join(idftext))
@@ -16,7 +16,7 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
-import bpy, os, subprocess, datetime, bmesh
+import bpy, os, subprocess, datetime, bmesh, signal
 from subprocess import PIPE, Popen, STDOUT
 from .vi_func import mtx2vals, retobjs, selobj, facearea
 from . import livi_export
@@ -35,23 +35,51 @@ def li_calc(calc_op, simnode, connode, geonode, simacc, **kwargs):
         calc_op.report({'ERROR'},"There are no materials with the livi sensor option enabled")
     else:
         (res, svres) = (numpy.zeros([len(frames), geonode['reslen']]), numpy.zeros([len(frames), geonode['reslen']]))
+        simnode['refined'] = {}
         for frame in frames:            
             findex = frame - scene.fs if not kwargs.get('genframe') else 0
-            if connode.bl_label in ('LiVi Basic', 'LiVi Compliance') or (connode.bl_label == 'LiVi CBDM' and int(connode.analysismenu) < 2):
+            if connode.bl_label == 'LiVi Basic' and simacc == '4':
+                adres = li_adaptive(calc_op, scene, simnode, connode, frame)
+                if not adres:
+                    return
+                res[findex], refined = adres
+                simnode['refined'][str(frame)] = refined
+                calc_op.report({'INFO'}, "Frame {}: {} sensors refined at medium accuracy, {} at high accuracy".format(frame, *refined))
+                with open(os.path.join(scene['viparams']['newdir'], connode['resname']+"-{}.res".format(frame)), 'w') as resfile:
+                    resfile.write(''.join(['{}\n'.format(r) for r in res[findex]]))
+
+            elif connode.bl_label in ('LiVi Basic', 'LiVi Compliance') or (connode.bl_label == 'LiVi CBDM' and int(connode.analysismenu) < 2):
                 if os.path.isfile("{}-{}.af".format(scene['viparams']['filebase'], frame)):
                     subprocess.call("{} {}-{}.af".format(scene['viparams']['rm'], scene['viparams']['filebase'], frame), shell=True)
-                rtcmd = "rtrace -n {0} -w {1} -faa -h -ov -I {2}-{3}.oct  < {2}.rtrace {4}".format(scene['viparams']['nproc'], simnode['radparams'], scene['viparams']['filebase'], frame, connode['simalg']) #+" | tee "+lexport.newdir+lexport.fold+self.simlistn[int(lexport.metric)]+"-"+str(frame)+".res"
+                ohash = scene['liparams'].get('octhashes', {}).get(str(frame), '')
+                if kwargs.get('genframe') and simnode.persist and ohash:
+                    # A persistent rtrace keeps the octree and options it was started with, so it is restarted when either changes
+                    if list(scene['liparams'].get('rtpersist', [])) != [ohash, simnode['radparams']]:
+                        rtpersistend(scene, calc_op)
+                        scene['liparams']['rtpersist'] = [ohash, simnode['radparams']]
+                    rtcmd = "rtrace -w {0} -faa -h -ov -I -PP {1}.pf {1}-{2}.oct  < {1}.rtrace {3}".format(simnode['radparams'], scene['viparams']['filebase'], octframe(scene, frame), connode['simalg'])
+                else:
+                    rtcmd = "rtrace -n {0} -w {1} -faa -h -ov -I {2}-{3}.oct  < {2}.rtrace {4}".format(scene['viparams']['nproc'], simnode['radparams'], scene['viparams']['filebase'], frame, connode['simalg']) #+" | tee "+lexport.newdir+lexport.fold+self.simlistn[int(lexport.metric)]+"-"+str(frame)+".res"
                 rtrun = Popen(rtcmd, shell = True, stdout=PIPE, stderr=STDOUT)                
+                # The exit status is rcalc's when the results are piped through it, so a failed or short trace shows as a wrong row count
+                rtlines = [line.decode() for line in rtrun.stdout]
+                if len(rtlines) != geonode['reslen']:
+                    calc_op.report({'ERROR'}, "rtrace returned {} results for {} sensors in frame {}. Check the Radiance parameters and the octree".format(len(rtlines), geonode['reslen'], frame))
+                    return
                 with open(os.path.join(scene['viparams']['newdir'], connode['resname']+"-{}.res".format(frame)), 'w') as resfile:
-                    for l, line in enumerate([line.decode() for line in rtrun.stdout]):
+                    for l, line in enumerate(rtlines):
                         res[findex][l] = eval(line)                
                         resfile.write(line)
                 
             if connode.bl_label == 'LiVi Compliance' and connode.analysismenu in ('0', '1'):
                 svcmd = "rtrace -n {0} -w {1} -h -ov -I -af {2}-{3}.af {2}-{3}.oct  < {2}.rtrace {4}".format(scene['viparams']['nproc'], '-ab 1 -ad 8192 -aa 0 -ar 512 -as 1024 -lw 0.0002', scene['viparams']['filebase'], frame, connode['simalg']) #+" | tee "+lexport.newdir+lexport.fold+self.simlistn[int(lexport.metric)]+"-"+str(frame)+".res"
                 svrun = Popen(svcmd, shell = True, stdout=PIPE, stderr=STDOUT)                  
+                svlines = [line.decode() for line in svrun.stdout]
+                if len(svlines) != geonode['reslen']:
+                    calc_op.report({'ERROR'}, "The sky view rtrace returned {} results for {} sensors in frame {}".format(len(svlines), geonode['reslen'], frame))
+                    return
                 with open(os.path.join(scene['viparams']['newdir'],'skyview'+"-"+str(frame)+".res"), 'w') as svresfile:
-                    for sv,line in enumerate([line.decode() for line in svrun.stdout]):
+                    for sv,line in enumerate(svlines):
                         svres[findex][sv] = eval(line)
                         svresfile.write(line)
 
@@ -95,6 +123,67 @@ def li_calc(calc_op, simnode, connode, geonode, simacc, **kwargs):
         print(res)
         return(res[0])
    
+def octframe(scene, frame):
+    # The earliest frame with an identical octree, so the persistent rtrace command line stays the same while it is attached
+    octhashes = scene['liparams'].get('octhashes', {})
+    return min([int(f) for f in octhashes if octhashes[f] == octhashes[str(frame)]]) if str(frame) in octhashes else frame
+
+def rtpersistend(scene, calc_op):
+    # The persist file starts with an "rtrace <pid>" line
+    pfile = "{}.pf".format(scene['viparams']['filebase'])
+    if scene.get('liparams') and 'rtpersist' in scene['liparams']:
+        del scene['liparams']['rtpersist']
+    if os.path.isfile(pfile):
+        with open(pfile, 'r') as pf:
+            try:
+                os.kill(int(pf.readline().split()[1]), signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            except (ValueError, IndexError):
+                calc_op.report({'WARNING'}, "The persistent rtrace process could not be identified and may still be running")
+        os.remove(pfile)
+
+def rtsub(scene, connode, frame, rtpoints, radparams):
+    # None if the trace fails or does not return one result per sensor point
+    rtrun = Popen("rtrace -n {0} -w {1} -faa -h -ov -I {2}-{3}.oct {4}".format(scene['viparams']['nproc'], radparams, scene['viparams']['filebase'], frame, connode['simalg']), shell = True, stdin = PIPE, stdout = PIPE, stderr = PIPE)
+    out = rtrun.communicate(input = ''.join(rtpoints).encode('utf-8'))[0].split()
+    if rtrun.returncode or len(out) != len(rtpoints):
+        return
+    try:
+        return numpy.array(out, dtype = float)
+    except ValueError:
+        return
+
+def li_adaptive(calc_op, scene, simnode, connode, frame):
+    # Two low accuracy passes with different ambient sampling give a per sensor uncertainty estimate.
+    # Sensors over tolerance are re-traced at medium, and those whose result then shifts by more than the tolerance at high, accuracy.
+    with open("{}.rtrace".format(scene['viparams']['filebase']), 'r') as rtfile:
+        rtpoints = numpy.array(rtfile.readlines())
+    # The second pass keeps the Low preset's sample counts but offsets them so its stratified hemisphere samples differ.
+    # Later options override earlier ones in rtrace, so the offsets are appended to the Low parameters.
+    adoffset, asoffset = 1, 3
+    lowad, lowas = [[n[1] for n in simnode.rtracebasic if n[0] == opt][0] for opt in ('-ad', '-as')]
+    tol, lowparams = simnode.adaptol * 0.01, simnode['adaptparams'][0]
+    jitparams = lowparams + '-ad {} -as {} '.format(lowad + adoffset, lowas + asoffset)
+    res1, res2 = rtsub(scene, connode, frame, rtpoints, lowparams), rtsub(scene, connode, frame, rtpoints, jitparams)
+    if res1 is None or res2 is None:
+        calc_op.report({'ERROR'}, "An adaptive low accuracy rtrace pass failed for frame {}".format(frame))
+        return
+    res, refined, rindex = (res1 + res2) * 0.5, [0, 0], numpy.arange(len(rtpoints))
+    unc = numpy.abs(res1 - res2)/numpy.maximum(numpy.abs(res), 1e-6)
+    for acc in (1, 2):
+        rindex = rindex[unc > tol]
+        refined[acc - 1] = len(rindex)
+        if not len(rindex):
+            break
+        rres = rtsub(scene, connode, frame, rtpoints[rindex], simnode['adaptparams'][acc])
+        if rres is None:
+            calc_op.report({'ERROR'}, "The adaptive {} accuracy rtrace pass failed for frame {}".format(('medium', 'high')[acc - 1], frame))
+            return
+        unc = numpy.abs(rres - res[rindex])/numpy.maximum(numpy.abs(rres), 1e-6)
+        res[rindex] = rres
+    return res, refined
+
 def resapply(calc_op, res, svres, simnode, connode, geonode, frames):
     scene = bpy.context.scene  
     simnode['maxres'], simnode['minres'] = {}, {}
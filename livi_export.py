@@ -16,10 +16,10 @@
 #
 # ##### END GPL LICENSE BLOCK #####
 
-import bpy, os, math, subprocess, datetime, bmesh
+import bpy, os, math, subprocess, datetime, bmesh, hashlib, re
 from math import sin, cos, tan, pi
 from subprocess import PIPE, Popen, STDOUT
-from .vi_func import retsky, retobj, retmesh, clearscene, solarPosition, mtx2vals, retobjs, selobj, selmesh, vertarea, radpoints, clearanim
+from .vi_func import retsky, retobj, retmesh, clearscene, solarPosition, solarpositions, frameresmatis, mtx2vals, retobjs, selobj, selmesh, vertarea, radpoints, clearanim
 
 def radgexport(export_op, node, **kwargs):
     scene = bpy.context.scene  
@@ -182,14 +182,14 @@ def radgexport(export_op, node, **kwargs):
                 if frame in range(node['frames']['Lights'] + 1):
                     iesname = os.path.splitext(os.path.basename(o.ies_name))[0]
                     if os.path.isfile(o.ies_name):
-                        subprocess.call("ies2rad -t default -m {0} -c {1[0]:.3f} {1[1]:.3f} {1[2]:.3f} -p {2} -d{3} -o {4}-{5} {6}".format(o.ies_strength, o.ies_colour, scene['viparams']['newdir'], o.ies_unit, iesname, frame, o.ies_name), shell=True)
+                        iesrad = iesexport(scene, o)
                         if o.type == 'LAMP':
                             if o.parent:
                                 o = o.parent
-                            lradfile += "!xform -rx {0[0]} -ry {0[1]} -rz {0[2]} -t {1[0]} {1[1]} {1[2]} {2}.rad\n\n".format([(180/pi)*o.rotation_euler[i] for i in range(3)], o.location, os.path.join(scene['viparams']['newdir'], iesname+"-{}".format(frame)))
+                            lradfile += "!xform -rx {0[0]} -ry {0[1]} -rz {0[2]} -t {1[0]} {1[1]} {1[2]} {2}\n\n".format([(180/pi)*o.rotation_euler[i] for i in range(3)], o.location, iesrad)
                         elif o.type == 'MESH':
                             for face in o.data.polygons:
-                                lradfile += "!xform -rx {0[0]:.3f} -ry {0[1]:.3f} -rz {0[2]:.3f} -t {1[0]:.3f} {1[1]:.3f} {1[2]:.3f} {2}{3}".format([(180/pi)*o.rotation_euler[i] for i in range(3)], o.matrix_world * face.center, os.path.join(scene['viparams']['newdir'], iesname+"-{}.rad".format(frame)), ('\n', '\n\n')[face == o.data.polygons[-1]])
+                                lradfile += "!xform -rx {0[0]:.3f} -ry {0[1]:.3f} -rz {0[2]:.3f} -t {1[0]:.3f} {1[1]:.3f} {1[2]:.3f} {2}{3}".format([(180/pi)*o.rotation_euler[i] for i in range(3)], o.matrix_world * face.center, iesrad, ('\n', '\n\n')[face == o.data.polygons[-1]])
                     elif iesname:
                         export_op.report({'ERROR'}, 'The IES file associated with {} cannot be found'.format(o.name))
             
@@ -207,9 +207,23 @@ def radgexport(export_op, node, **kwargs):
 
     for frame in range(scene.fs, scene.fe + 1):
         createradfile(scene, frame, export_op, connode, node)
-        if kwargs:
-            createoconv(scene, frame, export_op)
+    if kwargs:
+        createoconvs(scene, range(scene.fs, scene.fe + 1), export_op)
             
+iesfilehashes = {}
+
+def iesexport(scene, o):
+    # One ies2rad conversion per IES file content and parameter set, shared by all luminaires and frames that use it
+    iesstat = os.stat(o.ies_name)
+    if iesfilehashes.get(o.ies_name, (0, 0, ''))[:2] != (iesstat.st_mtime, iesstat.st_size):
+        with open(o.ies_name, 'rb') as iesfile:
+            iesfilehashes[o.ies_name] = (iesstat.st_mtime, iesstat.st_size, hashlib.md5(iesfile.read()).hexdigest())
+    iesparams = "-t default -m {0} -c {1[0]:.3f} {1[1]:.3f} {1[2]:.3f} -p {2} -d{3}".format(o.ies_strength, o.ies_colour, scene['viparams']['newdir'], o.ies_unit)
+    iesbase = '{}-{}'.format(os.path.splitext(os.path.basename(o.ies_name))[0], hashlib.md5((iesfilehashes[o.ies_name][2] + iesparams).encode('utf-8')).hexdigest()[:12])
+    if not all([os.path.isfile(os.path.join(scene['viparams']['newdir'], iesbase + ext)) for ext in ('.rad', '.dat')]):
+        subprocess.call("ies2rad {} -o {} {}".format(iesparams, iesbase, o.ies_name), shell = True, cwd = scene['viparams']['newdir'])
+    return os.path.join(scene['viparams']['newdir'], iesbase + '.rad')
+
 def radcexport(export_op, node, locnode, geonode):
     skyfileslist, scene, scene.li_disp_panel, scene.vi_display = [], bpy.context.scene, 0, 0
     clearscene(scene, export_op)
@@ -368,55 +382,127 @@ def createradfile(scene, frame, export_op, connode, geonode):
     bpy.data.texts['Radiance input-{}'.format(frame)].clear()
     bpy.data.texts['Radiance input-{}'.format(frame)].write(radtext)    
 
+def octhash(scene, frame):
+    # Octree key: the frame's Radiance input plus the state of any mesh, instance or picture files it pulls in
+    with open("{}-{}.rad".format(scene['viparams']['filebase'], frame), 'rb') as radfile:
+        radbytes = radfile.read()
+    ohash = hashlib.md5(radbytes)
+    for rfile in sorted(set(re.findall(r'\S+\.(?:mesh|rtm|rad|dat|hdr|pic|cal)\b', radbytes.decode('utf-8', 'ignore')))):
+        if os.path.isfile(rfile):
+            ohash.update('{}{}{}'.format(rfile, os.path.getmtime(rfile), os.path.getsize(rfile)).encode('utf-8'))
+    return ohash.hexdigest()
+
+def createoconvs(scene, frames, export_op):
+    octhashes, octstats, oconvruns = dict(scene['liparams'].get('octhashes', {})), {'built': 0, 'reused': 0}, []
+    def octwait(oconvrun):
+        # A failed octree must not be marked as current, so it is rebuilt on the next export
+        if oconvrun[1].wait():
+            del octhashes[str(oconvrun[0])]
+            octstats['built'] -= 1
+            export_op.report({'ERROR'}, "Octree creation failed for frame {}. Check the Radiance input file".format(oconvrun[0]))
+    for frame in frames:
+        ohash = octhash(scene, frame)
+        if octhashes.get(str(frame)) == ohash and os.path.isfile("{}-{}.oct".format(scene['viparams']['filebase'], frame)):
+            octstats['reused'] += 1
+            continue
+        if len(oconvruns) >= int(scene['viparams']['nproc']):
+            octwait(oconvruns.pop(0))
+        oconvruns.append((frame, Popen("oconv {0}-{1}.rad > {0}-{1}.oct".format(scene['viparams']['filebase'], frame), shell = True)))
+        octhashes[str(frame)] = ohash
+        octstats['built'] += 1
+    for oconvrun in oconvruns:
+        octwait(oconvrun)
+    scene['liparams']['octhashes'], scene['liparams']['octstats'] = octhashes, octstats
+    export_op.report({'INFO'},"Export is finished ({} octrees built, {} reused)".format(octstats['built'], octstats['reused']))
+
 def createoconv(scene, frame, export_op, **kwargs):
-    oconvcmd = "oconv {0}-{1}.rad > {0}-{1}.oct".format(scene['viparams']['filebase'], frame)
-    subprocess.call(oconvcmd, shell = True)
-    export_op.report({'INFO'},"Export is finished")
+    createoconvs(scene, [frame], export_op)
+
+# Frame change state, rebuilt when results are loaded or when a cached name no longer resolves
+cyfccache = {}
+
+def cyfcprep(scene):
+    cyfccache.clear()
+    cyfccache['resnode'] = scene.resnode
+    cyfccache['res'] = [ob.name for ob in scene.objects if ob.get('lires')]
+    cyfccache['mats'] = [m.name for m in bpy.data.materials if m.use_nodes and m.mattype in ('1', '2') and m.node_tree and m.node_tree.nodes.get('Attribute')]
+    cyfccache['obs'] = {ob.get('VIType'): ob.name for ob in scene.objects if ob.get('VIType') in ('Sun', 'SPathMesh', 'SkyMesh', 'SunMesh')}
+    cyfccache['solsig'], cyfccache['sol'] = solsig(scene), soltable(scene)
+
+def solsig(scene):
+    # Keyframes of the animated solar day and hour, so the solar table is rebuilt if they are edited
+    action = scene.animation_data.action if scene.animation_data else None
+    return [(fc.data_path, [kp.co[:] for kp in fc.keyframe_points]) for fc in action.fcurves if fc.data_path in ('solday', 'solhour')] if action else []
+
+def soltable(scene):
+    # Solar altitude and azimuth for every frame, from the solar day and hour curves or the static values
+    action = scene.animation_data.action if scene.animation_data else None
+    fcs = {fc.data_path: fc for fc in action.fcurves if fc.data_path in ('solday', 'solhour')} if action else {}
+    if not fcs:
+        return {}
+    frames = range(scene.frame_start, scene.frame_end + 1)
+    days = [int(round(fcs['solday'].evaluate(f))) if fcs.get('solday') else scene.solday for f in frames]
+    hours = [fcs['solhour'].evaluate(f) if fcs.get('solhour') else scene.solhour for f in frames]
+    betas, phis = solarpositions(days, hours, scene['latitude'], scene['longitude'])
+    return {f: (float(betas[fi]), float(phis[fi])) for fi, f in enumerate(frames)}
 
 def cyfc1(self):
     scene = bpy.context.scene
+    if cyfccache.get('resnode') != scene.resnode:
+        cyfcprep(scene)
+
     if 'LiVi' in scene.resnode or 'Shadow' in scene.resnode:
-        for material in [m for m in bpy.data.materials if m.use_nodes and m.mattype in ('1', '2')]:
+        for mname in cyfccache['mats']:
             try:
-                if any([node.bl_label == 'Attribute' for node in material.node_tree.nodes]):
-                    material.node_tree.nodes["Attribute"].attribute_name = str(scene.frame_current)
+                bpy.data.materials[mname].node_tree.nodes["Attribute"].attribute_name = str(scene.frame_current)
             except Exception as e:
                 print(e, 'Something wrong with changing the material attribute name')
+                cyfccache.clear()
+        for obname in cyfccache.get('res', []):
+            if scene.objects.get(obname):
+                frameresmatis(scene.objects[obname], scene.frame_current)
 
     if scene.resnode == 'VI Sun Path':
-        spoblist = {ob.get('VIType'):ob for ob in scene.objects if ob.get('VIType') in ('Sun', 'SPathMesh')}
-        beta, phi = solarPosition(scene.solday, scene.solhour, scene['latitude'], scene['longitude'])[2:]
+        if solsig(scene) != cyfccache['solsig']:
+            cyfccache['solsig'], cyfccache['sol'] = solsig(scene), soltable(scene)
+        beta, phi = cyfccache['sol'][scene.frame_current] if scene.frame_current in cyfccache['sol'] else solarPosition(scene.solday, scene.solhour, scene['latitude'], scene['longitude'])[2:]
+        spoblist = {vitype: scene.objects.get(obname) for vitype, obname in cyfccache['obs'].items()}
+        if not all(spoblist.values()):
+            cyfcprep(scene)
+            spoblist = {vitype: scene.objects.get(obname) for vitype, obname in cyfccache['obs'].items()}
+
         if bpy.data.worlds.get('World'):
             if bpy.data.worlds["World"].use_nodes == False:
                 bpy.data.worlds["World"].use_nodes = True
             nt = bpy.data.worlds[0].node_tree
             if nt and nt.nodes.get('Sky Texture'):
                 bpy.data.worlds['World'].node_tree.nodes['Sky Texture'].sun_direction = -sin(phi), -cos(phi), sin(beta)
-        
-        for ob in scene.objects:
-            if ob.get('VIType') == 'Sun':
-                ob.rotation_euler = pi * 0.5 - beta, 0, -phi
-                if ob.data.node_tree:
-                    for blnode in [blnode for blnode in ob.data.node_tree.nodes if blnode.bl_label == 'Blackbody']:
-                        blnode.inputs[0].default_value = 2000 + 3500*sin(beta)**0.5
-                    for emnode in [emnode for emnode in ob.data.node_tree.nodes if emnode.bl_label == 'Emission']:
-                        emnode.inputs[1].default_value = 5 * sin(beta)
-            
-            elif ob.get('VIType') == 'SPathMesh':
-                ob.scale = 3 * [scene.soldistance/100]
-            
-            elif ob.get('VIType') == 'SkyMesh':
-                ont = ob.data.materials['SkyMesh'].node_tree
-                if ont and ont.nodes.get('Sky Texture'):
-                    ont.nodes['Sky Texture'].sun_direction = sin(phi), -cos(phi), sin(beta)
-            
-            elif ob.get('VIType') == 'SunMesh':                
-                ob.scale = 3*[scene.soldistance/100]
-                ob.location.z = spoblist['Sun'].location.z = spoblist['SPathMesh'].location.z + scene.soldistance * sin(beta)
-                ob.location.x = spoblist['Sun'].location.x = spoblist['SPathMesh'].location.x -(scene.soldistance**2 - (spoblist['Sun'].location.z-spoblist['SPathMesh'].location.z)**2)**0.5  * sin(phi)
-                ob.location.y = spoblist['Sun'].location.y = spoblist['SPathMesh'].location.y -(scene.soldistance**2 - (spoblist['Sun'].location.z-spoblist['SPathMesh'].location.z)**2)**0.5 * cos(phi)
-                if ob.data.materials[0].node_tree:
-                    for smblnode in [smblnode for smblnode in ob.data.materials[0].node_tree.nodes if ob.data.materials and smblnode.bl_label == 'Blackbody']:
-                        smblnode.inputs[0].default_value = 2000 + 3500*sin(beta)**0.5
+
+        if spoblist.get('Sun'):
+            ob = spoblist['Sun']
+            ob.rotation_euler = pi * 0.5 - beta, 0, -phi
+            if ob.data.node_tree:
+                for blnode in [blnode for blnode in ob.data.node_tree.nodes if blnode.bl_label == 'Blackbody']:
+                    blnode.inputs[0].default_value = 2000 + 3500*sin(beta)**0.5
+                for emnode in [emnode for emnode in ob.data.node_tree.nodes if emnode.bl_label == 'Emission']:
+                    emnode.inputs[1].default_value = 5 * sin(beta)
+
+        if spoblist.get('SPathMesh'):
+            spoblist['SPathMesh'].scale = 3 * [scene.soldistance/100]
+
+        if spoblist.get('SkyMesh'):
+            ont = spoblist['SkyMesh'].data.materials['SkyMesh'].node_tree
+            if ont and ont.nodes.get('Sky Texture'):
+                ont.nodes['Sky Texture'].sun_direction = sin(phi), -cos(phi), sin(beta)
+
+        if spoblist.get('SunMesh') and spoblist.get('Sun') and spoblist.get('SPathMesh'):
+            ob = spoblist['SunMesh']
+            ob.scale = 3*[scene.soldistance/100]
+            ob.location.z = spoblist['Sun'].location.z = spoblist['SPathMesh'].location.z + scene.soldistance * sin(beta)
+            ob.location.x = spoblist['Sun'].location.x = spoblist['SPathMesh'].location.x -(scene.soldistance**2 - (spoblist['Sun'].location.z-spoblist['SPathMesh'].location.z)**2)**0.5  * sin(phi)
+            ob.location.y = spoblist['Sun'].location.y = spoblist['SPathMesh'].location.y -(scene.soldistance**2 - (spoblist['Sun'].location.z-spoblist['SPathMesh'].location.z)**2)**0.5 * cos(phi)
+            if ob.data.materials[0].node_tree:
+                for smblnode in [smblnode for smblnode in ob.data.materials[0].node_tree.nodes if ob.data.materials and smblnode.bl_label == 'Blackbody']:
+                    smblnode.inputs[0].default_value = 2000 + 3500*sin(beta)**0.5
     else:
         return
\ No newline at end of file
@@ -1,5 +1,5 @@
 import sys
-from .vi_func import retmenu
+from .vi_func import retmenu, retenres
 
 def label(cat, stat, time, metric):
     catdict = {'Climate': 'Ambient', 'Zone': 'Zone', 'Linkage': 'Linkage', 'External node': 'External node'} 
@@ -31,7 +31,7 @@ def timedata(datastring, timetype, stattype, months, days, dos, dnode, si, ei, S
 
 def chart_disp(chart_op, plt, dnode, rnodes, Sdate, Edate):
     rn = dnode.inputs['X-axis'].links[0].from_node
-    ard = rn['allresdict']
+    ard = retenres(rn)
     sm, sd, sh, em, ed, eh = Sdate.month, Sdate.day, Sdate.hour, Edate.month, Edate.day, Edate.hour
     (dm, dd, dh) = ([int(x) for x in ard['Month']], [int(x) for x in ard['Day']], [int(x) for x in ard['Hour']])
     for i in range(len(ard['Hour'])):
@@ -65,7 +65,7 @@ def chart_disp(chart_op, plt, dnode, rnodes, Sdate, Edate):
                     xlabel = label(dnode.inputs['X-axis'].rtypemenu, dnode.inputs['X-axis'].statmenu, dnode.timemenu, menus[1])
                     
     rn = dnode.inputs['Y-axis 1'].links[0].from_node
-    ard = rn['allresdict']
+    ard = retenres(rn)
     for rd in rn['resdict']:
         if dnode.inputs['Y-axis 1'].rtypemenu == 'Climate':
             if rn['resdict'][rd][0:2] == [dnode.inputs['Y-axis 1'].rtypemenu, dnode.inputs['Y-axis 1'].climmenu]:
@@ -82,7 +82,7 @@ def chart_disp(chart_op, plt, dnode, rnodes, Sdate, Edate):
 
     if dnode.inputs['Y-axis 2'].links:
         rn = dnode.inputs['Y-axis 2'].links[0].from_node 
-        ard = rn['allresdict']
+        ard = retenres(rn)
         menus = retmenu(dnode, 'Y-axis 2', dnode.inputs['Y-axis 2'].rtypemenu)
         for rd in rn['resdict']:
             if dnode.inputs['Y-axis 2'].rtypemenu == 'Climate':
@@ -96,7 +96,7 @@ def chart_disp(chart_op, plt, dnode, rnodes, Sdate, Edate):
 
     if dnode.inputs['Y-axis 3'].links:
         rn = dnode.inputs['Y-axis 3'].links[0].from_node
-        ard = rn['allresdict']
+        ard = retenres(rn)
         menus = retmenu(dnode, 'Y-axis 3', dnode.inputs['Y-axis 3'].rtypemenu)
         for rd in rn['resdict']:
             if dnode.inputs['Y-axis 3'].rtypemenu == 'Climate':
@@ -17,9 +17,9 @@
 # ##### END GPL LICENSE BLOCK #####
 
 
-import bpy, blf, colorsys, bgl, mathutils, bmesh
+import bpy, blf, colorsys, bgl, mathutils, bmesh, hashlib
 from math import pi
-from numpy import digitize, array
+import numpy
 try:
     import matplotlib
     mp = 1
@@ -27,7 +27,7 @@ except:
     mp = 0
 
 from . import livi_export
-from .vi_func import cmap, clearscene, skframe, selobj, retobjs, framerange, viewdesc, drawloop, drawpoly, draw_index, drawfont, skfpos, objmode
+from .vi_func import cmap, clearscene, skframe, resvals, resbins, setresmatis, frameresmatis, selobj, retobjs, framerange, viewdesc, drawcache, draw_index, binreps, screencells, shadowgeom, shadowbvh, objmode
 
 def ss_display():
     pass
@@ -44,7 +44,7 @@ def li_display(simnode, connode, geonode):
 
     bpy.ops.object.select_all(action = 'DESELECT')
 
-    if len(bpy.app.handlers.frame_change_pre) == 0:
+    if livi_export.cyfc1 not in bpy.app.handlers.frame_change_pre:
         bpy.app.handlers.frame_change_pre.append(livi_export.cyfc1)
         
     for o in scene.objects:
@@ -92,8 +92,7 @@ def li_display(simnode, connode, geonode):
 
         for matname in ['{}#{}'.format(mtype, i) for i in range(20)]:
             if bpy.data.materials[matname] not in ores.data.materials[:]:
-                bpy.ops.object.material_slot_add()
-                ores.material_slots[-1].material = bpy.data.materials[matname]
+                ores.data.materials.append(bpy.data.materials[matname])
         
         for fr, frame in enumerate(range(scene.fs, scene.fe + 1)):  
             if fr == 0:
@@ -104,31 +103,14 @@ def li_display(simnode, connode, geonode):
                 bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY')
             
             if connode and connode.bl_label == 'LiVi Compliance' and scene.vi_disp_sk:
-                sv = bm.faces.layers.float['sv{}'.format(frame)] if scene['liparams']['cp'] == '0' else bm.verts.layers.float['sv{}'.format(frame)]
-                for fi, f in enumerate(ores.data.polygons):
-                    if scene['liparams']['cp'] == '0':
-                        f.material_index = 11 if bm.faces[fi][sv] > 0 else 19
-                    if scene['liparams']['cp'] == '1':
-                        faceres = sum([v[sv] for v in bm.verts])/len(f.vertices)
-                        f.material_index = 11 if faceres > 0 else 19
-                oreslist = [f[sv] for f in bm.faces] if scene['liparams']['cp'] == '0' else [v[sv] for v in bm.verts]
+                vals, oreslist = resvals(ores, 'sv{}'.format(frame))
+                setresmatis(ores, frame, numpy.where(vals > 0, 11, 19))
             else:
-                livires = bm.faces.layers.float['res{}'.format(frame)] if scene['liparams']['cp'] == '0' else bm.verts.layers.float['res{}'.format(frame)]
-                try:
-                    vals = array([(f[livires] - min(simnode['minres'].values()))/(max(simnode['maxres'].values()) - min(simnode['minres'].values())) for f in bm.faces]) if scene['liparams']['cp'] == '0' else \
-                ([(sum([vert[livires] for vert in f.verts])/len(f.verts) - min(simnode['minres'].values()))/(max(simnode['maxres'].values()) - min(simnode['minres'].values())) for f in bm.faces])
-                except:
-                    vals = array([0 for f in bm.faces])
-                bins = array([0.05*i for i in range(1, 20)])
-                nmatis = digitize(vals, bins)
-                for fi, f in enumerate(ores.data.polygons):
-                    f.material_index = nmatis[fi]
-                oreslist = [f[livires] for f in bm.faces] if scene['liparams']['cp'] == '0' else [v[livires] for v in bm.verts]
-
-            if scene.fe - scene.fs > 0:
-                [ores.data.polygons[fi].keyframe_insert('material_index', frame=frame) for fi in range(len(bm.faces))] 
-            ores['omax'][str(frame)], ores['omin'][str(frame)], ores['oave'][str(frame)] = max(oreslist), min(oreslist), sum(oreslist)/len(oreslist)
+                vals, oreslist = resvals(ores, 'res{}'.format(frame))
+                setresmatis(ores, frame, resbins(vals, min(simnode['minres'].values()), max(simnode['maxres'].values())))
+            ores['omax'][str(frame)], ores['omin'][str(frame)], ores['oave'][str(frame)] = float(oreslist.max()), float(oreslist.min()), float(oreslist.mean())
         
+        frameresmatis(ores, scene.fs)
         bm.free()
         if scene.vi_disp_3d == 1:
             selobj(scene, ores)
@@ -139,6 +121,9 @@ def li_display(simnode, connode, geonode):
                 
     skframe('', scene, obreslist, simnode['Animation'])                                   
     bpy.ops.wm.save_mainfile(check_existing = False)
+    livi_export.cyfcprep(scene)
+    numcache.clear()
+    legcache.clear()
     scene.frame_set(scene.fs)
     rendview(1)
 
@@ -173,6 +158,49 @@ def spnumdisplay(disp_op, context, simnode):
     else:
         return
 
+# Label anchors, normals and values per result object and frame, with the labels found visible from the last view
+numcache = {}
+
+def numanchors(scene, ob, frame):
+    # Hide and select flags are re-read on every call, as hiding or selecting elements does not change the other key terms
+    me, omw = ob.data, numpy.array(ob.matrix_world)
+    elems = (me.polygons, me.vertices)[scene['liparams']['cp'] != '0']
+    hide, sel = numpy.zeros(len(elems), dtype = bool), numpy.zeros(len(elems), dtype = bool)
+    elems.foreach_get('hide', hide)
+    elems.foreach_get('select', sel)
+    key = (frame, scene['liparams']['cp'], scene.vi_disp_3d, tuple(omw.ravel()), len(me.vertices), len(me.polygons), hashlib.md5(hide.tobytes() + sel.tobytes()).hexdigest())
+    if numcache.get(ob.name, {}).get('key') != key:
+        sk = me.shape_keys.key_blocks.get(str(frame)) if me.shape_keys else None
+        if scene['liparams']['cp'] == '0':
+            res, nos = resvals(ob, 'res{}'.format(frame))[0], numpy.zeros(len(me.polygons) * 3)
+            me.polygons.foreach_get('normal', nos)
+            if scene.vi_disp_3d and sk:
+                kcos = numpy.zeros(len(me.vertices) * 3)
+                lv, ls = numpy.zeros(len(me.loops), dtype = numpy.int32), numpy.zeros(len(me.polygons), dtype = numpy.int32)
+                sk.data.foreach_get('co', kcos)
+                me.loops.foreach_get('vertex_index', lv)
+                me.polygons.foreach_get('loop_start', ls)
+                lcos = kcos.reshape(-1, 3)[lv]
+                cos, mask = (numpy.maximum.reduceat(lcos, ls) + numpy.minimum.reduceat(lcos, ls)) * 0.5, sel & ~hide
+            else:
+                cos, mask = numpy.zeros(len(me.polygons) * 3), ~hide
+                me.polygons.foreach_get('center', cos)
+        else:
+            res, nos, cos = resvals(ob, 'res{}'.format(frame))[1], numpy.zeros(len(me.vertices) * 3), numpy.zeros(len(me.vertices) * 3)
+            me.vertices.foreach_get('normal', nos)
+            (sk.data if scene.vi_disp_3d and sk else me.vertices).foreach_get('co', cos)
+            mask = ~hide
+        cos, nos = cos.reshape(-1, 3).dot(omw[:3, :3].T) + omw[:3, 3], nos.reshape(-1, 3).dot(omw[:3, :3].T)
+        nos /= numpy.maximum(numpy.linalg.norm(nos, axis = 1), 1e-9)[:, None]
+        numcache[ob.name] = {'key': key, 'cos': cos[mask], 'nos': nos[mask], 'res': res[mask], 'view': None, 'vis': None}
+    return numcache[ob.name]
+
+def numbvh(scene):
+    # Occluders for the visible only labels, built once per frame
+    if numcache.get('_bvh', (None,))[0] != scene.frame_current:
+        numcache['_bvh'] = (scene.frame_current, shadowbvh(*shadowgeom(scene)[:2]))
+    return numcache['_bvh'][1]
+
 def linumdisplay(disp_op, context, simnode, connode, geonode):
     scene = context.scene    
     if not scene.vi_display:
@@ -213,50 +241,38 @@ def linumdisplay(disp_op, context, simnode, connode, geonode):
     else:
         obd = [context.active_object] if context.active_object in obreslist else []
 
+    pm, vl, vwa = numpy.array(view_mat), numpy.array(view_location), numpy.array(vw)
+    # Visible labels are kept until the view moves more than 1% of the view distance, turns more than ~0.5 degrees or the display settings change
+    vkey = (width, height, scene.vi_display_rp_fs, scene.vi_display_vis_only, scene.vi_display_rp_off, scene.vi_display_rp_bin)
     for ob in obd:
         if ob.data.shape_keys and str(fn) in [sk.name for sk in ob.data.shape_keys.key_blocks] and ob.active_shape_key.name != str(fn):
             ob.active_shape_key_index = [sk.name for sk in ob.data.shape_keys.key_blocks].index(str(fn))
 
-        obm = ob.data
-        omw = ob.matrix_world
-        total_mat = view_mat * omw
-        bm = bmesh.new()
-        bm.from_mesh(obm)
-        bm.transform(omw)
-
-        if scene['liparams']['cp'] == "0":
-            livires = bm.faces.layers.float['res{}'.format(scene.frame_current)]
-            if not scene.vi_disp_3d:
-                faces = [f for f in bm.faces if not f.hide and mathutils.Vector.angle(vw, view_location - f.calc_center_median()) < pi * 0.5]
-                faces = [f for f in faces if not scene.ray_cast(f.calc_center_median() + scene.vi_display_rp_off * f.normal, view_location)[0]] if scene.vi_display_vis_only else faces
-                fcs = [view_mat*f.calc_center_bounds().to_4d() for f in faces]
-            else:
-                sk = bm.verts.layers.shape[scene.frame_current]
-                faces = [f for f in bm.faces if f.select and not f.hide]
-                fpos = [skfpos(ob, scene.frame_current, [v.index for v in f.verts]) for f in faces]
-                faces = [f for fi, f in enumerate(faces) if mathutils.Vector.angle(vw, view_location - f.calc_center_median()) < pi * 0.5]
-                fpos = [skfpos(ob, scene.frame_current, [v.index for v in f.verts]) for f in faces]
-                faces = [f for fi, f in enumerate(faces) if not scene.ray_cast(fpos[fi] + scene.vi_display_rp_off * f.normal, view_location)[0]] if scene.vi_display_vis_only else faces
-                fpos = [skfpos(ob, scene.frame_current, [v.index for v in f.verts]) for f in faces]
-                fcs = [view_mat*fpos[fi].to_4d() for fi, f in enumerate(faces)]
-            res = [f[livires] for f in faces]
-            draw_index(context, scene.vi_leg_display, mid_x, mid_y, width, height, fcs, res)
-        else:
-            livires = bm.verts.layers.float['res{}'.format(scene.frame_current)]              
-            if not scene.vi_disp_3d:
-                verts = [v for v in bm.verts if not v.hide and mathutils.Vector.angle(vw, view_location - v.co) < pi * 0.5]
-                verts = [v for v in verts if not scene.ray_cast(v.co + scene.vi_display_rp_off * v.normal, view_location)[0]] if scene.vi_display_vis_only else verts
-                vcs = [view_mat*v.co.to_4d() for v in verts]                
-            else:
-                verts = [v for v in bm.verts if not v.hide and mathutils.Vector.angle(vw, view_location - omw*(ob.data.shape_keys.key_blocks[str(scene.frame_current)].data[v.index].co)) < pi * 0.5]
-                verts = [v for v in verts if not scene.ray_cast(omw*(ob.data.shape_keys.key_blocks[str(scene.frame_current)].data[v.index].co) + scene.vi_display_rp_off * v.normal, view_location)[0]] if scene.vi_display_vis_only else verts
-                vcs = [total_mat*ob.data.shape_keys.key_blocks[str(scene.frame_current)].data[v.index].co.to_4d() for v in verts]
-            res = [v[livires] for v in verts]
-            draw_index(context, scene.vi_leg_display, mid_x, mid_y, width, height, vcs, res)
-
-        bm.free()
+        nc = numanchors(scene, ob, scene.frame_current)
+        if nc['view'] is None or nc['view'][2] != vkey or numpy.linalg.norm(nc['view'][0] - vl) > 0.01 * bpy.context.region_data.view_distance or numpy.dot(nc['view'][1], vwa) < 0.99996:
+            cos = nc['cos']
+            vis = numpy.flatnonzero(numpy.dot(vl - cos, vwa) > 0)
+            clips = numpy.column_stack((cos[vis], numpy.ones(len(vis)))).dot(pm.T)
+            vis, clips = vis[clips[:, 3] > 0], clips[clips[:, 3] > 0]
+            onscreen = (numpy.abs(clips[:, 0]) <= clips[:, 3]) & (numpy.abs(clips[:, 1]) <= clips[:, 3])
+            vis, clips = vis[onscreen], clips[onscreen]
+            # At most one label per screen cell before the occlusion test: the nearest in a cell a few characters across or,
+            # with label binning on, the binning representative, so only those are ray cast
+            xs, ys = mid_x + clips[:, 0]/clips[:, 3] * mid_x, mid_y + clips[:, 1]/clips[:, 3] * mid_y
+            if scene.vi_display_rp_bin == '0':
+                vis = vis[screencells(xs, ys, clips[:, 3], scene.vi_display_rp_fs * 3)]
+            elif len(vis):
+                vis = vis[binreps(scene, xs, ys, nc['res'][vis])]
+            if scene.vi_display_vis_only and len(vis):
+                bvh, origins = numbvh(scene), cos[vis] + scene.vi_display_rp_off * nc['nos'][vis]
+                vis = vis[[bvh.ray_cast(mathutils.Vector(origin), mathutils.Vector(vl - origin).normalized(), numpy.linalg.norm(vl - origin))[0] is None for origin in origins]]
+            nc['view'], nc['vis'] = (vl, vwa, vkey), vis
+        draw_index(context, scene.vi_leg_display, mid_x, mid_y, width, height, numpy.column_stack((nc['cos'][nc['vis']], numpy.ones(len(nc['vis'])))).dot(pm.T), nc['res'][nc['vis']])
     blf.disable(0, 4)
 
+# Legend and compliance overlays, rebuilt only when the results, frame, view height or display settings they show change
+legcache = {}
+
 def li3D_legend(self, context, simnode, connode, geonode):
     scene = context.scene
     fc = str(scene.frame_current)
@@ -264,50 +280,28 @@ def li3D_legend(self, context, simnode, connode, geonode):
         if scene.vi_leg_display != True or scene.vi_display == 0 or (scene.wr_disp_panel != 1 and scene.li_disp_panel != 2 and scene.ss_disp_panel != 2) or scene.frame_current not in range(scene.fs, scene.fe + 1):
             return
         else:
-            resvals = [('{:.1f}', '{:.0f}')[scene.vi_leg_max >= 100].format(scene.vi_leg_min+i*(scene.vi_leg_max - scene.vi_leg_min)/19) for i in range(20)]    
-            height = context.region.height
-            lenres = len(resvals[-1])
-            font_id = 0
-            drawpoly(20, height - 40, 70 + lenres*8, height - 520)
-            drawloop(19, height - 40, 70 + lenres*8, height - 520)
-    
-            for i in range(20):
-                h = 0.75 - 0.75*(i/19)
-                if connode:
-                    bgl.glColor4f(colorsys.hsv_to_rgb(h, 1.0, 1.0)[0], colorsys.hsv_to_rgb(h, 1.0, 1.0)[1], colorsys.hsv_to_rgb(h, 1.0, 1.0)[2], 1.0)
-                else:
-                    bgl.glColor4f(i/19, i/19, i/19, 1)
-                bgl.glBegin(bgl.GL_POLYGON)
-                bgl.glVertex2i(20, (i*20)+height - 460)
-                bgl.glVertex2i(60, (i*20)+height - 460)
-                bgl.glVertex2i(60, (i*20)+height - 440)
-                bgl.glVertex2i(20, (i*20)+height - 440)
-                bgl.glEnd()
-                blf.size(font_id, 20, 48)
-                bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
-                blf.position(font_id, 65, (i*20)+height - 455, 0)
-                blf.draw(font_id, "  "*(lenres - len(resvals[i]) ) + resvals[i])    
-            blf.size(font_id, 20, 56) 
-#            print(connode)
-#            cu = connode['unit'] if connode else '% Sunlit'    
-            drawfont(scene['liparams']['unit'], font_id, 0, height, 25, 57)
-            bgl.glLineWidth(1)
-            bgl.glDisable(bgl.GL_BLEND)
-            height = context.region.height
-            font_id = 0
-            bgl.glColor4f(0.0, 0.0, 0.0, 0.8)
-            blf.size(font_id, 20, 48)
-            if context.active_object and context.active_object.get('lires'):
-                drawfont("Ave: {:.1f}".format(context.active_object['oave'][fc]), font_id, 0, height, 22, 480)
-                drawfont("Max: {:.1f}".format(context.active_object['omax'][fc]), font_id, 0, height, 22, 495)
-                drawfont("Min: {:.1f}".format(context.active_object['omin'][fc]), font_id, 0, height, 22, 510)
-            else:
-                drawfont("Ave: {:.1f}".format(simnode['avres'][fc]), font_id, 0, height, 22, 480)
-                drawfont("Max: {:.1f}".format(simnode['maxres'][fc]), font_id, 0, height, 22, 495)
-                drawfont("Min: {:.1f}".format(simnode['minres'][fc]), font_id, 0, height, 22, 510)
+            height, dc = context.region.height, legcache.setdefault('li', drawcache())
+            resob = context.active_object if context.active_object and context.active_object.get('lires') else None
+            key = (height, scene.vi_leg_min, scene.vi_leg_max, bool(connode), scene['liparams']['unit'], fc, resob.name if resob else '')
+            if dc.key != key:
+                dc.reset(key)
+                resvals = [('{:.1f}', '{:.0f}')[scene.vi_leg_max >= 100].format(scene.vi_leg_min+i*(scene.vi_leg_max - scene.vi_leg_min)/19) for i in range(20)]    
+                lenres = len(resvals[-1])
+                dc.poly(20, height - 40, 70 + lenres*8, height - 520)
+                dc.loop(19, height - 40, 70 + lenres*8, height - 520)
+                for i in range(20):
+                    h = 0.75 - 0.75*(i/19)
+                    dc.poly(20, (i*20)+height - 440, 60, (i*20)+height - 460, colorsys.hsv_to_rgb(h, 1.0, 1.0) + (1.0,) if connode else (i/19, i/19, i/19, 1))
+                    dc.text("  "*(lenres - len(resvals[i]) ) + resvals[i], 65, (i*20)+height - 455, (20, 48))
+                dc.text(scene['liparams']['unit'], 25, height - 57, (20, 56))
+                stats = (resob['oave'][fc], resob['omax'][fc], resob['omin'][fc]) if resob else (simnode['avres'][fc], simnode['maxres'][fc], simnode['minres'][fc])
+                for si, stat in enumerate(('Ave', 'Max', 'Min')):
+                    dc.text("{}: {:.1f}".format(stat, stats[si]), 22, height - 480 - si*15, (20, 48), (0.0, 0.0, 0.0, 0.8))
+            dc.draw()
     
     except Exception as e:
         print(e, 'Turning off legend display')
+        legcache.pop('li', None)
         scene.vi_leg_display = 0
         scene.update()
         
@@ -317,62 +311,57 @@ def viwr_legend(self, context, simnode):
         return
     else:
         try:
-            resvals = ['{0:.0f} to {1:.0f}'.format(2*i, 2*(i+1)) for i in range(simnode['nbins'])]
-            resvals[-1] = resvals[-1][:-int(len('{:.0f}'.format(simnode['maxres'])))] + u"\u221E"
-            height, lenres, font_id = context.region.height, len(resvals[-1]), 0
-            drawpoly(20, height - 40, 70 + lenres*8, height - (simnode['nbins']+6)*20)
-            drawloop(19, height - 40, 70 + lenres*8, height - (simnode['nbins']+6)*20)
-            cm = matplotlib.cm.jet if simnode.wrtype in ('0', '1') else matplotlib.cm.hot
-            for i in range(simnode['nbins']):
-                bgl.glColor4f(*cm(i * 1/(simnode['nbins']-1), 1))
-                bgl.glBegin(bgl.GL_POLYGON)
-                bgl.glVertex2i(20, height - 70 - (simnode['nbins'] * 20) + (i*20))
-                bgl.glVertex2i(60, height - 70 - (simnode['nbins'] * 20) + (i*20))
-                bgl.glVertex2i(60, height - 50 - (simnode['nbins'] * 20) + (i*20))
-                bgl.glVertex2i(20, height - 50 - (simnode['nbins'] * 20) + (i*20))
-                bgl.glEnd()
-                blf.size(font_id, 20, 48)
-                bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
-                blf.position(font_id, 65, height - 65 - (simnode['nbins'] * 20) + (i*20), 0)
-                blf.draw(font_id, "  "*(lenres - len(resvals[i]) ) + resvals[i])
-    
-            blf.size(font_id, 20, 56)
-            cu = 'Speed (m/s)'
-            drawfont(cu, font_id, 0, height, 25, 57)
-            bgl.glLineWidth(1)
-            bgl.glDisable(bgl.GL_BLEND)
-            height = context.region.height
-            font_id = 0
-            bgl.glColor4f(0.0, 0.0, 0.0, 0.8)
-            blf.size(font_id, 20, 48)
-            drawfont("Ave: {:.1f}".format(simnode['avres']), font_id, 0, height, 22, simnode['nbins']*20 + 85)
-            drawfont("Max: {:.1f}".format(simnode['maxres']), font_id, 0, height, 22, simnode['nbins']*20 + 100)
-            drawfont("Min: {:.1f}".format(simnode['minres']), font_id, 0, height, 22, simnode['nbins']*20 + 115)
+            height, dc = context.region.height, legcache.setdefault('wr', drawcache())
+            key = (height, simnode['nbins'], simnode.wrtype, simnode['maxres'], simnode['avres'], simnode['minres'])
+            if dc.key != key:
+                dc.reset(key)
+                resvals = ['{0:.0f} to {1:.0f}'.format(2*i, 2*(i+1)) for i in range(simnode['nbins'])]
+                resvals[-1] = resvals[-1][:-int(len('{:.0f}'.format(simnode['maxres'])))] + u"\u221E"
+                lenres = len(resvals[-1])
+                dc.poly(20, height - 40, 70 + lenres*8, height - (simnode['nbins']+6)*20)
+                dc.loop(19, height - 40, 70 + lenres*8, height - (simnode['nbins']+6)*20)
+                cm = matplotlib.cm.jet if simnode.wrtype in ('0', '1') else matplotlib.cm.hot
+                for i in range(simnode['nbins']):
+                    dc.poly(20, height - 50 - (simnode['nbins'] * 20) + (i*20), 60, height - 70 - (simnode['nbins'] * 20) + (i*20), cm(i * 1/(simnode['nbins']-1), 1))
+                    dc.text("  "*(lenres - len(resvals[i]) ) + resvals[i], 65, height - 65 - (simnode['nbins'] * 20) + (i*20), (20, 48))
+                dc.text('Speed (m/s)', 25, height - 57, (20, 56))
+                for si, stat in enumerate(('avres', 'maxres', 'minres')):
+                    dc.text("{}: {:.1f}".format(stat[:3].capitalize(), simnode[stat]), 22, height - simnode['nbins']*20 - 85 - si*15, (20, 48), (0.0, 0.0, 0.0, 0.8))
+            dc.draw()
         except:
+            legcache.pop('wr', None)
             scene.vi_display = 0
             
 def li_compliance(self, context, connode):
     height, scene = context.region.height, context.scene
     if not scene.get('li_compliance') or scene.frame_current not in range(scene.fs, scene.fe + 1) or scene.li_disp_panel < 2:
         return
+    dc, ao = legcache.setdefault('comp', drawcache()), bpy.context.active_object
+    # The space types of each result object's compliance material set its criteria and titles, so they are part of the key
+    cmats = [(o.name, bpy.data.materials.get(o.get('compmat', ''))) for o in bpy.data.objects if o.get('lires')]
+    key = (height, scene.frame_current, ao.name if ao else '', connode.analysismenu, connode.bambuildmenu, scene.li_projname, scene.li_assorg, scene.li_assind, scene.li_jobno,
+           tuple([(on, (mat.hspacemenu, mat.brspacemenu, mat.respacemenu, mat.crspacemenu) if mat else ()) for on, mat in cmats]))
+    if dc.key != key:
+        dc.reset(key)
+        li_compbuild(dc, scene, connode, height)
+    dc.draw()
+
+def li_compbuild(dc, scene, connode, height):
+    red, green, black = (1.0, 0.0, 0.0, 1.0), (0.0, 0.7, 0.0, 1.0), (0.0, 0.0, 0.0, 1.0)
     if connode.analysismenu == '0':
         buildtype = ('School', 'Higher Education', 'Healthcare', 'Residential', 'Retail', 'Office & Other')[int(connode.bambuildmenu)]
     elif connode.analysismenu == '1':
         buildtype = 'Residential'
         cfshpfsdict = {'totkit': 0, 'kitdf': 0, 'kitsv': 0, 'totliv': 0, 'livdf': 0, 'livsv': 0}
 
-    drawpoly(100, height - 40, 900, height - 65)
-    bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
+    dc.poly(100, height - 40, 900, height - 65)
     horpos, widths = (100, 317, 633, 900), (100, 450, 600, 750, 900)
 
     for p in range(3):
-        drawloop(horpos[p], height - 40, horpos[p+1], height - 65)
+        dc.loop(horpos[p], height - 40, horpos[p+1], height - 65)
 
-    font_id = 0
-    blf.size(font_id, 20, 54)
-    drawfont('Standard: '+('BREEAM HEA1', 'CfSH', 'LEED EQ8.1', 'Green Star')[int(connode.analysismenu)], font_id, 0, height, 110, 58)
-    drawfont('Project Name: '+scene.li_projname, font_id, 0, height, 643, 58)
-    blf.size(font_id, 20, 40)
+    dc.text('Standard: '+('BREEAM HEA1', 'CfSH', 'LEED EQ8.1', 'Green Star')[int(connode.analysismenu)], 110, height - 58, (20, 54))
+    dc.text('Project Name: '+scene.li_projname, 643, height - 58, (20, 54))
 
     def space_compliance(os):
         frame, buildspace, pfs, epfs, lencrit = scene.frame_current, '', [], [], 0
@@ -416,8 +405,8 @@ def li_compliance(self, context, connode):
         if bpy.context.active_object in os:
             o = bpy.context.active_object
             lencrit = 1 + len(o['crit'])
-            drawpoly(100, height - 70, 900, height - 70  - (lencrit)*25)
-            drawloop(100, height - 70, 900, height - 70  - (lencrit)*25)
+            dc.poly(100, height - 70, 900, height - 70  - (lencrit)*25)
+            dc.loop(100, height - 70, 900, height - 70  - (lencrit)*25)
             mat = bpy.data.materials[o['compmat']]
             if connode.analysismenu == '0':
                 buildspace = ('', '', (' - Public/Staff', ' - Patient')[int(mat.hspacemenu)], (' - Kitchen', ' - Living/Dining/Study', ' - Communal')[int(mat.brspacemenu)], (' - Sales', ' - Office')[int(mat.respacemenu)], '')[int(connode.bambuildmenu)]
@@ -456,23 +445,14 @@ def li_compliance(self, context, connode):
                         etables[e] = ('Minimum {} (%)'.format('Point Daylight Factor'), ecr[3], '{:.2f}'.format(o['ecomps'][frame][:][e*2 + 1]), o['ecr4'][e].upper())
 
             for j in range(4):
-                drawloop(widths[j], height - 70, widths[j+1], height - 95)
+                dc.loop(widths[j], height - 70, widths[j+1], height - 95)
 
-            bgl.glEnable(bgl.GL_LINE_STIPPLE)
             for t, tab in enumerate(tables):
                 for j in range(4):
-                    drawloop(widths[j], height - 95 - t*25, widths[j+1], height - 120 - t*25)
-                    if tab[j] == 'FAIL':
-                        bgl.glColor4f(1.0, 0.0, 0.0, 1.0)
-                    elif tab[j] == 'PASS':
-                        bgl.glColor4f(0.0, 0.7, 0.0, 1.0)
-                    blf.size(font_id, 20, 44)
-                    drawfont(tab[j], 0, 0, height, widths[j]+(25, 50)[j != 0]+(0, 10)[j in (1, 3)], 113 + t*25)
-                    bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
+                    dc.loop(widths[j], height - 95 - t*25, widths[j+1], height - 120 - t*25)
+                    dc.text(tab[j], widths[j]+(25, 50)[j != 0]+(0, 10)[j in (1, 3)], height - 113 - t*25, (20, 44), (black, red, green)[('FAIL', 'PASS').index(tab[j]) + 1 if tab[j] in ('FAIL', 'PASS') else 0])
                     if t == 0:
-                        blf.size(font_id, 20, 48)
-                        drawfont(titles[j], 0, 0, height, widths[j]+(25, 50)[j != 0]+(0, 10)[j in (1, 3)], 88)
-            bgl.glDisable(bgl.GL_LINE_STIPPLE)
+                        dc.text(titles[j], widths[j]+(25, 50)[j != 0]+(0, 10)[j in (1, 3)], height - 88, (20, 48))
         else:
             etables = []
             lencrit = 0
@@ -488,48 +468,33 @@ def li_compliance(self, context, connode):
     if build_compliance == 'EXEMPLARY':
         for t, tab in enumerate(etables):
             if t == 0:
-                drawpoly(100, height - 70 - (lencrit * 25), 900, height - 70 - ((lencrit - len(etables)) * 25))
-                drawloop(100, height - 70 - (lencrit * 25), 900, height - 70 - ((lencrit - len(etables)) * 25))
+                dc.poly(100, height - 70 - (lencrit * 25), 900, height - 70 - ((lencrit - len(etables)) * 25))
+                dc.loop(100, height - 70 - (lencrit * 25), 900, height - 70 - ((lencrit - len(etables)) * 25))
             for j in range(4):
-                bgl.glEnable(bgl.GL_LINE_STIPPLE)
-                drawloop(widths[j], height - 95 - (lencrit - len(etables) + t - 1) * 25, widths[j+1], height - 120 - (lencrit - len(etables) + t - 1) * 25)
-                if tab[j] == 'FAIL':
-                    bgl.glColor4f(1.0, 0.0, 0.0, 1.0)
-                elif tab[j] == 'PASS':
-                    bgl.glColor4f(0.0, 1.0, 0.0, 1.0)
-                blf.size(font_id, 20, 44)
-                blf.position(font_id, widths[j]+(25, 50)[j != 0]+(0, 10)[j in (1, 3)], height - 113 - (lencrit - len(etables) + t - 1) * 25, 0)
-                blf.draw(font_id, tab[j])
-                bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
-                bgl.glDisable(bgl.GL_LINE_STIPPLE)
-
-    blf.position(font_id, 327, height - 58, 0)
-    blf.size(font_id, 20, 54)
-    blf.draw(font_id, 'Buildtype: '+buildtype+bs)
-
-    blf.size(font_id, 20, 52)
-    blf.position(font_id, 110, height - 87 - lencrit*26, 0)
+                dc.loop(widths[j], height - 95 - (lencrit - len(etables) + t - 1) * 25, widths[j+1], height - 120 - (lencrit - len(etables) + t - 1) * 25)
+                dc.text(tab[j], widths[j]+(25, 50)[j != 0]+(0, 10)[j in (1, 3)], height - 113 - (lencrit - len(etables) + t - 1) * 25, (20, 44), (black, red, (0.0, 1.0, 0.0, 1.0))[('FAIL', 'PASS').index(tab[j]) + 1 if tab[j] in ('FAIL', 'PASS') else 0])
+
+    dc.text('Buildtype: '+buildtype+bs, 327, height - 58, (20, 54))
+
     if connode.analysismenu == '0':
-        drawpoly(100, height - 70 - lencrit*26, 525, height - 95 - lencrit*26)
-        drawloop(100, height - 70 - lencrit*26, 350, height - 95 - lencrit*26)
-        drawloop(100, height - 70 - lencrit*26, 350, height - 95 - lencrit*26)
-        drawloop(350, height - 70 - lencrit*26, 525, height - 95 - lencrit*26)
-        blf.draw(font_id, 'Building Compliance:')
-        drawfont(build_compliance, 0, lencrit, height, 250, 87)
-        blf.position(font_id, 360, height - 87 - lencrit*26, 0)
-        blf.draw(font_id, 'Credits achieved:')
-        blf.position(font_id, 480, height - 87 - lencrit*26, 0)
+        dc.poly(100, height - 70 - lencrit*26, 525, height - 95 - lencrit*26)
+        dc.loop(100, height - 70 - lencrit*26, 350, height - 95 - lencrit*26)
+        dc.loop(350, height - 70 - lencrit*26, 525, height - 95 - lencrit*26)
+        dc.text('Building Compliance:', 110, height - 87 - lencrit*26, (20, 52))
+        dc.text(build_compliance, 250, height - 87 - lencrit*26, (20, 52))
+        dc.text('Credits achieved:', 360, height - 87 - lencrit*26, (20, 52))
         if build_compliance == 'PASS':
-           blf.draw(font_id,  ('1', '2', '2', '1', '1', '1')[int(connode.bambuildmenu)])
+            credits = ('1', '2', '2', '1', '1', '1')[int(connode.bambuildmenu)]
         elif build_compliance == 'EXEMPLARY':
-            blf.draw(font_id,  ('2', '3', '3', '2', '2', '2')[int(connode.bambuildmenu)])
+            credits = ('2', '3', '3', '2', '2', '2')[int(connode.bambuildmenu)]
         else:
-            blf.draw(font_id, '0')
+            credits = '0'
+        dc.text(credits, 480, height - 87 - lencrit*26, (20, 52))
 
     elif connode.analysismenu == '1':
-        drawpoly(100, height - 70 - lencrit*26, 300, height - 95 - lencrit*26)
-        drawloop(100, height - 70 - lencrit*26, 300, height - 95 - lencrit*26)
-        drawfont('Credits achieved:', 0, lencrit, height, 110, 87)
+        dc.poly(100, height - 70 - lencrit*26, 300, height - 95 - lencrit*26)
+        dc.loop(100, height - 70 - lencrit*26, 300, height - 95 - lencrit*26)
+        dc.text('Credits achieved:', 110, height - 87 - lencrit*26, (20, 52))
         cfshcred = 0
         if cfshpfsdict['kitdf'] == cfshpfsdict['totkit'] and cfshpfsdict['totkit'] != 0:
             cfshcred += 1
@@ -537,33 +502,16 @@ def li_compliance(self, context, connode):
             cfshcred += 1
         if (cfshpfsdict['kitsv'] == cfshpfsdict['totkit'] and  cfshpfsdict['totkit'] != 0) or (cfshpfsdict['livsv'] == cfshpfsdict['totliv'] and cfshpfsdict['totliv'] != 0):
             cfshcred += 1
-        blf.position(font_id, 250, height - 87 - lencrit*26, 0)
-        blf.draw(font_id, '{} of {}'.format(cfshcred, '3' if 0 not in (cfshpfsdict['totkit'], cfshpfsdict['totliv']) else '2'))
+        dc.text('{} of {}'.format(cfshcred, '3' if 0 not in (cfshpfsdict['totkit'], cfshpfsdict['totliv']) else '2'), 250, height - 87 - lencrit*26, (20, 52))
 
-    bgl.glEnable(bgl.GL_BLEND)
-    bgl.glColor4f(1.0, 1.0, 1.0, 0.8)
-    bgl.glLineWidth(1)
     sw = 8
-
     aolen, ailen, jnlen = len(scene.li_assorg), len(scene.li_assind), len(scene.li_jobno)
-    drawpoly(100, 50, 500 + aolen*sw + ailen*sw + jnlen*sw, 25)
-    bgl.glColor4f(0.0, 0.0, 0.0, 1.0)
-    drawloop(100, 50, 260 + aolen*sw, 25)
-    drawloop(260 + aolen*sw, 50, 400 + aolen*sw + ailen*sw, 25)
-    drawloop(400 + aolen*sw + ailen*sw, 50, 500 + aolen*sw + ailen*sw + jnlen*sw, 25)
-    blf.size(font_id, 20, 44)
-    blf.position(font_id, 110, 32, 0)
-    blf.draw(font_id, 'Assessing Organisation:')
-    blf.position(font_id, 250, 32, 0)
-    blf.draw(font_id, scene.li_assorg)
-    blf.position(font_id, 270 + aolen*sw, 32, 0)
-    blf.draw(font_id, 'Assessing Individual:')
-    blf.position(font_id, 395 + aolen*sw, 32, 0)
-    blf.draw(font_id, scene.li_assind)
-    blf.position(font_id, 410 + aolen*sw + ailen*sw, 32, 0)
-    blf.draw(font_id, 'Job Number:')
-    blf.position(font_id, 490 + aolen*sw + ailen*sw, 32, 0)
-    blf.draw(font_id, scene.li_jobno)
+    dc.poly(100, 50, 500 + aolen*sw + ailen*sw + jnlen*sw, 25)
+    dc.loop(100, 50, 260 + aolen*sw, 25)
+    dc.loop(260 + aolen*sw, 50, 400 + aolen*sw + ailen*sw, 25)
+    dc.loop(400 + aolen*sw + ailen*sw, 50, 500 + aolen*sw + ailen*sw + jnlen*sw, 25)
+    for text, x in (('Assessing Organisation:', 110), (scene.li_assorg, 250), ('Assessing Individual:', 270 + aolen*sw), (scene.li_assind, 395 + aolen*sw), ('Job Number:', 410 + aolen*sw + ailen*sw), (scene.li_jobno, 490 + aolen*sw + ailen*sw)):
+        dc.text(text, x, 32, (20, 44))
 
 def rendview(i):
     for scrn in bpy.data.screens:
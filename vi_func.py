@@ -1,6 +1,10 @@
-import bpy, os, sys, multiprocessing, mathutils, bmesh, datetime, colorsys, bgl, blf, numpy
+import bpy, os, sys, multiprocessing, mathutils, bmesh, datetime, colorsys, bgl, blf, numpy, json, sqlite3, hashlib
 from math import sin, cos, asin, acos, pi, isnan
 from mathutils import Vector, Matrix
+from mathutils.bvhtree import BVHTree
+from subprocess import Popen
+from .vi_shadow import bvhsave
+from collections import OrderedDict
 from bpy.props import IntProperty, StringProperty, EnumProperty, FloatProperty, BoolProperty, FloatVectorProperty
 try:
     import matplotlib
@@ -231,7 +235,146 @@ def retmenu(dnode, axis, mtype):
     elif mtype == 'External node':
         return [dnode.inputs[axis].enmenu, dnode.inputs[axis].enrmenu]
         
-def processf(pro_op, node):
+enresarrays = {}
+
+class enresstore(object):
+    # A results directory of one .npy file per column and an index.json, written once per simulation.
+    # Columns are memory mapped on first access so only the columns and time ranges used are read.
+    def __init__(self, storedir):
+        self.storedir, self.cols = storedir, {}
+        with open(os.path.join(storedir, 'index.json'), 'r') as indexfile:
+            self.index = json.load(indexfile)
+
+    def __getitem__(self, rid):
+        if rid not in self.cols:
+            self.cols[rid] = numpy.load(os.path.join(self.storedir, '{}.npy'.format(rid)), mmap_mode = 'r')
+        return self.cols[rid]
+
+    def __contains__(self, rid):
+        return rid in self.index['columns']
+
+    def keys(self):
+        return self.index['columns']
+
+    def fresh(self, esofile):
+        return self.index['eso'] == esofile and os.path.isfile(esofile) and self.index['esomtime'] == os.path.getmtime(esofile)
+
+class ensqlstore(object):
+    # Hourly series read on demand from an EnergyPlus SQLite output, keyed like the ESO report ids. The time columns and
+    # every series share one filter, hourly rows of the weather file run period outside warm-up, so they stay aligned
+    timefilter = ("t.IntervalType = 1 AND (t.WarmupFlag IS NULL OR t.WarmupFlag = 0) AND t.EnvironmentPeriodIndex IN "
+                  "(SELECT EnvironmentPeriodIndex FROM EnvironmentPeriods WHERE EnvironmentType = 3)")
+
+    def __init__(self, sqlfile, esofile, esokeys):
+        self.sqlfile, self.esofile, self.esokeys, self.cols = sqlfile, esofile, esokeys, {}
+        self.conn = sqlite3.connect(sqlfile)
+        try:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS vi_rdindex ON ReportData (ReportDataDictionaryIndex, TimeIndex)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS vi_rddindex ON ReportDataDictionary (KeyValue, Name, ReportingFrequency)")
+            self.conn.commit()
+        except sqlite3.OperationalError:
+            # A read only or locked output file; the queries still work, just unindexed
+            pass
+        times = numpy.array(self.conn.execute("SELECT t.Month, t.Day, t.Hour, t.SimulationDays FROM Time t WHERE {} ORDER BY t.TimeIndex".format(self.timefilter)).fetchall(), dtype = int).reshape(-1, 4)
+        self.cols['Month'], self.cols['Day'], self.cols['Hour'], self.cols['dos'] = [times[:, c] for c in range(4)]
+
+    def __getitem__(self, rid):
+        if rid not in self.cols:
+            self.cols[rid] = numpy.array(self.conn.execute("SELECT rd.Value FROM ReportData rd JOIN ReportDataDictionary rdd ON rd.ReportDataDictionaryIndex = rdd.ReportDataDictionaryIndex "
+                                        "JOIN Time t ON rd.TimeIndex = t.TimeIndex WHERE rdd.KeyValue = ? AND rdd.Name = ? AND rdd.ReportingFrequency = 'Hourly' AND {} "
+                                        "ORDER BY rd.TimeIndex".format(self.timefilter), self.esokeys[rid]).fetchall(), dtype = float).reshape(-1)
+        return self.cols[rid]
+
+    def __contains__(self, rid):
+        return rid in self.esokeys or rid in ('Month', 'Day', 'Hour', 'dos')
+
+    def keys(self):
+        return list(self.esokeys.keys()) + ['Month', 'Day', 'Hour', 'dos']
+
+    def fresh(self, esofile):
+        return self.esofile == esofile and os.path.isfile(self.sqlfile) and os.path.isfile(esofile) and os.path.getmtime(self.sqlfile) >= os.path.getmtime(esofile)
+
+class esotail(object):
+    # Incremental ESO reader. Each read parses only the bytes appended since the last one, so a running simulation can be
+    # followed cheaply, and keeps the hourly data in growing numpy columns that are complete once the run has finished
+    def __init__(self, esofile):
+        self.esofile, self.offset, self.rem, self.header, self.hdone, self.hourly, self.dos, self.day, self.row, self.cap = esofile, 0, b'', [], 0, [], '', 0, -1, 8760
+        self.times, self.cols = numpy.zeros((self.cap, 4), dtype = int), {}
+
+    def read(self, data = 1):
+        if not os.path.isfile(self.esofile):
+            return self.day
+        elif os.path.getsize(self.esofile) < self.offset:
+            self.__init__(self.esofile)
+        with open(self.esofile, 'rb') as resfile:
+            resfile.seek(self.offset)
+            while 1:
+                chunk = resfile.read(4194304)
+                if not chunk:
+                    break
+                self.offset += len(chunk)
+                lines = (self.rem + chunk).split(b'\n')
+                self.rem = lines.pop()
+                for line in lines:
+                    if not self.hdone:
+                        self.hdone = self.parsehead(line.decode().strip('\r').split(','))
+                    elif not data:
+                        return self.day
+                    else:
+                        self.parsedata(line.decode().split(',', 1))
+        return self.day
+
+    def parsehead(self, linesplit):
+        if len(linesplit) > 1:
+            self.header.append(linesplit)
+            return 0
+        self.hourly = [ls[0] for ls in self.header if ls[1] == '1' and '!Hourly' in ls[-1]]
+        self.dos = ([ls[0] for ls in self.header if len(ls) > 3 and ls[2] == 'Day of Simulation[]'] or [''])[0]
+        self.cols = {rid: numpy.zeros(self.cap) for rid in self.hourly}
+        return 1
+
+    def parsedata(self, linesplit):
+        # Data blocks: one timestamp line (report id dos) followed by a value line per reported variable
+        if linesplit[0] == self.dos:
+            self.row += 1
+            if self.row == self.cap:
+                self.times, self.cols, self.cap = numpy.vstack((self.times, numpy.zeros((self.cap, 4), dtype = int))), {rid: numpy.append(self.cols[rid], numpy.zeros(self.cap)) for rid in self.cols}, self.cap * 2
+            tsplit = linesplit[1].split(',')
+            self.times[self.row], self.day = (tsplit[1], tsplit[2], tsplit[4], tsplit[0]), int(tsplit[0])
+        elif linesplit[0] in self.cols:
+            self.cols[linesplit[0]][self.row] = float(linesplit[1])
+
+    def columns(self):
+        allresdict = {rid: self.cols[rid][:self.row + 1] for rid in self.cols}
+        allresdict['Month'], allresdict['Day'], allresdict['Hour'], allresdict['dos'] = [self.times[:self.row + 1, c] for c in range(4)]
+        return allresdict
+
+def resstoredir(esofile):
+    return os.path.splitext(esofile)[0] + '-store'
+
+def resstorewrite(esofile, allresdict, runid = ''):
+    storedir = resstoredir(esofile)
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir)
+    for rid in allresdict:
+        numpy.save(os.path.join(storedir, '{}.npy'.format(rid)), allresdict[rid])
+    with open(os.path.join(storedir, 'index.json'), 'w') as indexfile:
+        json.dump({'columns': list(allresdict.keys()), 'rows': len(allresdict['Hour']), 'eso': esofile, 'esomtime': os.path.getmtime(esofile), 'run': runid}, indexfile)
+    return enresstore(storedir)
+
+def retenres(node):
+    # Result columns of a results node. EPW locations keep theirs on the node, ESO results come from the results store,
+    # which is only rebuilt from the ESO file if it is missing or older than the ESO file
+    if node.get('allresdict'):
+        return node['allresdict']
+    if node['nodeid'] not in enresarrays or not enresarrays[node['nodeid']].fresh(node.resfilename):
+        if os.path.isfile(os.path.join(resstoredir(node.resfilename), 'index.json')) and enresstore(resstoredir(node.resfilename)).fresh(node.resfilename):
+            enresarrays[node['nodeid']] = enresstore(resstoredir(node.resfilename))
+        else:
+            processf(None, node)
+    return enresarrays[node['nodeid']]
+
+def esoread(esofile, resid, runid = '', tail = None):
     rtypes, ctypes, ztypes, zrtypes, ltypes, lrtypes, entypes, enrtypes = [], [], [], [], [], [], [], []
 
     envdict = {'Site Outdoor Air Drybulb Temperature [C] !Hourly': "Temperature ("+ u'\u00b0'+"C)",
@@ -261,110 +404,112 @@ def processf(pro_op, node):
     lresdict = {'AFN Linkage Node 1 to Node 2 Volume Flow Rate [m3/s] !Hourly': 'Linkage Flow out',
                 'AFN Linkage Node 2 to Node 1 Volume Flow Rate [m3/s] !Hourly': 'Linkage Flow in',
                 'AFN Surface Venting Window or Door Opening Factor [] !Hourly': 'Opening Factor'}
-    resdict = {}
-    allresdict = {}
-    objlist = []
-    
-    with open(node.resfilename, 'r') as resfile:
-        intro = 1    
-        for line in resfile.readlines():
-            linesplit = line.strip('\n').split(',')
-            if intro:
-                if len(linesplit) == 1:
-                    intro = 0
-                elif linesplit[1] == '1' and '!Hourly' in linesplit[-1]:
-                    if linesplit[3] in zresdict and linesplit[2][-10:] == '_OCCUPANCY' and linesplit[2].strip('_OCCUPANCY') not in objlist and 'ExtNode' not in linesplit[2]:
-                        objlist.append(linesplit[2].strip('_OCCUPANCY'))
-                    elif linesplit[3] in zresdict and linesplit[2][-4:] == '_AIR' and linesplit[2].strip('_AIR') not in objlist and 'ExtNode' not in linesplit[2]:
-                        objlist.append(linesplit[2].strip('_AIR'))
-                    elif linesplit[3] in zresdict and linesplit[2] not in objlist and 'ExtNode' not in linesplit[2]:
-                        objlist.append(linesplit[2])
-                    allresdict[linesplit[0]] = []
-            elif not intro and len(linesplit) == 2:
-                allresdict[linesplit[0]].append(float(linesplit[1]))
-            if linesplit[0] in resdict:
-                if linesplit[0] == dos:
-                    allresdict['Month'].append(int(linesplit[2]))
-                    allresdict['Day'].append(int(linesplit[3]))
-                    allresdict['Hour'].append(int(linesplit[5]))
-                    allresdict['dos'].append(int(linesplit[1]))
-                        
-            elif len(linesplit) > 3 and linesplit[2] == 'Day of Simulation[]':
-                resdict[linesplit[0]], allresdict['Month'],  allresdict['Day'], allresdict['Hour'], allresdict['dos'], dos, node['rtypes'] = ['Day of Simulation'], [], [], [], [], linesplit[0], ['Time']
-    
-            elif len(linesplit) > 3 and linesplit[2] == 'Environment':
-                if 'Climate' not in node['rtypes']:
-                    node['rtypes']+= ['Climate']
-                try:
-                    resdict[linesplit[0]] = ['Climate', envdict[linesplit[3]]]
-                    ctypes.append(envdict[linesplit[3]])
-                except:
-                    pass
-    
-            elif len(linesplit) > 3 and linesplit[2][-10:] == '_OCCUPANCY' and linesplit[2][:-10] in objlist:
-                if 'Zone' not in node['rtypes']:
-                   node['rtypes'] += ['Zone']
-                try:
-                    resdict[linesplit[0]] = [linesplit[2][:-10], zresdict[linesplit[3]]]
-                    if linesplit[2][:-10] not in ztypes:
-                        ztypes.append(linesplit[2][:-10])
-                    if zresdict[linesplit[3]] not in zrtypes:
-                        zrtypes.append(zresdict[linesplit[3]])
-                except:
-                    pass
-            
-            elif len(linesplit) > 3 and linesplit[2][-4:] == '_AIR' and linesplit[2][:-4] in objlist:
-                if 'Zone' not in node['rtypes']:
-                   node['rtypes'] += ['Zone']
-                try:
-                    resdict[linesplit[0]] = [linesplit[2][:-4], zresdict[linesplit[3]]]
-                    if linesplit[2][:-4] not in ztypes:
-                        ztypes.append(linesplit[2][:-4])
-                    if zresdict[linesplit[3]] not in zrtypes:
-                        zrtypes.append(zresdict[linesplit[3]])
-                except:
-                    pass
-            
-            elif len(linesplit) > 3 and linesplit[2] in objlist:
-                if 'Zone' not in node['rtypes']:
-                   node['rtypes'] += ['Zone']
-                try:
-                    resdict[linesplit[0]] = [linesplit[2], zresdict[linesplit[3]]]
-                    if linesplit[2] not in ztypes:
-                        ztypes.append(linesplit[2])
-                    if zresdict[linesplit[3]] not in zrtypes:
-                        zrtypes.append(zresdict[linesplit[3]])
-                except:
-                    pass
-            
-            elif len(linesplit) > 3 and linesplit[3] in lresdict:
-                if 'Linkage' not in node['rtypes']:
-                   node['rtypes'] += ['Linkage']
-                try:
-                    resdict[linesplit[0]] = [linesplit[2], lresdict[linesplit[3]]]
-                    if linesplit[2] not in ltypes:
-                        ltypes.append(linesplit[2])
-                    if lresdict[linesplit[3]] not in lrtypes:
-                        lrtypes.append(lresdict[linesplit[3]])
-                except:
-                    pass
-            
-            elif len(linesplit) > 3 and linesplit[3] in enresdict:
-                if 'External node' not in node['rtypes']:
-                   node['rtypes'] += ['External node']
-                try:
-                    resdict[linesplit[0]] = [linesplit[2], enresdict[linesplit[3]]]
-                    if linesplit[2] not in entypes:
-                        entypes.append(linesplit[2])
-                    if enresdict[linesplit[3]] not in enrtypes:
-                        enrtypes.append(enresdict[linesplit[3]])
-                except Exception as e:
-                    print('ext', e)
-            
-    node.dsdoy = datetime.datetime(datetime.datetime.now().year, allresdict['Month'][0], allresdict['Day'][0]).timetuple().tm_yday
-    node.dedoy = datetime.datetime(datetime.datetime.now().year, allresdict['Month'][-1], allresdict['Day'][-1]).timetuple().tm_yday
+    resdict, objlist, dos = {}, [], ''
+
+    # The ESO data is only parsed (or, after an esotail has followed the running simulation, only its remainder) if
+    # there is no SQLite output at least as new as the ESO file to query per series instead
+    sqlfile = os.path.splitext(esofile)[0] + '.sql'
+    usesql = os.path.isfile(sqlfile) and os.path.getmtime(sqlfile) >= os.path.getmtime(esofile)
+    tail = tail or esotail(esofile)
+    tail.esofile = esofile
+    tail.read(data = not usesql)
+    header = tail.header
+
+    hourly = [linesplit[0] for linesplit in header if linesplit[1] == '1' and '!Hourly' in linesplit[-1]]
+    for linesplit in [linesplit for linesplit in header if linesplit[0] in hourly]:
+        if linesplit[3] in zresdict and linesplit[2][-10:] == '_OCCUPANCY' and linesplit[2].strip('_OCCUPANCY') not in objlist and 'ExtNode' not in linesplit[2]:
+            objlist.append(linesplit[2].strip('_OCCUPANCY'))
+        elif linesplit[3] in zresdict and linesplit[2][-4:] == '_AIR' and linesplit[2].strip('_AIR') not in objlist and 'ExtNode' not in linesplit[2]:
+            objlist.append(linesplit[2].strip('_AIR'))
+        elif linesplit[3] in zresdict and linesplit[2] not in objlist and 'ExtNode' not in linesplit[2]:
+            objlist.append(linesplit[2])
+
+    for linesplit in header:
+        if len(linesplit) > 3 and linesplit[2] == 'Day of Simulation[]':
+            resdict[linesplit[0]], dos, rtypes = ['Day of Simulation'], linesplit[0], ['Time']
+
+        elif len(linesplit) > 3 and linesplit[2] == 'Environment':
+            if 'Climate' not in rtypes:
+                rtypes+= ['Climate']
+            try:
+                resdict[linesplit[0]] = ['Climate', envdict[linesplit[3]]]
+                ctypes.append(envdict[linesplit[3]])
+            except:
+                pass
+
+        elif len(linesplit) > 3 and linesplit[2][-10:] == '_OCCUPANCY' and linesplit[2][:-10] in objlist:
+            if 'Zone' not in rtypes:
+               rtypes += ['Zone']
+            try:
+                resdict[linesplit[0]] = [linesplit[2][:-10], zresdict[linesplit[3]]]
+                if linesplit[2][:-10] not in ztypes:
+                    ztypes.append(linesplit[2][:-10])
+                if zresdict[linesplit[3]] not in zrtypes:
+                    zrtypes.append(zresdict[linesplit[3]])
+            except:
+                pass
+        
+        elif len(linesplit) > 3 and linesplit[2][-4:] == '_AIR' and linesplit[2][:-4] in objlist:
+            if 'Zone' not in rtypes:
+               rtypes += ['Zone']
+            try:
+                resdict[linesplit[0]] = [linesplit[2][:-4], zresdict[linesplit[3]]]
+                if linesplit[2][:-4] not in ztypes:
+                    ztypes.append(linesplit[2][:-4])
+                if zresdict[linesplit[3]] not in zrtypes:
+                    zrtypes.append(zresdict[linesplit[3]])
+            except:
+                pass
+        
+        elif len(linesplit) > 3 and linesplit[2] in objlist:
+            if 'Zone' not in rtypes:
+               rtypes += ['Zone']
+            try:
+                resdict[linesplit[0]] = [linesplit[2], zresdict[linesplit[3]]]
+                if linesplit[2] not in ztypes:
+                    ztypes.append(linesplit[2])
+                if zresdict[linesplit[3]] not in zrtypes:
+                    zrtypes.append(zresdict[linesplit[3]])
+            except:
+                pass
+        
+        elif len(linesplit) > 3 and linesplit[3] in lresdict:
+            if 'Linkage' not in rtypes:
+               rtypes += ['Linkage']
+            try:
+                resdict[linesplit[0]] = [linesplit[2], lresdict[linesplit[3]]]
+                if linesplit[2] not in ltypes:
+                    ltypes.append(linesplit[2])
+                if lresdict[linesplit[3]] not in lrtypes:
+                    lrtypes.append(lresdict[linesplit[3]])
+            except:
+                pass
+        
+        elif len(linesplit) > 3 and linesplit[3] in enresdict:
+            if 'External node' not in rtypes:
+               rtypes += ['External node']
+            try:
+                resdict[linesplit[0]] = [linesplit[2], enresdict[linesplit[3]]]
+                if linesplit[2] not in entypes:
+                    entypes.append(linesplit[2])
+                if enresdict[linesplit[3]] not in enrtypes:
+                    enrtypes.append(enresdict[linesplit[3]])
+            except Exception as e:
+                print('ext', e)
+
+    if usesql:
+        allresdict = enresarrays[resid] = ensqlstore(sqlfile, esofile, {linesplit[0]: [linesplit[2], linesplit[3].split(' [')[0]] for linesplit in header if linesplit[0] in hourly})
+    else:
+        allresdict = enresarrays[resid] = resstorewrite(esofile, tail.columns(), runid)
+    return allresdict, resdict, rtypes, dos, objlist, (ctypes, ztypes, zrtypes, ltypes, lrtypes, entypes, enrtypes)
+
+def processf(pro_op, node, tail = None):
+    allresdict, resdict, node['rtypes'], dos, objlist, (ctypes, ztypes, zrtypes, ltypes, lrtypes, entypes, enrtypes) = esoread(node.resfilename, node['nodeid'], tail = tail)
+    node.dsdoy = datetime.datetime(datetime.datetime.now().year, int(allresdict['Month'][0]), int(allresdict['Day'][0])).timetuple().tm_yday
+    node.dedoy = datetime.datetime(datetime.datetime.now().year, int(allresdict['Month'][-1]), int(allresdict['Day'][-1])).timetuple().tm_yday
     node['dos'], node['resdict'], node['ctypes'], node['ztypes'], node['zrtypes'], node['ltypes'], node['lrtypes'], node['entypes'], node['enrtypes'] = dos, resdict, ctypes, ztypes, zrtypes, ltypes, lrtypes, entypes, enrtypes
-    node['allresdict'] = allresdict
+    if node.get('allresdict'):
+        del node['allresdict']
     if node.outputs['Results out'].links:
        node.outputs['Results out'].links[0].to_node.update() 
 
@@ -374,9 +519,9 @@ def processf(pro_op, node):
     for zres in resdict.items():
         for o in bpy.data.objects:
             if ['EN_'+o.name.upper(), 'Zone air heating (W)'] == zres[1]:            
-                o['enviresults']['Zone air heating (kWh)'] = sum(allresdict[zres[0]])*0.001
+                o['enviresults']['Zone air heating (kWh)'] = float(numpy.sum(allresdict[zres[0]]))*0.001
             elif ['EN_'+o.name.upper(), 'Zone air cooling (W)'] == zres[1]:            
-                o['enviresults']['Zone air cooling (kWh)'] = sum(allresdict[zres[0]])*0.001
+                o['enviresults']['Zone air cooling (kWh)'] = float(numpy.sum(allresdict[zres[0]]))*0.001
 
 def iprop(iname, idesc, imin, imax, idef):
     return(IntProperty(name = iname, description = idesc, min = imin, max = imax, default = idef))
@@ -450,6 +595,108 @@ def ceilheight(obj, vertz):
     floor = [min((obj.matrix_world * mesh.vertices[poly.vertices[0]].co)[2], (obj.matrix_world * mesh.vertices[poly.vertices[1]].co)[2], (obj.matrix_world * mesh.vertices[poly.vertices[2]].co)[2]) for poly in mesh.polygons if min((obj.matrix_world * mesh.vertices[poly.vertices[0]].co)[2], (obj.matrix_world * mesh.vertices[poly.vertices[1]].co)[2], (obj.matrix_world * mesh.vertices[poly.vertices[2]].co)[2]) < zmin + 0.1 * (zmax - zmin)]
     return(sum(ceiling)/len(ceiling)-sum(floor)/len(floor))
 
+def shadowgeom(scene):
+    # World space vertices and polygon index arrays of all visible meshes, the occluders for the shadow rays of a frame,
+    # plus transform and mesh hashes and world bounds per object so frames can be compared
+    verts, polys, obinfo = [], [], {}
+    for o in [o for o in scene.objects if o.type == 'MESH' and o.is_visible(scene)]:
+        me = o.to_mesh(scene, True, 'PREVIEW')
+        co, lv, lt = numpy.zeros(len(me.vertices) * 3), numpy.zeros(len(me.loops), dtype = numpy.int32), numpy.zeros(len(me.polygons), dtype = numpy.int32)
+        me.vertices.foreach_get('co', co)
+        me.loops.foreach_get('vertex_index', lv)
+        me.polygons.foreach_get('loop_total', lt)
+        omw = numpy.array(o.matrix_world)
+        polys += numpy.split(lv + sum([len(v) for v in verts]), numpy.cumsum(lt)[:-1]) if len(lt) else []
+        verts.append(co.reshape(-1, 3).dot(omw[:3, :3].T) + omw[:3, 3])
+        if len(co):
+            obinfo[o.name] = (hashlib.md5(omw.tobytes()).hexdigest(), hashlib.md5(co.tobytes() + lv.tobytes() + lt.tobytes()).hexdigest(), verts[-1].min(axis = 0), verts[-1].max(axis = 0))
+        bpy.data.meshes.remove(me)
+    return (numpy.concatenate(verts) if verts else numpy.zeros((0, 3))), polys, obinfo
+
+def shadorigins(o, cpoint, offset):
+    # World space sensor origins, offset along the normals, vertex areas and sensing area of an object at the current frame.
+    # Sensing faces or vertices are taken in element order, as when the result layers were set up
+    bm = bmesh.new()
+    bm.from_mesh(o.data)
+    bm.transform(o.matrix_world)
+    bm.normal_update()
+    obcalcarea = sum([f.calc_area() for f in bm.faces if o.data.materials[f.material_index].mattype == '2'])
+    if cpoint == '0':
+        cpoints = [f for f in bm.faces if o.data.materials[f.material_index].mattype == '2']
+        origins, vareas = [f.calc_center_median() + (offset * f.normal) for f in cpoints], []
+    else:
+        cpoints = [v for v in bm.verts if any([o.data.materials[f.material_index].mattype == '2' for f in v.link_faces])]
+        origins, vareas = [v.co + offset*v.normal for v in cpoints], numpy.array([vertarea(bm, v) for v in cpoints])
+    bm.free()
+    return origins, vareas, obcalcarea
+
+def shadowbvh(verts, polys):
+    return BVHTree.FromPolygons(verts.tolist(), [poly.tolist() for poly in polys])
+
+def shadowtris(verts, polys):
+    # Fan triangulated occluders as one (n, 3, 3) array for the out of process engine
+    tris = [numpy.column_stack((numpy.repeat(poly[0], len(poly) - 2), poly[1:-1], poly[2:])) for poly in polys if len(poly) > 2]
+    return verts[numpy.concatenate(tris)] if tris else numpy.zeros((0, 3, 3))
+
+def sweptbox(origins, direcs, boxes, dist = 10000):
+    # True if any of the boxes can block a ray from the origins along one of the directions. The origins' bounding box swept
+    # along a direction meets a box exactly when the ray from its centre hits that box grown by its half extents
+    if not boxes or not len(origins):
+        return False
+    ocos = numpy.array([origin[:] for origin in origins])
+    centre, half = (ocos.max(axis = 0) + ocos.min(axis = 0))/2, (ocos.max(axis = 0) - ocos.min(axis = 0))/2
+    ds = numpy.array([direc.normalized()[:] for direc in direcs]).reshape(-1, 3)
+    invds = 1/numpy.where(numpy.abs(ds) < 1e-12, 1e-12, ds)
+    for bmin, bmax in boxes:
+        t1, t2 = (bmin - half - centre) * invds, (bmax + half - centre) * invds
+        tmin, tmax = numpy.minimum(t1, t2).max(axis = 1), numpy.maximum(t1, t2).min(axis = 1)
+        if ((tmax >= numpy.maximum(tmin, 0)) & (tmin <= dist)).any():
+            return True
+    return False
+
+def bvhsunlit(bvh, origins, direcs, weights = None, dist = 10000):
+    # Weighted percentage of the sun directions each origin can see without hitting the BVH
+    weights = numpy.ones(len(direcs)) if weights is None else weights
+    lit = numpy.zeros(len(origins))
+    for direc, weight in zip([direc.normalized() for direc in direcs], weights):
+        lit += weight * numpy.array([bvh.ray_cast(origin, direc, dist)[0] is None for origin in origins])
+    return 100 * lit/max(numpy.sum(weights), 1)
+
+def skybins(sps, skybin, mf = 1, res = 10):
+    # Bins sun positions (altitude, azimuth in radians, above the horizon) into sky patches: Reinhart subdivisions of the
+    # Tregenza sky (skybin '1') or bands of res degrees split into near square patches (skybin '2'). Each bin is traced
+    # once along the mean direction of its sun positions and weighted by their number. The mean lies inside the patch, so
+    # no sun position is further from its traced direction than the patch diagonal, at most sqrt(2) * 12/mf or
+    # sqrt(2) * res degrees (the 6/mf degree Reinhart zenith cap is smaller), and the largest angle actually seen is returned
+    alts, azis = numpy.array([sp[0] for sp in sps]), numpy.array([sp[1] for sp in sps]) % (2 * pi)
+    units = numpy.column_stack((-numpy.sin(azis) * numpy.cos(alts), -numpy.cos(azis) * numpy.cos(alts), numpy.sin(alts)))
+    bh = numpy.radians((res, 12/mf)[skybin == '1'])
+    rows = numpy.floor(alts/bh).astype(int)
+    if skybin == '1':
+        caprow = 7 * mf
+        ncols = numpy.array((30, 30, 24, 24, 18, 12, 6))[numpy.minimum(rows//mf, 6)] * mf
+    else:
+        caprow = rows.max() + 1 if len(rows) else 0
+        ncols = numpy.maximum(numpy.round(2 * pi * numpy.cos((rows + 0.5) * bh)/bh), 1).astype(int)
+    cols = numpy.where(rows >= caprow, 0, numpy.floor(azis * ncols/(2 * pi)).astype(int) % ncols)
+    bins, binis = numpy.unique(numpy.minimum(rows, caprow) * 100000 + cols, return_inverse = True)
+    sums = numpy.zeros((len(bins), 3))
+    numpy.add.at(sums, binis, units)
+    bdirecs = sums/numpy.linalg.norm(sums, axis = 1)[:, None]
+    binerr = float(numpy.degrees(numpy.arccos(numpy.clip(numpy.sum(units * bdirecs[binis], axis = 1), -1, 1)).max())) if len(units) else 0
+    return [Vector(bdirec) for bdirec in bdirecs], numpy.bincount(binis).astype(float), binerr
+
+def enginesunlit(scene, shaddir, tris, nproc):
+    # Out of process engine: save the frame's BVH next to the origins and directions already in shaddir, then fan the sun
+    # directions out to nproc python workers that memory map the arrays and return weighted lit counts per origin
+    bvhsave(shaddir, tris)
+    ndirecs, wsum = len(numpy.load(os.path.join(shaddir, 'direcs.npy'), mmap_mode = 'r')), numpy.sum(numpy.load(os.path.join(shaddir, 'weights.npy')))
+    chunks = [chunk for chunk in numpy.array_split(numpy.arange(ndirecs), max(nproc, 1)) if len(chunk)]
+    workers = [Popen([bpy.app.binary_path_python, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vi_shadow.py'), shaddir, str(ci), str(chunk[0]), str(chunk[-1] + 1)]) for ci, chunk in enumerate(chunks)]
+    if any([worker.wait() for worker in workers]):
+        return None
+    return 100 * sum([numpy.load(os.path.join(shaddir, 'lit-{}.npy'.format(ci))) for ci in range(len(chunks))])/max(wsum, 1)
+
 def vertarea(mesh, vert):
     area = 0
     faces = [face for face in vert.link_faces] 
@@ -716,6 +963,41 @@ def drawloop(x1, y1, x2, y2):
     bgl.glVertex2i(x1, y1)
     bgl.glEnd()
 
+class drawcache(object):
+    # Prebuilt 2D overlay. Filled rectangles, outlines and text are collected once and drawn grouped by colour, one glBegin
+    # per group and one blf state change per text style, until the key they were built for changes
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, key):
+        self.key, self.polys, self.loops, self.texts = key, OrderedDict(), OrderedDict(), OrderedDict()
+
+    def poly(self, x1, y1, x2, y2, colour = (1.0, 1.0, 1.0, 0.8)):
+        self.polys.setdefault(tuple(colour), []).append([(int(x), int(y)) for x, y in ((x1, y2), (x2, y2), (x2, y1), (x1, y1))])
+
+    def loop(self, x1, y1, x2, y2, colour = (0.0, 0.0, 0.0, 1.0)):
+        self.loops.setdefault(tuple(colour), []).append([(int(x), int(y)) for x, y in ((x1, y2), (x2, y2), (x2, y2), (x2, y1), (x2, y1), (x1, y1), (x1, y1), (x1, y2))])
+
+    def text(self, text, x, y, size, colour = (0.0, 0.0, 0.0, 1.0)):
+        self.texts.setdefault((tuple(size), tuple(colour)), []).append((int(x), int(y), text))
+
+    def draw(self):
+        bgl.glEnable(bgl.GL_BLEND)
+        for (glmode, prims) in ((bgl.GL_QUADS, self.polys), (bgl.GL_LINES, self.loops)):
+            for colour, shapes in prims.items():
+                bgl.glColor4f(*colour)
+                bgl.glBegin(glmode)
+                [bgl.glVertex2i(*v) for shape in shapes for v in shape]
+                bgl.glEnd()
+        for (size, colour), texts in self.texts.items():
+            blf.size(0, *size)
+            bgl.glColor4f(*colour)
+            for x, y, text in texts:
+                blf.position(0, x, y, 0)
+                blf.draw(0, text)
+        bgl.glLineWidth(1)
+        bgl.glDisable(bgl.GL_BLEND)
+
 def drawfont(text, fi, lencrit, height, x1, y1):
     blf.position(fi, x1, height - y1 - lencrit*26, 0)
     blf.draw(fi, text)
@@ -827,10 +1109,29 @@ def selmesh(sel):
     bpy.ops.object.mode_set(mode = 'OBJECT')
 
 def draw_index(context, leg, mid_x, mid_y, width, height, posis, res):
-    vecs = [mathutils.Vector((vec[0] / vec[3], vec[1] / vec[3], vec[2] / vec[3])) for vec in posis]
-    xs = [int(mid_x + vec[0] * mid_x) for vec in vecs]
-    ys = [int(mid_y + vec[1] * mid_y) for vec in vecs]
-    [(blf.position(0, xs[ri], ys[ri], 0), blf.draw(0, ('{:.1f}', '{:.0f}')[r > 100 or context.scene.resnode == 'VI Sun Path'].format(r))) for ri, r in enumerate(res) if (leg == 1 and (xs[ri] > 120 or ys[ri] < height - 530)) or leg == 0]
+    scene = context.scene
+    posis, res = numpy.array(posis, dtype = float).reshape(-1, 4), numpy.array(res, dtype = float)
+    xs, ys = mid_x + posis[:, 0]/posis[:, 3] * mid_x, mid_y + posis[:, 1]/posis[:, 3] * mid_y
+    if scene.vi_display_rp_bin != '0' and len(res):
+        # One representative per screen cell, so the number of labels drawn is bounded by the screen area
+        reps = binreps(scene, xs, ys, res)
+        xs, ys, res = xs[reps], ys[reps], res[reps]
+    xs, ys, fmt = xs.astype(int), ys.astype(int), ('{:.1f}', '{:.0f}')
+    [(blf.position(0, int(xs[ri]), int(ys[ri]), 0), blf.draw(0, fmt[r > 100 or scene.resnode == 'VI Sun Path'].format(r))) for ri, r in enumerate(res.tolist()) if (leg == 1 and (xs[ri] > 120 or ys[ri] < height - 530)) or leg == 0]
+
+def binreps(scene, xs, ys, res):
+    # Label binning representatives: the maximum, minimum or most central result in each screen cell
+    cell = scene.vi_display_rp_cell
+    keys = (-res, res, numpy.hypot(xs % cell - cell * 0.5, ys % cell - cell * 0.5))[int(scene.vi_display_rp_bin) - 1]
+    return screencells(xs, ys, keys, cell)
+
+def screencells(xs, ys, keys, cell):
+    # Index of the lowest keyed label in each occupied cell of a screen space grid
+    cells = (xs//cell).astype(int) * 100000 + (ys//cell).astype(int)
+    order = numpy.lexsort((keys, cells))
+    first = numpy.ones(len(order), dtype = bool)
+    first[1:] = cells[order][1:] != cells[order][:-1]
+    return order[first]
         
 def edgelen(ob, edge):
     omw = ob.matrix_world
@@ -918,6 +1219,65 @@ def solarPosition(doy, lst, lat, lon):
     azimuth = radToDeg*phi
     return([altitude, azimuth, beta, phi])
 
+def uvsphere(name, segs, rings, radius, mat):
+    me = bpy.data.meshes.new(name)
+    bm = bmesh.new()
+    bmesh.ops.create_uvsphere(bm, u_segments = segs, v_segments = rings, diameter = radius)
+    bm.to_mesh(me)
+    bm.free()
+    me.materials.append(mat)
+    return me
+
+def solarpositions(doys, lsts, lat, lon):
+    # solarPosition over arrays of days and local solar times, returning altitude and azimuth arrays in radians
+    doys, lsts = numpy.asarray(doys, dtype = float), numpy.asarray(lsts, dtype = float)
+    b = 2*pi*(doys-81)/364
+    ast = lsts + (9.87 * numpy.sin(2*b) - 7.53 * numpy.cos(b) - 1.5 * numpy.sin(b))/60 + (round(lon/15, 0)*15 - lon)/15
+    delta = numpy.radians(23.45) * numpy.sin(2*pi*(284+doys)/365)
+    h, l = numpy.radians(15 * (ast-12)), numpy.radians(lat)
+    beta = numpy.arcsin(numpy.clip(cos(l) * numpy.cos(delta) * numpy.cos(h) + sin(l) * numpy.sin(delta), -1, 1))
+    phi = numpy.arccos(numpy.clip((numpy.sin(beta) * sin(l) - numpy.sin(delta))/(numpy.cos(beta) * cos(l)), -1, 1))
+    return beta, numpy.where((ast <= 12) | (ast >= 24), 2*pi - phi, phi)
+
+def horizonruns(pts, closed = 1):
+    # Splits a path of points into its runs above the horizon, each ended by points interpolated onto the horizon
+    above = pts[:, 2] >= 0
+    if above.all():
+        return [(pts, closed)]
+    if closed:
+        start = int(numpy.argmin(above))
+        pts, above = numpy.roll(pts, -start, axis = 0), numpy.roll(above, -start)
+        pts, above = numpy.vstack((pts, pts[:1])), numpy.append(above, above[0])
+    runs, run = [], []
+    for i, pt in enumerate(pts):
+        if above[i]:
+            if not run and i:
+                run.append(pts[i - 1] + (pt - pts[i - 1]) * pts[i - 1][2]/(pts[i - 1][2] - pt[2]))
+            run.append(pt)
+        elif run:
+            runs.append((numpy.array(run + [pts[i - 1] + (pt - pts[i - 1]) * pts[i - 1][2]/(pts[i - 1][2] - pt[2])]), 0))
+            run = []
+    return runs + ([(numpy.array(run), 0)] if len(run) > 1 else [])
+
+def tubemesh(paths, radius, segs = 16):
+    # Tube vertices and quad faces around paths on a sphere about the origin. The rings lie in the plane of the path normal
+    # and the radial direction, so no curve conversion is needed. Returns (n, 3) vertices, (f, 4) faces and faces per path
+    verts, faces, nfaces, vi = [], [], [], 0
+    angs = numpy.linspace(0, 2*pi, segs, endpoint = False)
+    for pts, closed in [(pts, closed) for pts, closed in paths if len(pts) > 1]:
+        tans = (numpy.roll(pts, -1, axis = 0) - numpy.roll(pts, 1, axis = 0)) if closed else numpy.vstack((pts[1] - pts[0], pts[2:] - pts[:-2], pts[-1] - pts[-2]))
+        norms = numpy.cross(tans, pts)
+        norms /= numpy.maximum(numpy.linalg.norm(norms, axis = 1), 1e-9)[:, None]
+        rads = pts/numpy.maximum(numpy.linalg.norm(pts, axis = 1), 1e-9)[:, None]
+        verts.append((pts[:, None] + radius * (numpy.cos(angs)[None, :, None] * norms[:, None] + numpy.sin(angs)[None, :, None] * rads[:, None])).reshape(-1, 3))
+        rings = numpy.arange(len(pts) if closed else len(pts) - 1)
+        i0, j0 = numpy.meshgrid(rings, numpy.arange(segs), indexing = 'ij')
+        i1, j1 = (i0 + 1) % len(pts), (j0 + 1) % segs
+        faces.append(vi + numpy.array((i0 * segs + j0, i0 * segs + j1, i1 * segs + j1, i1 * segs + j0)).transpose(1, 2, 0).reshape(-1, 4))
+        nfaces.append(len(faces[-1]))
+        vi += len(verts[-1])
+    return (numpy.concatenate(verts), numpy.concatenate(faces), nfaces) if verts else (numpy.zeros((0, 3)), numpy.zeros((0, 4), dtype = int), [])
+
 def set_legend(ax):
     l = ax.legend(borderaxespad = -4)
     plt.setp(l.get_texts(), fontsize=8)
@@ -929,6 +1289,37 @@ def wr_axes():
     fig.add_axes(ax)
     return(fig, ax)
 
+def resvals(o, name):
+    # Face values of a result mesh's float layer, per polygon or averaged from the vertices, and the raw layer values
+    me = o.data
+    if me.polygon_layers_float.get(name):
+        vals = numpy.zeros(len(me.polygons))
+        me.polygon_layers_float[name].data.foreach_get('value', vals)
+        return vals, vals
+    vvals, lv = numpy.zeros(len(me.vertices)), numpy.zeros(len(me.loops), dtype = numpy.int32)
+    ls, lt = numpy.zeros(len(me.polygons), dtype = numpy.int32), numpy.zeros(len(me.polygons), dtype = numpy.int32)
+    me.vertex_layers_float[name].data.foreach_get('value', vvals)
+    me.loops.foreach_get('vertex_index', lv)
+    me.polygons.foreach_get('loop_start', ls)
+    me.polygons.foreach_get('loop_total', lt)
+    return numpy.add.reduceat(vvals[lv], ls)/lt, vvals
+
+def resbins(vals, minres, maxres):
+    return numpy.digitize((vals - minres)/(maxres - minres) if maxres > minres else numpy.zeros(len(vals)), [0.05*i for i in range(1, 20)])
+
+def setresmatis(o, frame, matis):
+    # Material indices are stored per frame in an integer polygon layer and swapped in by the frame change handler
+    layer = o.data.polygon_layers_int.get('mi{}'.format(frame)) or o.data.polygon_layers_int.new('mi{}'.format(frame))
+    layer.data.foreach_set('value', numpy.array(matis, dtype = numpy.int32))
+
+def frameresmatis(o, frame):
+    layer = o.data.polygon_layers_int.get('mi{}'.format(frame))
+    if layer:
+        matis = numpy.zeros(len(o.data.polygons), dtype = numpy.int32)
+        layer.data.foreach_get('value', matis)
+        o.data.polygons.foreach_set('material_index', matis)
+        o.data.update()
+
 def skframe(pp, scene, oblist, anim):
     for frame in range(scene.fs, scene.fe + 1):
         scene.frame_set(frame)
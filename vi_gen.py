@@ -1,6 +1,7 @@
 import bpy, mathutils, math
 from .vi_func import clearanim, livisimacc, selobj, gentarget, bres, framerange
 from .livi_export import radgexport
+from .livi_calc import rtpersistend
 
 def vigen(calc_op, li_calc, resapply, geonode, connode, simnode, geogennode, tarnode):
     scene = bpy.context.scene 
@@ -13,6 +14,7 @@ def vigen(calc_op, li_calc, resapply, geonode, connode, simnode, geogennode, tar
         liviom = scene['livim']
             
     clearanim(scene, [bpy.data.objects[on] for on in scene['livim']])    
+    rtpersistend(scene, calc_op)
     scene.frame_set(scene.frame_start)                    
     radgexport(calc_op, geonode, genframe = scene.frame_current)
     res = [li_calc(calc_op, simnode, connode, geonode, livisimacc(simnode, connode), genframe = scene.frame_current)]
@@ -102,6 +104,7 @@ def vigen(calc_op, li_calc, resapply, geonode, connode, simnode, geogennode, tar
                                
     scene.frame_current = scene.frame_start 
     scene['livic'] = livioc      
+    rtpersistend(scene, calc_op)
         
 def modgeo(o, geogennode, scene, fc, fs):            
     if geogennode.geomenu == 'Object':
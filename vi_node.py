@@ -443,10 +443,11 @@ class ViLiSNode(bpy.types.Node, ViNodes):
     bl_icon = 'LAMP'
 
     def nodeupdate(self):
-        nodecolour(self, self['exportstate'] != [str(x) for x in (self.cusacc, self.simacc, self.csimacc)])
+        nodecolour(self, self['exportstate'] != [str(x) for x in (self.cusacc, self.simacc, self.csimacc, self.adaptol)])
 
-    simacc = bpy.props.EnumProperty(items=[("0", "Low", "Low accuracy and high speed (preview)"),("1", "Medium", "Medium speed and accuracy"), ("2", "High", "High but slow accuracy"),("3", "Custom", "Edit Radiance parameters"), ],
-            name="", description="Simulation accuracy", default="0")
+    simacc = bpy.props.EnumProperty(items=[("0", "Low", "Low accuracy and high speed (preview)"),("1", "Medium", "Medium speed and accuracy"), ("2", "High", "High but slow accuracy"),("3", "Custom", "Edit Radiance parameters"),
+            ("4", "Adaptive", "Low accuracy pass with medium and high accuracy refinement of uncertain sensors")], name="", description="Simulation accuracy", default="0")
+    adaptol = bpy.props.FloatProperty(name="", description="Relative sensor uncertainty (%) above which adaptive refinement re-traces a sensor", min=0.1, max=50, default=5)
     csimacc = bpy.props.EnumProperty(items=[("0", "Custom", "Edit Radiance parameters"), ("1", "Initial", "Initial accuracy for this metric"), ("2", "Final", "Final accuracy for this metric")],
             name="", description="Simulation accuracy", default="1")
     cusacc = bpy.props.StringProperty(
@@ -458,6 +459,7 @@ class ViLiSNode(bpy.types.Node, ViNodes):
 
     run = bpy.props.IntProperty(default = 0)
     edit_file = bpy.props.BoolProperty(name = '', default = False)
+    persist = bpy.props.BoolProperty(name = '', description = "Keep a persistent rtrace process between generative steps", default = False)
 
     def init(self, context):
         self['nodeid'] = nodeid(self)
@@ -473,12 +475,16 @@ class ViLiSNode(bpy.types.Node, ViNodes):
         connode = self.connodes()
         if geonode and connode and all([not node.use_custom_color for node in (geonode, connode)]):
             newrow(layout, 'Edit file:', self, 'edit_file')
+            if geonode.inputs['Generative in'].links:
+                newrow(layout, 'Persistent rtrace:', self, 'persist')
             row = layout.row()
             row.label("Accuracy:")
             simdict = {'LiVi Basic': 'simacc', 'LiVi Compliance':'csimacc', 'LiVi CBDM':'csimacc'}
             row.prop(self, simdict[connode.bl_label])
             if (self.simacc == '3' and connode.bl_label == 'LiVi Basic') or (self.csimacc == '0' and connode.bl_label in ('LiVi Compliance', 'LiVi CBDM')):
                newrow(layout, "Radiance parameters:", self, 'cusacc')
+            elif self.simacc == '4' and connode.bl_label == 'LiVi Basic':
+               newrow(layout, "Tolerance (%):", self, 'adaptol')
             if self.run and (connode.bl_label == 'LiVi Basic' and connode.analysismenu == '3'):
                 row = layout.row()
                 row.label('Calculating'+(self.run%10 *'-'))
@@ -507,18 +513,20 @@ class ViLiSNode(bpy.types.Node, ViNodes):
         connode = self.connodes()
         geonode = self.geonodes()
         unitdict = {'LiVi Basic': ("Lux", "W/m"+ u'\u00b2', "DF %", '')[int(connode.analysismenu)], 'LiVi Compliance': 'DF (%)', 'LiVi CBDM': ('kLuxHours', 'kWh', 'DA (%)', '', 'UDI-a (%)')[int(connode.analysismenu)]}
+        sacc = self.simacc if self.simacc != '4' else '0'
         if op == 'LiVi simulation':
             if connode.bl_label == 'LiVi Basic':
-                self['radparams'] = self.cusacc if self.simacc == '3' else (" {0[0]} {1[0]} {0[1]} {1[1]} {0[2]} {1[2]} {0[3]} {1[3]} {0[4]} {1[4]} {0[5]} {1[5]} {0[6]} {1[6]} {0[7]} {1[7]} {0[8]} {1[8]} {0[9]} {1[9]} {0[10]} {1[10]} ".format([n[0] for n in self.rtracebasic], [n[int(self.simacc)+1] for n in self.rtracebasic]))
+                self['radparams'] = self.cusacc if self.simacc == '3' else (" {0[0]} {1[0]} {0[1]} {1[1]} {0[2]} {1[2]} {0[3]} {1[3]} {0[4]} {1[4]} {0[5]} {1[5]} {0[6]} {1[6]} {0[7]} {1[7]} {0[8]} {1[8]} {0[9]} {1[9]} {0[10]} {1[10]} ".format([n[0] for n in self.rtracebasic], [n[int(sacc)+1] for n in self.rtracebasic]))
+                self['adaptparams'] = [" {0[0]} {1[0]} {0[1]} {1[1]} {0[2]} {1[2]} {0[3]} {1[3]} {0[4]} {1[4]} {0[5]} {1[5]} {0[6]} {1[6]} {0[7]} {1[7]} {0[8]} {1[8]} {0[9]} {1[9]} {0[10]} {1[10]} ".format([n[0] for n in self.rtracebasic], [n[acc] for n in self.rtracebasic]) for acc in range(1, 4)]
             else:
                 self['radparams'] = self.cusacc if self.csimacc == '0' else (" {0[0]} {1[0]} {0[1]} {1[1]} {0[2]} {1[2]} {0[3]} {1[3]} {0[4]} {1[4]} {0[5]} {1[5]} {0[6]} {1[6]} {0[7]} {1[7]} {0[8]} {1[8]} {0[9]} {1[9]} {0[10]} {1[10]} ".format([n[0] for n in self.rtraceadvance], [n[int(self.csimacc)] for n in self.rtraceadvance]))
         else:
             if connode.bl_label == 'LiVi Basic':
-                self['radparams'] = self.cusacc if self.simacc == '3' else (" {0[0]} {1[0]} {0[1]} {1[1]} {0[2]} {1[2]} {0[3]} {1[3]}  {0[4]} {1[4]} {0[5]} {1[5]} {0[6]} {1[6]} {0[7]} {1[7]} {0[8]} {1[8]} {0[9]} {1[9]} {0[10]} {1[10]}".format([n[0] for n in self.rvubasic], [n[int(self.simacc)+1] for n in self.rvubasic]))
+                self['radparams'] = self.cusacc if self.simacc == '3' else (" {0[0]} {1[0]} {0[1]} {1[1]} {0[2]} {1[2]} {0[3]} {1[3]}  {0[4]} {1[4]} {0[5]} {1[5]} {0[6]} {1[6]} {0[7]} {1[7]} {0[8]} {1[8]} {0[9]} {1[9]} {0[10]} {1[10]}".format([n[0] for n in self.rvubasic], [n[int(sacc)+1] for n in self.rvubasic]))
             else:
                 self['radparams'] = self.cusacc if self.csimacc == '0' else (" {0[0]} {1[0]} {0[1]} {1[1]} {0[2]} {1[2]} {0[3]} {1[3]} {0[4]} {1[4]} {0[5]} {1[5]} {0[6]} {1[6]} {0[7]} {1[7]} {0[8]} {1[8]} {0[9]} {1[9]} {0[10]} {1[10]}".format([n[0] for n in self.rvuadvance], [n[int(self.csimacc)] for n in self.rvuadvance]))
 
-        self['exportstate'] = [str(x) for x in (self.cusacc, self.simacc, self.csimacc)]
+        self['exportstate'] = [str(x) for x in (self.cusacc, self.simacc, self.csimacc, self.adaptol)]
         bpy.context.scene['liparams']['unit'], bpy.context.scene['liparams']['type'] =  unitdict[connode.bl_label], connode.bl_label
         nodecolour(self, 0)
         return connode, geonode
@@ -549,7 +557,7 @@ class ViSSNode(bpy.types.Node, ViNodes):
     bl_icon = 'LAMP'
 
     def nodeupdate(self, context):
-        nodecolour(self, self['exportstate'] != [str(x) for x in (self.animmenu, self.startmonth, self.endmonth, self.starthour, self.endhour, self.interval, self.cpoint, self.offset)])
+        nodecolour(self, self['exportstate'] != [str(x) for x in (self.animmenu, self.startmonth, self.endmonth, self.starthour, self.endhour, self.interval, self.cpoint, self.offset, self.skybin, self.skymf, self.skyres)])
 
     animtype = [('Static', "Static", "Simple static analysis"), ('Geometry', "Geometry", "Animated geometry analysis")]
     animmenu = bpy.props.EnumProperty(name="", description="Animation type", items=animtype, default = 'Static', update = nodeupdate)
@@ -561,6 +569,12 @@ class ViSSNode(bpy.types.Node, ViNodes):
     cpoint = bpy.props.EnumProperty(items=[("0", "Faces", "Export faces for calculation points"),("1", "Vertices", "Export vertices for calculation points"), ],
             name="", description="Specify the calculation point geometry", default="0", update = nodeupdate)
     offset = bpy.props.FloatProperty(name="", description="Calc point offset", min=0.001, max=1, default=0.01, update = nodeupdate)
+    engine = bpy.props.EnumProperty(items=[("0", "Blender", "Cast rays in Blender against a BVH of each frame"),("1", "Parallel", "Cast rays in parallel worker processes"), ],
+            name="", description="Specify the ray casting engine", default="0")
+    skybin = bpy.props.EnumProperty(items=[("0", "None", "Trace every sun position"),("1", "Reinhart", "Bin sun positions into Reinhart sky patches"), ("2", "Angular", "Bin sun positions into sky patches of a set angular size")],
+            name="", description="Specify the sky patch binning of sun positions", default="0", update = nodeupdate)
+    skymf = bpy.props.IntProperty(name = '', default = 2, min = 1, max = 12, description = 'Reinhart subdivision factor', update = nodeupdate)
+    skyres = bpy.props.FloatProperty(name = '', default = 5, min = 0.5, max = 30, description = 'Sky patch size (degrees)', update = nodeupdate)
 
     def init(self, context):
         self['nodeid'] = nodeid(self)
@@ -578,12 +592,18 @@ class ViSSNode(bpy.types.Node, ViNodes):
             newrow(layout, 'Interval:', self, "interval")
             newrow(layout, 'Result point:', self, "cpoint")
             newrow(layout, 'Offset:', self, 'offset')
+            newrow(layout, 'Engine:', self, 'engine')
+            newrow(layout, 'Sky bins:', self, 'skybin')
+            if self.skybin == '1':
+                newrow(layout, 'Subdivisions:', self, 'skymf')
+            elif self.skybin == '2':
+                newrow(layout, 'Patch size:', self, 'skyres')
             row = layout.row()
             row.operator("node.shad", text = 'Calculate').nodeid = self['nodeid']
 
     def export(self, scene):
         nodecolour(self, 0)
-        self['exportstate'] = [str(x) for x in (self.animmenu, self.startmonth, self.endmonth, self.starthour, self.endhour, self.interval, self.cpoint, self.offset)]
+        self['exportstate'] = [str(x) for x in (self.animmenu, self.startmonth, self.endmonth, self.starthour, self.endhour, self.interval, self.cpoint, self.offset, self.skybin, self.skymf, self.skyres)]
         self['minres'], self['maxres'], self['avres'] = {}, {}, {}
 
 class ViWRNode(bpy.types.Node, ViNodes):
@@ -662,9 +682,10 @@ class ViExEnNode(bpy.types.Node, ViNodes):
     bl_icon = 'LAMP'
 
     def nodeupdate(self, context):
-        nodecolour(self, self['exportstate'] != [str(x) for x in (self.loc, self.terrain, self.timesteps)])
+        nodecolour(self, self['exportstate'] != [str(x) for x in (self.loc, self.terrain, self.timesteps, self.sqlite)])
 
     loc = bpy.props.StringProperty(name="", description="Identifier for this project", default="", update = nodeupdate)
+    sqlite = bpy.props.BoolProperty(name="", description="Also write results to an SQLite database for faster results retrieval", default=False, update = nodeupdate)
     terrain = bpy.props.EnumProperty(items=[("0", "City", "Towns, city outskirts, centre of large cities"),
                    ("1", "Urban", "Urban, Industrial, Forest"),("2", "Suburbs", "Rough, Wooded Country, Suburbs"),
                     ("3", "Country", "Flat, Open Country"),("4", "Ocean", "Ocean, very flat country")],
@@ -711,6 +732,7 @@ class ViExEnNode(bpy.types.Node, ViNodes):
         newrow(layout, 'Start month:', self, "startmonth")
         newrow(layout, 'End month:', self, "endmonth")
         newrow(layout, 'Time-steps/hour', self, "timesteps")
+        newrow(layout, 'SQLite output:', self, "sqlite")
         row = layout.row()
         row.label(text = 'Results Category:')
         col = row.column()
@@ -731,7 +753,7 @@ class ViExEnNode(bpy.types.Node, ViNodes):
 
     def export(self):
         nodecolour(self, 0)
-        self['exportstate'] = [str(x) for x in (self.loc, self.terrain, self.timesteps)]
+        self['exportstate'] = [str(x) for x in (self.loc, self.terrain, self.timesteps, self.sqlite)]
 
 class ViEnSimNode(bpy.types.Node, ViNodes):
     '''Node describing an EnergyPlus simulation'''
@@ -755,6 +777,11 @@ class ViEnSimNode(bpy.types.Node, ViNodes):
     resname = bpy.props.StringProperty(name="", description="Base name for the results files", default="results", update = nodeupdate)
     resfilename = bpy.props.StringProperty(name = "", default = 'results')
     dsdoy, dedoy, run  = bpy.props.IntProperty(), bpy.props.IntProperty(), bpy.props.IntProperty(min = -1, default = -1)
+    batchdir = bpy.props.StringProperty(name = "", description = "Directory of IDF variants (with optional same named EPW files) for a batch run", default = "", subtype = 'DIR_PATH')
+    batchnum = bpy.props.IntProperty(name = "", description = "Number of concurrent batch runs (0 for one per processor)", min = 0, max = 256, default = 0)
+    shards = bpy.props.IntProperty(name = "", description = "Number of parallel sub-periods the run period is split into", min = 1, max = 64, default = 1)
+    shardlead = bpy.props.IntProperty(name = "", description = "Days of real weather simulated and discarded before each sub-period", min = 0, max = 60, default = 7)
+    shardcheck = bpy.props.BoolProperty(name = "", description = "Also run the full period and report the error at the sub-period seams", default = False)
 
     def draw_buttons(self, context, layout):
         if self.run > -1:
@@ -762,8 +789,17 @@ class ViEnSimNode(bpy.types.Node, ViNodes):
             row.label('Calculating {}%'.format(self.run))
         elif self.inputs['Context in'].links and not self.inputs['Context in'].links[0].from_node.use_custom_color:
             newrow(layout, 'Results name:', self, 'resname')
+            newrow(layout, 'Shards:', self, 'shards')
+            if self.shards > 1:
+                newrow(layout, 'Lead-in days:', self, 'shardlead')
+                newrow(layout, 'Seam check:', self, 'shardcheck')
             row = layout.row()
             row.operator("node.ensim", text = 'Calculate').nodeid = self['nodeid']
+            newrow(layout, 'Batch directory:', self, 'batchdir')
+            if self.batchdir:
+                newrow(layout, 'Concurrent runs:', self, 'batchnum')
+                row = layout.row()
+                row.operator("node.ensimbatch", text = 'Batch').nodeid = self['nodeid']
 
     def update(self):
         if self.outputs.get('Results out'):
@@ -1,4 +1,4 @@
-import bpy, bpy_extras, sys, datetime, mathutils, os, time, bmesh, shutil
+import bpy, bpy_extras, sys, datetime, mathutils, os, time, bmesh, shutil, numpy
 from os import rename
 from numpy import max as nmax
 from numpy import arange, histogram
@@ -18,12 +18,13 @@ try:
 except:
     mp = 0
 
-from .livi_export import radcexport, radgexport, cyfc1, createoconv, createradfile
+from .livi_export import radcexport, radgexport, cyfc1, cyfcprep, createoconv, createoconvs, createradfile
 from .livi_calc  import li_calc, resapply
 from .vi_display import li_display, li_compliance, linumdisplay, spnumdisplay, li3D_legend, viwr_legend
 from .envi_export import enpolymatexport, pregeo
+from .envi_calc import batchvariants, batchstart, batchcollect, eplusfailed, batchsummary, shardstart, shardstitch, seamerror, simhash
 from .envi_mat import envi_materials, envi_constructions
-from .vi_func import processf, livisimacc, solarPosition, wr_axes, clearscene, framerange, viparams, objmode, nodecolour, cmap, vertarea, wind_rose, windnum, compass
+from .vi_func import processf, retenres, esotail, shadowgeom, shadorigins, shadowbvh, shadowtris, sweptbox, bvhsunlit, enginesunlit, skybins, livisimacc, solarPosition, solarpositions, horizonruns, tubemesh, uvsphere, wr_axes, clearscene, framerange, viparams, objmode, nodecolour, cmap, wind_rose, windnum, compass
 from .vi_chart import chart_disp
 from .vi_gen import vigen
 
@@ -210,6 +211,8 @@ class NODE_OT_RadPreview(bpy.types.Operator, io_utils.ExportHelper):
         objmode()
         simnode, frame = bpy.data.node_groups[self.nodeid.split('@')[1]].nodes[self.nodeid.split('@')[0]], scene.frame_current
         connode, geonode =  simnode.export(self.bl_label) 
+        if simnode.simacc == '4' and connode.bl_label == 'LiVi Basic':
+            self.report({'WARNING'}, "The preview ignores the adaptive accuracy setting and uses low accuracy")
         if frame not in range(scene.fs, scene.fe + 1):
             self.report({'ERROR'}, "Current frame is not within the exported frame range")
             return {'CANCELLED'}
@@ -304,6 +307,8 @@ class NODE_OT_LiVIGlare(bpy.types.Operator):
         if self.cam:
             self.simnode = bpy.data.node_groups[self.nodeid.split('@')[1]].nodes[self.nodeid.split('@')[0]]
             self.connode, self.geonode = self.simnode.export(self.bl_label)
+            if self.simnode.simacc == '4' and self.connode.bl_label == 'LiVi Basic':
+                self.report({'WARNING'}, "Glare analysis ignores the adaptive accuracy setting and uses low accuracy")
             self.frame = self.scene.fs
             for frame in range(self.scene.fs, self.scene.fe + 1):
                 if not self.simnode.edit_file:
@@ -311,7 +316,7 @@ class NODE_OT_LiVIGlare(bpy.types.Operator):
                 elif not os.path.isfile(os.path.join(self.scene['viparams']['newdir'], self.scene['viparams']['filename']+'-{}.rad'.format(frame))):
                     self.report({'ERROR'}, "There is no saved radiance input file. Turn off the edit file option")
                     return {'CANCELLED'}
-                createoconv(self.scene, frame, self)
+            createoconvs(self.scene, range(self.scene.fs, self.scene.fe + 1), self)
 
             rpictcmd = "rpict -w -vth -vh 180 -vv 180 -x 800 -y 800 -vd {0[0][2]} {0[1][2]} {0[2][2]} -vp {1[0]} {1[1]} {1[2]} {2} {3}-{4}.oct | evalglare -c {5}".format(-1*self.cam.matrix_world, self.cam.location, self.simnode['radparams'], self.scene['viparams']['filebase'], self.frame, os.path.join(self.scene['viparams']['newdir'], 'glare{}.hdr'.format(self.frame)))               
             self.egrun = Popen(rpictcmd, shell = True, stdout=PIPE)
@@ -343,7 +348,7 @@ class NODE_OT_LiViCalc(bpy.types.Operator):
             elif not os.path.isfile(os.path.join(scene['viparams']['newdir'], scene['viparams']['filename']+'-{}.rad'.format(frame))):
                 self.report({'ERROR'}, "There is no saved radiance input file. Turn off the edit file option")
                 return {'CANCELLED'}
-            createoconv(scene, frame, self)
+        createoconvs(scene, range(scene.fs, scene.fe + 1), self)
        
         if connode.bl_label == 'LiVi Basic':
             geogennode = geonode.inputs['Generative in'].links[0].from_node if geonode.inputs['Generative in'].links else 0
@@ -586,7 +591,8 @@ class NODE_OT_CSVExport(bpy.types.Operator, io_utils.ExportHelper):
     def execute(self, context):
         resnode = bpy.data.node_groups[self.nodeid.split('@')[1]].nodes[self.nodeid.split('@')[0]].inputs['Results in'].links[0].from_node
         resstring = ' '.join(['Month,', 'Day,', 'Hour,'] + ['{} {},'.format(resnode['resdict'][k][0], resnode['resdict'][k][1]) for k in sorted(resnode['resdict'].keys(), key=lambda x: float(x)) if len(resnode['resdict'][k]) == 2] + ['\n'])
-        resdata = [resnode['allresdict']['Month'], resnode['allresdict']['Day'], resnode['allresdict']['Hour']] + [list(resnode['allresdict'][k]) for k in sorted(resnode['resdict'].keys(), key=lambda x: float(x)) if k in resnode['allresdict']]
+        allresdict = retenres(resnode)
+        resdata = [allresdict['Month'], allresdict['Day'], allresdict['Hour']] + [list(allresdict[k]) for k in sorted(resnode['resdict'].keys(), key=lambda x: float(x)) if k in allresdict]
         for rline in zip(*resdata):
             for r in rline:
                 resstring += '{:.3f},'.format(r)
@@ -658,19 +664,16 @@ class NODE_OT_EnSim(bpy.types.Operator):
     nodeid = bpy.props.StringProperty()
     
     def modal(self, context, event):
-        if event.type == 'TIMER':
+        if event.type == 'TIMER' and self.shards:
+            return self.shardmodal(context)
+        elif event.type == 'TIMER':
             scene = context.scene
             if self.esimrun.poll() is None:
                 nodecolour(self.simnode, 1)
-                try:
-                    with open(os.path.join(scene['viparams']['newdir'], 'eplusout.eso'), 'r') as resfile: 
-                        for resline in [line for line in resfile.readlines()[::-1] if line.split(',')[0] == '2' and len(line.split(',')) == 9]: 
-                            self.simnode.run = int(100 * int(resline.split(',')[1])/(self.simnode.dedoy - self.simnode.dsdoy))
-                            break
-                    return {'PASS_THROUGH'}
-                except:
-                    return {'PASS_THROUGH'} 
+                self.simnode.run = int(100 * self.esotail.read()/max(self.simnode.dedoy - self.simnode.dsdoy, 1))
+                return {'PASS_THROUGH'}
             else:
+                self.esotail.read()
                 for fname in [fname for fname in os.listdir('.') if fname.split(".")[0] == self.simnode.resname]:                
                     os.remove(os.path.join(scene['viparams']['newdir'], fname))
                 
@@ -688,32 +691,123 @@ class NODE_OT_EnSim(bpy.types.Operator):
                     return {'CANCELLED'}
                 else: 
                     nodecolour(self.simnode, 0)
-                    processf(self, self.simnode)
+                    processf(self, self.simnode, tail = self.esotail)
+                    self.simnode['simhash'] = self.simhash
                     self.report({'INFO'}, "Calculation is finished.") 
                     scene.vi_display, scene.sp_disp_panel, scene.li_disp_panel, scene.lic_disp_panel, scene.en_disp_panel, scene.ss_disp_panel, scene.wr_disp_panel = 0, 0, 0, 0, 0, 0, 0                    
                     self.simnode.run = -1
                     return {'FINISHED'}                
         else:
             return {'PASS_THROUGH'}
-            
+
+    def shardmodal(self, context):
+        scene = context.scene
+        runs = [shard[0] for shard in self.shards] + ([self.refrun[0]], [])[self.refrun is None]
+        if [run for run in runs if run.poll() is None]:
+            nodecolour(self.simnode, 1)
+            self.simnode.run = int(100 * len([run for run in runs if run.poll() is not None])/len(runs))
+            return {'PASS_THROUGH'}
+        self.simnode.run = -1
+        if [shard for shard in self.shards if eplusfailed(shard[1])]:
+            self.report({'ERROR'}, "A shard failed. Check the eplusout.err files in the {}-shards folder.".format(self.simnode.resname))
+            return {'CANCELLED'}
+        seams = shardstitch(scene, self.simnode, self.shards)
+        if self.simnode.resname+".err" in bpy.data.texts:
+            bpy.data.texts.remove(bpy.data.texts[self.simnode.resname+".err"])
+        bpy.data.texts.load(os.path.join(scene['viparams']['newdir'], self.simnode.resname+".err"))
+        nodecolour(self.simnode, 0)
+        processf(self, self.simnode)
+        self.simnode['simhash'] = self.simhash
+        scene.vi_display, scene.sp_disp_panel, scene.li_disp_panel, scene.lic_disp_panel, scene.en_disp_panel, scene.ss_disp_panel, scene.wr_disp_panel = 0, 0, 0, 0, 0, 0, 0
+        if self.refrun and not eplusfailed(self.refrun[1]):
+            errs = seamerror(self.simnode, seams, self.refrun[1])
+            self.simnode['seamerror'] = errs
+            self.report({'INFO'}, "Calculation is finished. Seam error (max over the day after each seam): {}".format(', '.join(['{} {:.3f}'.format(*err) for err in sorted(errs.items())]) or 'reference run does not match'))
+        else:
+            self.report({'INFO'}, "Calculation is finished ({} shards).".format(len(self.shards)))
+        return {'FINISHED'}
+
     def invoke(self, context, event):
         scene = context.scene
         if viparams(self, scene):
             return {'CANCELLED'}
         context.scene['visimcontext'] = 'EnVi'
-        wm = context.window_manager
-        self._timer = wm.event_timer_add(1, context.window)
-        wm.modal_handler_add(self)
         self.simnode = bpy.data.node_groups[self.nodeid.split('@')[1]].nodes[self.nodeid.split('@')[0]]
         self.simnode.sim()
         self.connode = self.simnode.inputs['Context in'].links[0].from_node
         self.simnode.resfilename = os.path.join(scene['viparams']['newdir'], self.simnode.resname+'.eso')
+        self.simhash = simhash(scene, self.simnode)
+        if self.simnode.get('simhash') == self.simhash and os.path.isfile(self.simnode.resfilename):
+            self.report({'INFO'}, "The IDF and weather files are unchanged. The existing results have been kept.")
+            return {'FINISHED'}
         os.chdir(scene['viparams']['newdir'])
-        esimcmd = "EnergyPlus" 
-        self.esimrun = Popen(esimcmd.split(), stderr = PIPE, shell = True)
+        self.shards, self.refrun = [], None
+        if self.simnode.shards > 1:
+            shardruns = shardstart(scene, self.simnode, self.connode, self)
+            if not shardruns:
+                return {'CANCELLED'}
+            self.shards, self.refrun = shardruns
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(1, context.window)
+        wm.modal_handler_add(self)
+        if not self.shards:
+            self.esotail = esotail(os.path.join(scene['viparams']['newdir'], 'eplusout.eso'))
+            esimcmd = "EnergyPlus" 
+            self.esimrun = Popen(esimcmd.split(), stderr = PIPE, shell = True)
         self.simnode.run = 0
         return {'RUNNING_MODAL'}
 
+class NODE_OT_EnSimBatch(bpy.types.Operator):
+    bl_idname = "node.ensimbatch"
+    bl_label = "Batch"
+    bl_description = "Run a batch of EnergyPlus variants"
+    bl_register = True
+    bl_undo = True
+
+    nodeid = bpy.props.StringProperty()
+
+    def modal(self, context, event):
+        if event.type == 'TIMER':
+            scene = context.scene
+            for variant in [variant for variant in self.runs if self.runs[variant][0].poll() is not None]:
+                self.rows.append(batchcollect(variant, self.runs.pop(variant)[1]))
+            while self.variants and len(self.runs) < self.pnum:
+                variant = self.variants.pop(0)
+                self.runs[variant] = batchstart(scene, self.simnode, variant)
+            self.simnode.run = int(100 * len(self.rows)/self.vnum)
+            if self.runs:
+                return {'PASS_THROUGH'}
+            context.window_manager.event_timer_remove(self._timer)
+            batchsummary(scene, self.simnode, sorted(self.rows))
+            nodecolour(self.simnode, 0)
+            self.simnode.run = -1
+            errs = len([row for row in self.rows if row[1] == 'Error'])
+            self.report(({'INFO'}, {'ERROR'})[errs > 0], "Batch finished: {} of {} variants failed. Summary in the {}-batch text.".format(errs, self.vnum, self.simnode.resname) if errs else "Batch finished: {} variants. Summary in the {}-batch text.".format(self.vnum, self.simnode.resname))
+            return {'FINISHED'}
+        else:
+            return {'PASS_THROUGH'}
+
+    def invoke(self, context, event):
+        scene = context.scene
+        if viparams(self, scene):
+            return {'CANCELLED'}
+        self.simnode = bpy.data.node_groups[self.nodeid.split('@')[1]].nodes[self.nodeid.split('@')[0]]
+        if not os.path.isdir(bpy.path.abspath(self.simnode.batchdir)) or not batchvariants(bpy.path.abspath(self.simnode.batchdir)):
+            self.report({'ERROR'}, "There are no IDF files in the batch directory")
+            return {'CANCELLED'}
+        if not all([os.path.isfile(os.path.join(scene['viparams']['newdir'], f)) for f in ('in.epw', 'Energy+.idd')]):
+            self.report({'ERROR'}, "Export the EnVi context first")
+            return {'CANCELLED'}
+        self.simnode.sim()
+        self.variants, self.runs, self.rows = batchvariants(bpy.path.abspath(self.simnode.batchdir)), {}, []
+        self.vnum, self.pnum = len(self.variants), (self.simnode.batchnum, int(scene['viparams']['nproc']))[self.simnode.batchnum == 0]
+        nodecolour(self.simnode, 1)
+        self.simnode.run = 0
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(1, context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
 class NODE_OT_Chart(bpy.types.Operator, io_utils.ExportHelper):
     bl_idname = "node.chart"
     bl_label = "Chart"
@@ -726,7 +820,7 @@ class NODE_OT_Chart(bpy.types.Operator, io_utils.ExportHelper):
     def invoke(self, context, event):
         node = bpy.data.node_groups[self.nodeid.split('@')[1]].nodes[self.nodeid.split('@')[0]]
         innodes = list(OrderedDict.fromkeys([inputs.links[0].from_node for inputs in node.inputs if inputs.links]))
-        if not len(innodes[0]['allresdict']['Hour']):
+        if not len(retenres(innodes[0])['Hour']):
             self.report({'ERROR'},"There are no results in the results file. Check the results.err file in Blender")
             return {'CANCELLED'}
         if not mp:
@@ -763,7 +857,7 @@ class NODE_OT_SunPath(bpy.types.Operator):
     nodeid = bpy.props.StringProperty()
     
     def invoke(self, context, event):
-        solringnum, sd, numpos = 0, 100, {}
+        sd = 100
         node = bpy.data.node_groups[self.nodeid.split('@')[1]].nodes[self.nodeid.split('@')[0]]
         node.export()
         scene, scene.resnode, scene.restree = context.scene, node.name, self.nodeid.split('@')[1]
@@ -778,8 +872,8 @@ class NODE_OT_SunPath(bpy.types.Operator):
         if 'SUN' in [ob.data.type for ob in context.scene.objects if ob.data == 'LAMP' and ob.hide == False]:
             [ob.data.type for ob in context.scene.objects if ob.data == 'LAMP' and ob.data.type == 'SUN'][0]['VIType'] = 'Sun'
         elif 'Sun' not in [ob.get('VIType') for ob in context.scene.objects]:
-            bpy.ops.object.lamp_add(type = "SUN")
-            sun = context.active_object
+            sun = bpy.data.objects.new('Sun', bpy.data.lamps.new('Sun', 'SUN'))
+            scene.objects.link(sun)
             sun['VIType'] = 'Sun'
         else:
             sun = [ob for ob in context.scene.objects if ob.get('VIType') == 'Sun'][0]
@@ -791,91 +885,59 @@ class NODE_OT_SunPath(bpy.types.Operator):
         sun['solhour'], sun['solday'], sun['soldistance'] = scene.solhour, scene.solday, scene.soldistance
 
         if "SkyMesh" not in [ob.get('VIType') for ob in context.scene.objects]:
-            bpy.data.materials.new('SkyMesh')
-            bpy.ops.mesh.primitive_uv_sphere_add(segments=32, ring_count=16, size=105)
-            smesh = context.active_object
-            smesh.location, smesh.rotation_euler[0], smesh.cycles_visibility.shadow, smesh.name, smesh['VIType']  = (0,0,0), pi, False, "SkyMesh", "SkyMesh"
-            bpy.ops.object.material_slot_add()
-            smesh.material_slots[0].material = bpy.data.materials['SkyMesh']
-            bpy.ops.object.shade_smooth()
-            smesh.hide = True
+            smesh = bpy.data.objects.new('SkyMesh', uvsphere('SkyMesh', 32, 16, 105, bpy.data.materials.new('SkyMesh')))
+            scene.objects.link(smesh)
+            smesh.rotation_euler[0], smesh.cycles_visibility.shadow, smesh['VIType'], smesh.hide = pi, False, "SkyMesh", True
+            smesh.data.polygons.foreach_set('use_smooth', [True] * len(smesh.data.polygons))
 
         if "SunMesh" not in [ob.get('VIType') for ob in context.scene.objects]:
-            bpy.ops.mesh.primitive_uv_sphere_add(segments=12, ring_count=12, size=1)
-            sunob = context.active_object
-            sunob.location, sunob.cycles_visibility.shadow, sunob.name, sunob['VIType'] = (0, 0, 0), 0, "SunMesh", "SunMesh"
+            sunob = bpy.data.objects.new('SunMesh', uvsphere('SunMesh', 12, 12, 1, bpy.data.materials['Sun']))
+            scene.objects.link(sunob)
+            sunob.cycles_visibility.shadow, sunob['VIType'] = 0, "SunMesh"
         else:
             sunob = [ob for ob in context.scene.objects if ob.get('VIType') == "SunMesh"][0]
 
         if len(sunob.material_slots) == 0:
-             bpy.ops.object.material_slot_add()
-             sunob.material_slots[0].material = bpy.data.materials['Sun']
+             sunob.data.materials.append(bpy.data.materials['Sun'])
 
         for ob in context.scene.objects:
             if ob.get('VIType') == "SPathMesh":
                 context.scene.objects.unlink(ob)
                 ob.name = 'oldspathmesh'
 
-        bpy.ops.object.add(type = "MESH")
-        spathob = context.active_object
-        spathob.location, spathob.name,  spathob['VIType'], spathmesh = (0, 0, 0), "SPathMesh", "SPathMesh", spathob.data
-        bm = bmesh.new()
-        bm.from_mesh(spathmesh)
-
-        for doy in range(0, 363):
-            for hour in range(1, 25):
-                ([solalt, solazi]) = solarPosition(doy, hour, scene['latitude'], scene['longitude'])[2:]
-                bm.verts.new().co = [-(sd-(sd-(sd*cos(solalt))))*sin(solazi), -(sd-(sd-(sd*cos(solalt))))*cos(solazi), sd*sin(solalt)]
-        for v in range(24, len(bm.verts)):
-            if hasattr(bm.verts, "ensure_lookup_table"):
-                bm.verts.ensure_lookup_table()               
-            bm.edges.new((bm.verts[v], bm.verts[v - 24]))
-            if v in range(8568, 8736):
-                bm.edges.new((bm.verts[v], bm.verts[v - 8568]))
-                    
-        for doy in (79, 172, 355):
-            for hour in range(1, 241):                
-                ([solalt, solazi]) = solarPosition(doy, hour*0.1, scene['latitude'], scene['longitude'])[2:]                
-                bm.verts.new().co = [-(sd-(sd-(sd*cos(solalt))))*sin(solazi), -(sd-(sd-(sd*cos(solalt))))*cos(solazi), sd*sin(solalt)]
-                if hasattr(bm.verts, "ensure_lookup_table"):
-                    bm.verts.ensure_lookup_table()
-                if bm.verts[-1].co.z >= 0 and doy in (172, 355) and not hour%10:
-                    numpos['{}-{}'.format(doy, int(hour*0.1))] = bm.verts[-1].co[:]
-                if hour != 1:
-                    bm.edges.new((bm.verts[-2], bm.verts[-1]))
-                    solringnum += 1
-                if hour == 240:
-                    bm.edges.new((bm.verts[-240], bm.verts[-1]))
-                    solringnum += 1
-
-        bm.to_mesh(spathmesh)
-        bm.free()
-
-        bpy.ops.object.convert(target='CURVE')
-        spathob.data.bevel_depth, spathob.data.bevel_resolution = 0.15, 6
-        bpy.context.object.data.fill_mode = 'FULL'
-        bpy.ops.object.convert(target='MESH')
-        bpy.ops.object.material_slot_add()
-        spathob.material_slots[0].material, spathob['numpos'] = bpy.data.materials['HourRings'], numpos
-
-        for vert in spathob.data.vertices[0:16 * (solringnum + 3)]:
-            vert.select = True
-
-        bpy.ops.object.material_slot_add()
-        spathob.material_slots[-1].material = bpy.data.materials['SolEquoRings']
-        spathob.active_material_index = 1        
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.select_mode(type="VERT")
-        bpy.ops.object.material_slot_assign()
-        bpy.ops.mesh.select_all(action='SELECT')
-        bpy.ops.mesh.bisect(plane_co=(0.0, 0.0, 0.0), plane_no=(0.0, 0.0, 1.0), use_fill=True, clear_inner=True, clear_outer=False)
-        bpy.ops.object.mode_set(mode='OBJECT')       
-        bpy.ops.object.select_all(action='DESELECT')
+        # Hourly analemmas over the year and the equinox and solstice rings, clipped at the horizon and built as tubes in one go
+        doys, hours = numpy.repeat(numpy.arange(363), 24), numpy.tile(numpy.arange(1, 25), 363)
+        rdoys, rhours = numpy.repeat((79, 172, 355), 240), numpy.tile(numpy.arange(1, 241) * 0.1, 3)
+        solalts, solazis = solarpositions(numpy.append(doys, rdoys), numpy.append(hours, rhours), scene['latitude'], scene['longitude'])
+        pts = numpy.column_stack((-sd * numpy.cos(solalts) * numpy.sin(solazis), -sd * numpy.cos(solalts) * numpy.cos(solazis), sd * numpy.sin(solalts)))
+        apts, rpts = pts[:len(doys)], pts[len(doys):]
+        numpos = {'{}-{}'.format(doy, int(round(hour))): rpts[i][:].tolist() for i, (doy, hour) in enumerate(zip(rdoys, rhours)) if doy in (172, 355) and not round(hour * 10) % 10 and rpts[i][2] >= 0}
+        hruns = [run for h in range(24) for run in horizonruns(apts[h::24])]
+        rruns = [run for r in range(3) for run in horizonruns(rpts[r * 240:(r + 1) * 240])]
+        verts, faces, nfaces = tubemesh(hruns + rruns, 0.15)
+
+        spathmesh = bpy.data.meshes.new('SPathMesh')
+        spathmesh.vertices.add(len(verts))
+        spathmesh.vertices.foreach_set('co', verts.ravel().astype(numpy.float32))
+        spathmesh.loops.add(faces.size)
+        spathmesh.loops.foreach_set('vertex_index', faces.ravel().astype(numpy.int32))
+        spathmesh.polygons.add(len(faces))
+        spathmesh.polygons.foreach_set('loop_start', numpy.arange(0, faces.size, 4, dtype = numpy.int32))
+        spathmesh.polygons.foreach_set('loop_total', [4] * len(faces))
+        spathmesh.polygons.foreach_set('material_index', [0] * sum(nfaces[:len(hruns)]) + [1] * sum(nfaces[len(hruns):]))
+        spathmesh.polygons.foreach_set('use_smooth', [True] * len(faces))
+        spathmesh.update(calc_edges = True)
+        spathmesh.materials.append(bpy.data.materials['HourRings'])
+        spathmesh.materials.append(bpy.data.materials['SolEquoRings'])
+        spathob = bpy.data.objects.new('SPathMesh', spathmesh)
+        scene.objects.link(spathob)
+        spathob['VIType'], spathob['numpos'] = "SPathMesh", numpos
         compass((0,0,-sd*0.01), sd, spathob, bpy.data.materials['SPBase'])
 
         for ob in (spathob, sunob):
             spathob.cycles_visibility.diffuse, spathob.cycles_visibility.shadow, spathob.cycles_visibility.glossy, spathob.cycles_visibility.transmission = [False] * 4
 
+        cyfcprep(scene)
         if cyfc1 not in bpy.app.handlers.frame_change_pre:
             bpy.app.handlers.frame_change_pre.append(cyfc1)
         bpy.ops.view3d.spnumdisplay('INVOKE_DEFAULT')
@@ -1031,14 +1093,20 @@ class NODE_OT_Shadow(bpy.types.Operator):
         interval = datetime.timedelta(hours = modf(simnode.interval)[0], minutes = 60 * modf(simnode.interval)[1])
         times = [time + interval*t for t in range(int((endtime - time)/interval)) if simnode.starthour <= (time + interval*t).hour <= simnode.endhour]
         sps = [solarPosition(t.timetuple().tm_yday, t.hour+t.minute/60, scene['latitude'], scene['longitude'])[2:] for t in times]
-        direcs = [mathutils.Vector((-sin(sp[1]), -cos(sp[1]), tan(sp[0]))) for sp in sps if sp[0] > 0]
+        if simnode.skybin == '0':
+            direcs = [mathutils.Vector((-sin(sp[1]), -cos(sp[1]), tan(sp[0]))) for sp in sps if sp[0] > 0]
+            weights, simnode['binerror'] = numpy.ones(len(direcs)), 0
+        else:
+            direcs, weights, simnode['binerror'] = skybins([sp for sp in sps if sp[0] > 0], simnode.skybin, simnode.skymf, simnode.skyres)
+            self.report({'INFO'}, "{} sun positions traced as {} sky patches, largest angular error {:.2f} degrees".format(int(sum(weights)), len(direcs), simnode['binerror']))
 
+        # Result layers are kept on a local space bmesh, while origins are world space at the frame they are traced
+        sensors = []
+        scene.frame_set(frange[0])
         for o in [scene.objects[on] for on in scene['shadc']]:
             o['omin'], o['omax'], o['oave'] = [0] * fdiff, [100] * fdiff, [100] * fdiff
             bm = bmesh.new()
             bm.from_mesh(o.data)
-            bm.transform(o.matrix_world)  
-            obcalcarea = sum([f.calc_area() for f in bm.faces if o.data.materials[f.material_index].mattype == '2'])
             if bm.faces.layers.int.get('cindex'):
                     bm.faces.layers.int.remove(bm.faces.layers.int['cindex'])
             if bm.verts.layers.int.get('cindex'):
@@ -1047,33 +1115,66 @@ class NODE_OT_Shadow(bpy.types.Operator):
                 bm.faces.layers.int.new('cindex')
                 cindex = bm.faces.layers.int['cindex']
                 [bm.faces.layers.float.new('res{}'.format(fi)) for fi in frange]
-                cfaces = [f for f in bm.faces if o.data.materials[f.material_index].mattype == '2']
-                for ci, f in enumerate([f for f in cfaces]):
+                cpoints = [f for f in bm.faces if o.data.materials[f.material_index].mattype == '2']
+                for ci, f in enumerate([f for f in cpoints]):
                     f[cindex] = ci + 1
             else:               
                 bm.verts.layers.int.new('cindex')
                 cindex = bm.verts.layers.int['cindex'] 
                 bm.verts.layers.int.new('cindex')
                 [bm.verts.layers.float.new('res{}'.format(fi)) for fi in frange]
-                cverts = [v for v in bm.verts if any([o.data.materials[f.material_index].mattype == '2' for f in v.link_faces])]
-                for ci, v in enumerate([v for v in cverts]):
+                cpoints = [v for v in bm.verts if any([o.data.materials[f.material_index].mattype == '2' for f in v.link_faces])]
+                for ci, v in enumerate([v for v in cpoints]):
                     v[cindex] = ci
-                    
-            for fi, frame in enumerate(frange):
-                scene.frame_set(frame)
-                if simnode.cpoint == '0':  
-                    shadres = bm.faces.layers.float['res{}'.format(frame)]  
-                    cfaces = [f for f in bm.faces if o.data.materials[f.material_index].mattype == '2']
-                    for f in cfaces:
-                        f[shadres] = 100 * (1 - sum([bpy.data.scenes[0].ray_cast(f.calc_center_median() + (simnode.offset * f.normal), f.calc_center_median() + 10000*direc)[0] for direc in direcs])/len(direcs))
-                    o['omin'][fi], o['omax'][fi], o['oave'][fi] = min([f[shadres] for f in cfaces]), max([f[shadres] for f in cfaces]), sum([f[shadres] for f in cfaces])/len(cfaces)
-                else:                                                       
-                    shadres = bm.verts.layers.float['res{}'.format(frame)]    
-                    cverts = [v for v in bm.verts if any([o.data.materials[f.material_index].mattype == '2' for f in v.link_faces])]
-                    for v in cverts:
-                        v[shadres] = 100 * (1 - sum([bpy.data.scenes[0].ray_cast(v.co + simnode.offset*v.normal, v.co + 10000*direc)[0] for direc in direcs])/len(direcs))
-                    o['omin'][fi], o['omax'][fi], o['oave'][fi] = min([v[shadres] for v in cverts]), max([v[shadres] for v in cverts]) , obcalcarea * sum([v[shadres]/vertarea(bm,v) for v in cverts])/len(cverts)
-            bm.transform(o.matrix_world.inverted())
+            sensors.append((o, bm, cpoints) + shadorigins(o, simnode.cpoint, simnode.offset))
+
+        # Each frame needs one BVH of the scene for all sensors and sun directions
+        if simnode.engine == '1':
+            shaddir = os.path.join(scene['viparams']['newdir'], 'shadow')
+            if not os.path.isdir(shaddir):
+                os.makedirs(shaddir)
+            numpy.save(os.path.join(shaddir, 'direcs.npy'), numpy.array([direc.normalized()[:] for direc in direcs]).reshape(-1, 3))
+            numpy.save(os.path.join(shaddir, 'weights.npy'), weights)
+
+        sunlits, pobinfo = [None] * len(sensors), {}
+        for fi, frame in enumerate(frange):
+            scene.frame_set(frame)
+            verts, polys, obinfo = shadowgeom(scene)
+            # After the first frame only sensors that moved, or whose swept ray bundle meets an object that moved or changed, are re-traced
+            cnames = [on for on in set(obinfo).union(pobinfo) if (obinfo.get(on) or ('', ''))[:2] != (pobinfo.get(on) or ('', ''))[:2]]
+            cboxes = [info[2:] for info in [obinfo.get(on) for on in cnames] + [pobinfo.get(on) for on in cnames] if info]
+            traces = [si for si, sensor in enumerate(sensors) if not fi or sensor[0].name in cnames or sweptbox(sensor[3], direcs, cboxes)]
+            pobinfo = obinfo
+            # Sensors that moved or were deformed get their origins, normals and areas rebuilt for this frame
+            for si in [si for si in traces if fi and sensors[si][0].name in cnames]:
+                sensors[si] = sensors[si][:3] + shadorigins(sensors[si][0], simnode.cpoint, simnode.offset)
+                if len(sensors[si][3]) != len(sensors[si][2]):
+                    [sensor[1].free() for sensor in sensors]
+                    self.report({'ERROR'},"The sensing geometry of {} changes between frames. Only its transform or vertex positions can be animated.".format(sensors[si][0].name))
+                    return {'CANCELLED'}
+
+            if traces:
+                toffsets = numpy.cumsum([0] + [len(sensors[si][3]) for si in traces])
+                if simnode.engine == '1':
+                    numpy.save(os.path.join(shaddir, 'origins.npy'), numpy.array([origin[:] for si in traces for origin in sensors[si][3]]))
+                    allsunlit = enginesunlit(scene, shaddir, shadowtris(verts, polys), int(scene['viparams']['nproc']))
+                    if allsunlit is None:
+                        [sensor[1].free() for sensor in sensors]
+                        self.report({'ERROR'},"A shadow worker process failed. Check the Blender console.")
+                        return {'CANCELLED'}
+                else:
+                    allsunlit = bvhsunlit(shadowbvh(verts, polys), [origin for si in traces for origin in sensors[si][3]], direcs, weights)
+                for ti, si in enumerate(traces):
+                    sunlits[si] = allsunlit[toffsets[ti]:toffsets[ti + 1]]
+
+            for (o, bm, cpoints, origins, vareas, obcalcarea), sunlit in zip(sensors, sunlits):
+                shadres = (bm.faces, bm.verts)[simnode.cpoint == '1'].layers.float['res{}'.format(frame)]
+                for cp, sl in zip(cpoints, sunlit.tolist()):
+                    cp[shadres] = sl
+                o['omin'][fi], o['omax'][fi] = float(sunlit.min()), float(sunlit.max())
+                o['oave'][fi] = float(sunlit.mean()) if simnode.cpoint == '0' else float(obcalcarea * numpy.sum(sunlit/vareas)/len(cpoints))
+
+        for o, bm, cpoints, origins, vareas, obcalcarea in sensors:
             bm.to_mesh(o.data)
             bm.free()
         
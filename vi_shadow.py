@@ -0,0 +1,82 @@
+import sys, os, numpy
+
+# Shadow study engine. No bpy here: the module is imported by the add-on to build the BVH and is also run as a script,
+# with Blender's python, by the worker processes. The BVH and the sensor origins are shared between workers as memory
+# mapped .npy files in the shadow folder, and each worker writes the weighted lit counts for its chunk of sun directions
+
+def bvhbuild(tris, leafsize = 8):
+    # Median split BVH over world space triangles (n, 3, 3). Nodes are flat arrays: bounds, children and leaf triangle ranges
+    cents, order = tris.mean(axis = 1), numpy.arange(len(tris))
+    bmins, bmaxs, lefts, rights, starts, counts = [], [], [], [], [], []
+    stack = [(0, len(tris), -1, 0)]
+    while stack:
+        start, end, parent, side = stack.pop()
+        ni, ntris = len(bmins), tris[order[start:end]]
+        bmins.append(ntris.reshape(-1, 3).min(axis = 0))
+        bmaxs.append(ntris.reshape(-1, 3).max(axis = 0))
+        lefts.append(-1)
+        rights.append(-1)
+        if parent > -1:
+            (lefts, rights)[side][parent] = ni
+        if end - start <= leafsize:
+            starts.append(start)
+            counts.append(end - start)
+        else:
+            starts.append(0)
+            counts.append(0)
+            ncents = cents[order[start:end]]
+            axis, mid = numpy.argmax(ncents.max(axis = 0) - ncents.min(axis = 0)), (end - start)//2
+            order[start:end] = order[start:end][numpy.argpartition(ncents[:, axis], mid)]
+            stack += [(start + mid, end, ni, 1), (start, start + mid, ni, 0)]
+    return tris[order], numpy.array(bmins), numpy.array(bmaxs), numpy.array(lefts), numpy.array(rights), numpy.array(starts), numpy.array(counts)
+
+def bvhsave(shaddir, tris):
+    for name, arr in zip(('tris', 'bmins', 'bmaxs', 'lefts', 'rights', 'starts', 'counts'), bvhbuild(tris)):
+        numpy.save(os.path.join(shaddir, '{}.npy'.format(name)), arr)
+
+def bvhload(shaddir):
+    return [numpy.load(os.path.join(shaddir, '{}.npy'.format(name)), mmap_mode = 'r') for name in ('tris', 'bmins', 'bmaxs', 'lefts', 'rights', 'starts', 'counts')]
+
+def occluded(origins, direc, bvh, dist = 10000, eps = 1e-6):
+    # Packet traversal: all rays share the sun direction, so the slab tests and the Moller-Trumbore edge terms of each node
+    # are vectorised over the rays still alive in it. Returns a boolean per origin
+    tris, bmins, bmaxs, lefts, rights, starts, counts = bvh
+    hit, invd = numpy.zeros(len(origins), dtype = bool), 1/numpy.where(numpy.abs(direc) < 1e-12, 1e-12, direc)
+    stack = [(0, numpy.arange(len(origins)))]
+    while stack:
+        ni, ri = stack.pop()
+        ri = ri[~hit[ri]]
+        if not len(ri):
+            continue
+        t1, t2 = (bmins[ni] - origins[ri]) * invd, (bmaxs[ni] - origins[ri]) * invd
+        tmin, tmax = numpy.minimum(t1, t2).max(axis = 1), numpy.maximum(t1, t2).min(axis = 1)
+        ri = ri[(tmax >= numpy.maximum(tmin, 0)) & (tmin <= dist)]
+        if not len(ri):
+            continue
+        if counts[ni]:
+            ltris = numpy.array(tris[starts[ni]:starts[ni] + counts[ni]])
+            e1, e2 = ltris[:, 1] - ltris[:, 0], ltris[:, 2] - ltris[:, 0]
+            p = numpy.cross(direc, e2)
+            det = numpy.einsum('ij,ij->i', e1, p)
+            invdet = 1/numpy.where(numpy.abs(det) < 1e-12, 1e-12, det)
+            tvec = origins[ri][:, None, :] - ltris[None, :, 0]
+            u = numpy.einsum('rtj,tj->rt', tvec, p) * invdet
+            q = numpy.cross(tvec, e1[None])
+            v = numpy.einsum('rtj,j->rt', q, direc) * invdet
+            t = numpy.einsum('rtj,tj->rt', q, e2) * invdet
+            hit[ri[((numpy.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > eps) & (t < dist)).any(axis = 1)]] = True
+        else:
+            stack += [(lefts[ni], ri), (rights[ni], ri)]
+    return hit
+
+def litcount(shaddir, dstart, dend):
+    bvh, origins = bvhload(shaddir), numpy.load(os.path.join(shaddir, 'origins.npy'))
+    direcs, weights = numpy.load(os.path.join(shaddir, 'direcs.npy')), numpy.load(os.path.join(shaddir, 'weights.npy'))
+    lit = numpy.zeros(len(origins))
+    for direc, weight in zip(direcs[dstart:dend], weights[dstart:dend]):
+        lit += weight * ~occluded(origins, direc, bvh)
+    return lit
+
+if __name__ == '__main__':
+    shaddir, chunk, dstart, dend = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+    numpy.save(os.path.join(shaddir, 'lit-{}.npy'.format(chunk)), litcount(shaddir, dstart, dend))
@@ -52,9 +52,11 @@ class Vi3DPanel(bpy.types.Panel):
                     if context.mode != "EDIT":
                         row = layout.row()
                         row.label(text="{:-<48}".format("Point visualisation "))
-                        propdict = OrderedDict([('Enable', "vi_display_rp"), ("Selected only:", "vi_display_sel_only"), ("Visible only:", "vi_display_vis_only"), ("Font size:", "vi_display_rp_fs"), ("Font colour:", "vi_display_rp_fc"), ("Font shadow:", "vi_display_rp_fsh"), ("Position offset:", "vi_display_rp_off")])
+                        propdict = OrderedDict([('Enable', "vi_display_rp"), ("Selected only:", "vi_display_sel_only"), ("Visible only:", "vi_display_vis_only"), ("Font size:", "vi_display_rp_fs"), ("Font colour:", "vi_display_rp_fc"), ("Font shadow:", "vi_display_rp_fsh"), ("Position offset:", "vi_display_rp_off"), ("Label binning:", "vi_display_rp_bin")])
                         for prop in propdict.items():
                             newrow(layout, prop[0], scene, prop[1])
+                        if scene.vi_display_rp_bin != '0':
+                            newrow(layout, "Cell size:", scene, "vi_display_rp_cell")
                         row = layout.row()
                         row.label(text="{:-<60}".format(""))
 